@@ -0,0 +1,314 @@
+from collections import defaultdict
+
+from shipping_parser import shipment_items
+
+# ==========================================
+# SINGLE-PASS AGGREGATION ENGINE
+# ==========================================
+# Every source record is streamed ONCE and handed to all reducers:
+#   1. incoming orders   -> on_incoming_order(entry)
+#   2. purchase orders   -> on_purchase_order(order)
+#   3. shipments         -> on_shipment(ship, parsed_items)   (stored items, or details parsed once)
+# New aggregates plug in as extra Reducer subclasses.
+
+
+class Reducer:
+    """ Base class. Override only the hooks you need; result() returns the aggregate. """
+    name = None
+
+    def on_incoming_order(self, entry):
+        pass
+
+    def on_purchase_order(self, order):
+        pass
+
+    def on_shipment(self, ship, parsed_items):
+        pass
+
+    def result(self):
+        return None
+
+
+def _subscribers(reducers, hook):
+    # Only call reducers that actually override the hook
+    return [getattr(r, hook) for r in reducers if getattr(type(r), hook) is not getattr(Reducer, hook)]
+
+
+def aggregate(reducers, incoming_orders=(), purchase_orders=(), shipments=()):
+    """
+    Runs all reducers in one pass over the data.
+    result() is called in list order, after the pass.
+    Returns: { reducer.name: reducer.result() }
+    """
+    on_incoming = _subscribers(reducers, 'on_incoming_order')
+    on_purchase = _subscribers(reducers, 'on_purchase_order')
+    on_shipment = _subscribers(reducers, 'on_shipment')
+
+    # Incoming orders first, so joins are ready when purchase orders stream by
+    if on_incoming:
+        for entry in incoming_orders:
+            for hook in on_incoming:
+                hook(entry)
+
+    if on_purchase:
+        for order in purchase_orders:
+            for hook in on_purchase:
+                hook(order)
+
+    if on_shipment:
+        for ship in shipments:
+            parsed_items = shipment_items(ship)
+            for hook in on_shipment:
+                hook(ship, parsed_items)
+
+    return {r.name: r.result() for r in reducers}
+
+
+# ==========================================
+# REDUCERS
+# ==========================================
+
+# Purchase-order product names that differ from products_data keys
+STOCK_NAME_ALIASES = {
+    "Flip Straw Tumbler 30 OZ Rose Quartz": "The IceFlow™ Flip Straw Tumbler 30 OZ Rose Quartz",
+}
+
+
+def tally_stock_counts(orders):
+    """
+    Vectorized stock tally over purchase orders (each with 'note' and a parsed 'items' list).
+    Returns: { "Product Name": { "total": 0, "signed": 0, "unsigned": 0 } }, in first-seen order.
+    """
+    import pandas as pd
+
+    orders_df = pd.DataFrame({
+        'note': [order.get('note', '') for order in orders],
+        'items': [order['items'] for order in orders],
+    })
+
+    # 1. One row per purchase-order line
+    lines = orders_df.explode('items', ignore_index=True).dropna(subset=['items'])
+    if lines.empty:
+        return {}
+    items = pd.DataFrame(lines['items'].tolist(), index=lines.index)
+
+    # 2. Normalize names to match products_data keys
+    p_name = items['product'].str.replace(" (Gift Box)", "", regex=False).replace(STOCK_NAME_ALIASES)
+    qty = items['qty']
+
+    # 3. An order is "Signed" (Secured/Shipped) if its note contains BOTH "已发货" and "已签收".
+    #    Returns (qty < 0) always reduce 'Signed' (On Hand) stock, NOT 'Unsigned'.
+    note = lines['note'].astype(str)
+    is_signed = note.str.contains("已发货", regex=False) & note.str.contains("已签收", regex=False)
+    to_signed = (qty < 0) | is_signed
+
+    tally = pd.DataFrame({
+        'name': p_name,
+        'total': qty,
+        'signed': qty.where(to_signed, 0),
+        'unsigned': qty.where(~to_signed, 0),
+    }).groupby('name', sort=False).sum()
+
+    return {
+        name: {'total': total, 'signed': signed, 'unsigned': unsigned}
+        for name, total, signed, unsigned in zip(tally.index.tolist(), tally['total'].tolist(),
+                                                 tally['signed'].tolist(), tally['unsigned'].tolist())
+    }
+
+
+class StockCounts(Reducer):
+    """
+    Tally up all purchase orders (see tally_stock_counts).
+    Orders are collected while streaming and tallied as one dataframe op in result(),
+    which fills self.counts in place -- list this reducer before any reducer that reads it.
+    """
+    name = 'stock_counts'
+
+    def __init__(self):
+        self.counts = {}
+        self._orders = []
+
+    def on_purchase_order(self, order):
+        self._orders.append(order)
+
+    def result(self):
+        self.counts.clear()
+        self.counts.update(tally_stock_counts(self._orders))
+        return self.counts
+
+
+class ShippedCounts(Reducer):
+    """ Total quantity shipped to China per product. """
+    name = 'shipped_counts'
+
+    def __init__(self):
+        self.counts = {}
+
+    def on_shipment(self, ship, parsed_items):
+        for (p_name, qty, is_packaged) in parsed_items:
+            self.counts[p_name] = self.counts.get(p_name, 0) + qty
+
+    def result(self):
+        return self.counts
+
+
+def format_details(detail_dict):
+    if not detail_dict: return "——"
+    return ", ".join([f"{name}({qty})" for name, qty in detail_dict.items()])
+
+
+def stats_image_and_type(p_name, product_images, fallback_images):
+    """ (image, type) of a product_stats row for a product not in the stats template. """
+    # Check products_data first, then IMAGE_MAP
+    img_path = product_images.get(p_name)
+    if not img_path:
+        img_path = fallback_images.get(p_name, 'img/default.png')
+
+    # Determine type
+    p_type = 'product'
+    if "礼盒" in p_name:
+        p_type = 'accessory'
+    elif "包装" in p_name:
+        p_type = 'packaging'
+    return img_path, p_type
+
+
+class ProductStats(Reducer):
+    """
+    Builds the product_stats documents: shipped totals split into packaged / unpackaged,
+    with per-recipient breakdowns.
+    stock_counts is read at result() time, so it can be filled by a StockCounts in the same pass.
+    """
+    name = 'product_stats'
+
+    def __init__(self, current_inventory_stats, product_images, fallback_images, stock_counts):
+        self.product_images = product_images
+        self.fallback_images = fallback_images
+        self.stock_counts = stock_counts
+        self.product_metadata = {}
+
+        # 1. Pre-populate from existing stats template
+        for stat in current_inventory_stats:
+            self.product_metadata[stat['产品名称']] = self._new_entry(stat.get('image', 'img/default.png'),
+                                                                     stat.get('类型', 'product'))
+
+    @staticmethod
+    def _new_entry(image, p_type):
+        return {
+            'image': image,
+            'type': p_type,
+            '已发总数': 0, '带包装': 0, '带包装详情': defaultdict(int),
+            '不带包装': 0, '不带包装详情': defaultdict(int)
+        }
+
+    def on_shipment(self, ship, parsed_items):
+        # Same name as the shipment's customer profile ("Alice" and "Alice " are one person)
+        recipient = str(ship['recipient']).strip()
+
+        for p_name, qty, is_packaged in parsed_items:
+            # Init if new (e.g. found in shipping but not in manual stats list)
+            if p_name not in self.product_metadata:
+                self.product_metadata[p_name] = self._new_entry(*stats_image_and_type(
+                    p_name, self.product_images, self.fallback_images))
+
+            p_data = self.product_metadata[p_name]
+            p_data['已发总数'] += qty
+
+            # --- STRICT PACKAGING LOGIC ---
+            # Special Case: "Packaging Only" is implicitly "Packaged"
+            final_pack = is_packaged or p_name == "压扁包装"
+
+            # Assign to correct column
+            if final_pack:
+                p_data['带包装'] += qty
+                p_data['带包装详情'][recipient] += qty
+            else:
+                p_data['不带包装'] += qty
+                p_data['不带包装详情'][recipient] += qty
+
+    def result(self):
+        product_metadata = self.product_metadata
+        final_stats_list = []
+
+        # Sort
+        sorted_names = sorted(product_metadata.keys(),
+                              key=lambda x: (product_metadata[x]['type'] == 'packaging', -product_metadata[x]['已发总数']))
+
+        for p_name in sorted_names:
+            p_data = product_metadata[p_name]
+
+            if p_data['已发总数'] <= 0: continue
+
+            total_stock = 0
+            if p_name in self.stock_counts:
+                total_stock = self.stock_counts[p_name]['total']
+            if p_data['type'] == 'packaging': total_stock = 'N/A'
+
+            final_stats_list.append({
+                "产品名称": p_name,
+                "image": p_data['image'],
+                "已发总数": p_data['已发总数'],
+                "带包装": p_data['带包装'],
+                "带包装详情": format_details(p_data['带包装详情']),
+                "不带包装": p_data['不带包装'],
+                "不带包装详情": format_details(p_data['不带包装详情']),
+                "总库存": total_stock,
+                "类型": p_data['type']
+            })
+
+        return final_stats_list
+
+
+# Helper function to generate tracking URLs
+def get_tracking_url(tracking_num):
+    if not tracking_num or tracking_num == "——":
+        return ""
+    tracking_num = tracking_num.strip()
+    if tracking_num.upper().startswith("1Z"):
+        return f"https://www.ups.com/track?track=yes&trackNums={tracking_num}"
+    return f"https://www.fedex.com/fedextrack/?trknbr={tracking_num}"
+
+
+def get_junan_tracking_url(tracking_num, phone):
+    return f"https://www.junanex.com/tracking?code={tracking_num}&mobile={phone}"
+
+
+class TrackingJoin(Reducer):
+    """
+    Joins incoming-order tracking numbers onto purchase orders (sets order['shipments']).
+    Result: { order_id: [shipment_info, ...] }
+    """
+    name = 'tracking_map'
+
+    def __init__(self):
+        self.tracking_map = {}
+        self._seen = set()
+
+    def on_incoming_order(self, entry):
+        o_id = entry.get('order_id')
+        t_num = entry.get('tracking')
+
+        if not o_id or not t_num or t_num == "——": return
+
+        # Keep the first entry per (order, tracking number)
+        if (o_id, t_num) in self._seen: return
+        self._seen.add((o_id, t_num))
+
+        t_url = entry.get('tracking_url', '')
+        if not t_url or t_url == t_num:
+            t_url = get_tracking_url(t_num)
+
+        shipment_info = {
+            "tracking_number": t_num,
+            "tracking_url": t_url,
+            "status": entry.get('status', 'Unknown'),
+            "carrier": "UPS" if t_num.upper().startswith("1Z") else "FedEx",
+            "signed": entry.get('signed', 'No')
+        }
+        self.tracking_map.setdefault(o_id, []).append(shipment_info)
+
+    def on_purchase_order(self, order):
+        order['shipments'] = self.tracking_map.get(order['order_id'], [])
+
+    def result(self):
+        return self.tracking_map
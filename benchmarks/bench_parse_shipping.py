@@ -0,0 +1,223 @@
+"""
+Micro-benchmark: compiled + memoized parse_shipping_details vs. the original implementation.
+
+Usage:
+    python benchmarks/bench_parse_shipping.py [--n 100000] [--distinct 2000] [--seed 42]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shipping_parser
+from shipping_parser import NAME_MAP, parse_shipping_details
+
+
+# ==========================================
+# BASELINE
+# ==========================================
+def legacy_parse_shipping_details(details_str):
+    """ Verbatim copy of the original db_refresh.parse_shipping_details (per-item sort + linear scan). """
+    items = []
+    # 1. Standardize string format
+    # Replace x/X with *, standardize brackets, remove spaces
+    s = details_str.replace("x", "*").replace("X", "*").replace("（", "(").replace("）", ")").replace(" ", "")
+
+    # 2. Product Name Mapping
+    # Maps keywords to the canonical Product Name in your database
+    name_map = {
+        # 20oz Blue
+        "20oz蓝": "蓝底 20oz", "蓝20oz": "蓝底 20oz", "蓝底20oz": "蓝底 20oz",
+        # 40oz Blue
+        "40oz蓝": "蓝底 40oz", "蓝40oz": "蓝底 40oz", "蓝底40oz": "蓝底 40oz", "40蓝": "蓝底 40oz",
+        # 30oz Blue
+        "30oz蓝": "蓝底 30oz", "蓝30oz": "蓝底 30oz", "蓝底30oz": "蓝底 30oz",
+        # 20oz White
+        "20oz白": "白底 20oz", "白20oz": "白底 20oz", "白底20oz": "白底 20oz",
+        "30oz白": "白底 30oz", "白30oz": "白底 30oz", "白底30oz": "白底 30oz",
+        # 40oz White
+        "40oz白": "白底 40oz", "白40oz": "白底 40oz", "白底40oz": "白底 40oz", "40白": "白底 40oz",
+        # 20oz pink
+        "20oz粉": "粉底 20oz", "粉20oz": "粉底 20oz", "粉底20oz": "粉底 20oz",
+        "40oz粉": "粉底 40oz", "粉40oz": "粉底 40oz", "粉底40oz": "粉底 40oz", "40粉": "粉底 40oz",
+        # Slim Bottle
+        "SlimBottle": "Slim Bottle", "Slim": "Slim Bottle",  # Spaceless due to earlier replace
+        "礼盒": "礼盒",
+        "HolidayReserveAllDayWineSet": "Holiday Reserve All Day Wine Set",
+        "TheReserveWineTumblerSet|11oz": "The Reserve Wine Tumbler Set | 11 oz",
+        "Everyday Camp Mug Set": "Everyday Camp Mug Set", "EverydayCampMugSet": "Everyday Camp Mug Set",
+        "Holiday The Quencher Details ProTour Tumbler Set": "Holiday The Quencher Details ProTour Tumbler Set",
+        "HolidayTheQuencherDetailsProTourTumblerSet": "Holiday The Quencher Details ProTour Tumbler Set",
+        "Coquette Bow Chantilly 20oz": "Coquette Bow Chantilly 20oz", "CoquetteBowChantilly20oz": "Coquette Bow Chantilly 20oz",
+        "情人节款20oz": "情人节款20oz", "情人节款30oz": "情人节款30oz", "情人节款40oz": "情人节款40oz",
+        "情人节款红色20oz": "情人节款红色20oz", "情人节款红色30oz": "情人节款红色30oz", "情人节款红色40oz": "情人节款红色40oz",
+    }
+
+    # 3. Handle Parentheses Groups
+    # We replace '+' inside parentheses with '&' to split safely later
+    temp_s = ""
+    depth = 0
+    for char in s:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == '+' and depth > 0:
+            temp_s += '&'
+        else:
+            temp_s += char
+
+    parts = temp_s.split('+')
+
+    # 4. Handle Special "Packaging Only" item
+    if "压扁包装" in s:
+        match = re.search(r'(\d+)\*?压扁包装', s)
+        qty = int(match.group(1)) if match else 1
+        items.append(("压扁包装", qty, True))
+
+        # 5. Process each part
+    for part in parts:
+        part = part.strip()
+        if not part: continue
+
+        mult = 1
+        content = part
+
+        # Extract multiplier (e.g., "3*...")
+        if '*' in part:
+            try:
+                m_str, _content = part.split('*', 1)
+                mult = int(m_str)
+                content = _content
+            except:
+                pass
+
+        content = content.replace('&', '+')
+
+        # --- Helper to process a single item string ---
+        def process_single_item(item_str, multiplier):
+            # A. Check for Packaging Keyword
+            is_pkg = "包装" in item_str or "带包装" in item_str
+
+            # B. Clean the string for matching (Remove "包装" so "蓝包装20oz" becomes "蓝20oz")
+            clean_str = item_str.replace("包装", "").replace("带包装", "")
+
+            # C. Match against map
+            matched = False
+            # Sort keys by length desc to match longest first (e.g. avoid matching "Slim" inside "Slim Bottle")
+            sorted_keys = sorted(name_map.keys(), key=len, reverse=True)
+
+            for key in sorted_keys:
+                if key in clean_str:
+                    items.append((name_map[key], multiplier, is_pkg))
+                    matched = True
+                    break
+
+            # Debugging check (Optional)
+            # if not matched and "压扁包装" not in item_str:
+            #    print(f"Warning: Could not identify product in '{item_str}'")
+
+        # Check for groups (...)
+        if '(' in content:
+            match = re.search(r'\((.*?)\)', content)
+            if match:
+                inner = match.group(1)
+                sub_items = inner.split('+')
+                for sub in sub_items:
+                    # Handle inner multiplier if exists (e.g. inside group)
+                    sub_mult = 1
+                    sub_content = sub
+                    if '*' in sub:
+                        try:
+                            sm, sc = sub.split('*', 1)
+                            sub_mult = int(sm)
+                            sub_content = sc
+                        except:
+                            pass
+
+                    final_mult = mult * sub_mult
+                    process_single_item(sub_content, final_mult)
+        else:
+            # Single Item
+            process_single_item(content, mult)
+
+    return items
+
+
+# ==========================================
+# SYNTHETIC DETAILS STRINGS
+# ==========================================
+def random_item(rng):
+    key = rng.choice(list(NAME_MAP.keys()))
+    if rng.random() < 0.5:
+        # "蓝20oz" -> "蓝包装20oz" / "20oz蓝包装"
+        key = key[:1] + "包装" + key[1:] if rng.random() < 0.5 else key + "包装"
+    return key
+
+
+def random_details(rng):
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        if rng.random() < 0.2:
+            group = "+".join(f"{rng.randint(1, 2)}*{random_item(rng)}" if rng.random() < 0.3 else random_item(rng)
+                             for _ in range(rng.randint(2, 4)))
+            parts.append(f"{rng.randint(1, 3)}*({group})")
+        elif rng.random() < 0.05:
+            parts.append(f"{rng.randint(1, 5)}*压扁包装")
+        else:
+            parts.append(f"{rng.randint(1, 8)}{rng.choice(['*', 'x', ' * '])}{random_item(rng)}")
+    s = rng.choice(["+", " + "]).join(parts)
+    if rng.random() < 0.1:
+        s = s.replace("(", "（").replace(")", "）")
+    return s
+
+
+def make_corpus(n, distinct, seed):
+    rng = random.Random(seed)
+    pool = [random_details(rng) for _ in range(distinct)]
+    return [rng.choice(pool) for _ in range(n)]
+
+
+def timed(fn, corpus):
+    start = time.perf_counter()
+    for s in corpus:
+        fn(s)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=100_000, help="number of details strings to parse")
+    parser.add_argument("--distinct", type=int, default=2000, help="number of distinct strings in the corpus")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.n, args.distinct, args.seed)
+    print(f"🧪 {args.n} details strings ({args.distinct} distinct)")
+
+    # 1. Same output as the original implementation
+    for s in set(corpus):
+        assert parse_shipping_details(s) == legacy_parse_shipping_details(s), s
+    print("✅ Output identical to the original parser")
+
+    # 2. Timings
+    uncached = shipping_parser._parse_normalized.__wrapped__
+    compiled_only = lambda s: uncached(shipping_parser.normalize_details(s))
+
+    legacy_t = timed(legacy_parse_shipping_details, corpus)
+    compiled_t = timed(compiled_only, corpus)
+    shipping_parser._parse_normalized.cache_clear()
+    cached_t = timed(parse_shipping_details, corpus)
+
+    print(f"   - Original:            {legacy_t:8.3f}s")
+    print(f"   - Compiled (no cache): {compiled_t:8.3f}s  ({legacy_t / compiled_t:5.1f}x)")
+    print(f"   - Compiled + LRU:      {cached_t:8.3f}s  ({legacy_t / cached_t:5.1f}x)")
+    print(f"   - {shipping_parser._parse_normalized.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Benchmark suite for the db_refresh.py pipeline on synthetic workbooks (benchmarks/synthetic_data.py).
+
+Times, per scale: workbook load (openpyxl and cached), parse_shipping_details, the stock tally,
+recalculate_inventory_stats, the tracking merge, the single-pass aggregation and a full
+init_db write (mongomock by default, or a real mongod with --mongo-uri). With --mongo-uri, explain()
+confirms the hot queries (customer / shipment / order lookups, the sorted export) use indexes.
+Every run is appended to benchmarks/results/refresh.jsonl and compared with the previous
+run at the same scale, so regressions show up as a ratio > 1.
+
+Usage:
+    python benchmarks/bench_refresh.py [--scales 1,10,100] [--mongo-uri mongodb://localhost:27017]
+                                       [--repeat 3] [--no-record]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db_refresh
+import excel_cache
+import shipping_parser
+from aggregation import aggregate, tally_stock_counts, TrackingJoin
+from synthetic_data import generate
+
+RESULTS_FILE = os.path.join(ROOT, "benchmarks", "results", "refresh.jsonl")
+
+# The queries the scripts run per row / per export; each should be answered from an index
+HOT_QUERIES = {
+    'customers by (phone, name)': lambda db: db.customers.find({'phone': '13615826555', 'name': '徐双双'}),
+    'shipment by tracking_number': lambda db: db.outgoing_shipments.find({'tracking_number': 'ZB899000001CA'}),
+    'purchase order by order_id': lambda db: db.purchase_orders.find({'order_id': '#11600000'}),
+    'incoming orders by order_id': lambda db: db.incoming_orders.find({'order_id': '#11600000'}),
+    'purchase orders sorted by date': lambda db: db.purchase_orders.find({}, {'_id': 0}).sort("date", -1),
+}
+
+
+def best_of(fn, repeat):
+    """ Best wall time of 'repeat' calls (seconds), and the last result. """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def quiet(fn):
+    """ Runs fn with the pipeline's progress prints swallowed. """
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn()
+    return run
+
+
+def open_db(mongo_uri, name):
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+        client.drop_database(name)
+        return client[name], f"mongod ({mongo_uri})"
+    try:
+        import mongomock
+    except ImportError:
+        return None, "skipped (pip install mongomock, or pass --mongo-uri)"
+    return mongomock.MongoClient()[name], "mongomock"
+
+
+def bench_scale(scale, work_dir, repeat, mongo_uri, seed):
+    """ Returns: (rows per workbook, { phase: seconds }, db backend) """
+    # 1. Point the refresh at the synthetic workbooks (and a private Excel cache)
+    paths = generate(work_dir, scale, seed)
+    for name in db_refresh.WORKBOOKS:
+        db_refresh.WORKBOOKS[name] = paths[name]
+    excel_cache.CACHE_DIR = os.path.join(work_dir, ".cache")
+
+    timings = {}
+    timings['load_openpyxl'], data = best_of(quiet(lambda: db_refresh.load_workbooks(use_cache=False)), 1)
+    quiet(lambda: db_refresh.load_workbooks(use_cache=True))()  # fill the cache
+    timings['load_cached'], data = best_of(quiet(lambda: db_refresh.load_workbooks(use_cache=True)), repeat)
+    rows = {name: len(records) for name, records in data.items()}
+
+    # 2. Analytics
+    details = [ship['details'] for ship in data['shipping']]
+
+    def parse_all():
+        shipping_parser._parse_normalized.cache_clear()
+        return [shipping_parser.parse_shipping_details(s) for s in details]
+
+    timings['parse_shipping_details'], _ = best_of(parse_all, repeat)
+    timings['stock_tally'], stock_counts = best_of(lambda: tally_stock_counts(data['purchase_orders']), repeat)
+    timings['recalculate_inventory_stats'], _ = best_of(
+        lambda: db_refresh.recalculate_inventory_stats(data['shipping'], data['inventory_stats'],
+                                                       data['products'], stock_counts), repeat)
+    timings['tracking_merge'], _ = best_of(
+        lambda: aggregate([TrackingJoin()], incoming_orders=data['incoming_orders'],
+                          purchase_orders=data['purchase_orders']), repeat)
+    timings['aggregate_all'], _ = best_of(quiet(lambda: db_refresh.aggregate_all(data)), repeat)
+
+    # 3. Full refresh into MongoDB (write stage alone, then end to end)
+    db, backend = open_db(mongo_uri, "bench_refresh")
+    if db is not None:
+        def write_only():
+            pipeline = db_refresh.RefreshPipeline(use_cache=True)
+            quiet(pipeline.join)()
+            start = time.perf_counter()
+            quiet(lambda: pipeline.write(db=db))()
+            return time.perf_counter() - start
+
+        timings['write'] = min(write_only() for _ in range(repeat))
+        timings['init_db'], _ = best_of(quiet(lambda: db_refresh.RefreshPipeline(use_cache=True).write(db=db)),
+                                        repeat)
+        if mongo_uri:
+            # 4. The hot queries must use the indexes created by the refresh (mongomock has no planner)
+            print(f"\n🔎 Query plans at x{scale:g}:")
+            check_indexes(db)
+            db.client.drop_database(db.name)
+
+    return rows, timings, backend
+
+
+def plan_stages(plan):
+    """ All stage names of an explain() winning plan, outermost first. """
+    stages = [plan.get('stage')]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages += plan_stages(child)
+    return [s for s in stages if s]
+
+
+def check_indexes(db):
+    """ explain() every hot query. Returns: { query: [plan stages] }, printing a ✅/❌ per query. """
+    plans = {}
+    for label, query in HOT_QUERIES.items():
+        winning = query(db).explain()['queryPlanner']['winningPlan']
+        # Newer servers wrap the classic plan in 'queryPlan'
+        stages = plan_stages(winning.get('queryPlan', winning))
+        plans[label] = stages
+        uses_index = 'IXSCAN' in stages and 'COLLSCAN' not in stages and 'SORT' not in stages
+        print(f"   {'✅' if uses_index else '❌'} {label}: {' <- '.join(stages)}")
+    return plans
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_run(scale, backend):
+    """ Last recorded run with the same scale and database backend, if any. """
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    last = None
+    with open(RESULTS_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['scale'] == scale and record['db'] == backend:
+                last = record
+    return last
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1,10", help="comma-separated multiples of today's volume")
+    parser.add_argument("--repeat", type=int, default=3, help="report the best of N runs per phase")
+    parser.add_argument("--mongo-uri", help="benchmark writes against this mongod (default: mongomock)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-record", action="store_true", help=f"do not append to {os.path.relpath(RESULTS_FILE, ROOT)}")
+    args = parser.parse_args()
+
+    scales = [float(s) for s in args.scales.split(",") if s.strip()]
+    commit = git_commit()
+
+    for scale in scales:
+        with tempfile.TemporaryDirectory(prefix="bench_refresh_") as work_dir:
+            rows, timings, backend = bench_scale(scale, work_dir, args.repeat, args.mongo_uri, args.seed)
+
+        print(f"\n🧪 Scale x{scale:g}: " + ", ".join(f"{name} {n}" for name, n in rows.items()))
+        print(f"   db: {backend}")
+        previous = previous_run(scale, backend)
+        for phase, seconds in timings.items():
+            line = f"   - {phase:<28} {seconds * 1000:10.1f} ms"
+            if previous and phase in previous['timings']:
+                line += f"   ({seconds / previous['timings'][phase]:5.2f}x vs {previous.get('commit') or 'last run'})"
+            print(line)
+
+        if not args.no_record:
+            record = {
+                'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'commit': commit,
+                'python': platform.python_version(),
+                'scale': scale,
+                'db': backend,
+                'rows': rows,
+                'timings': {phase: round(seconds, 6) for phase, seconds in timings.items()},
+            }
+            os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+            with open(RESULTS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    if not args.no_record:
+        print(f"\n📝 Results appended to {os.path.relpath(RESULTS_FILE, ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Load benchmark: update_shipping.scrape_many against the local JunAn stub (benchmarks/junan_stub.py).
+
+Reports throughput, p50/p99 latency (per tracking number, including rate-limiter waits and
+retries, and per HTTP request) and how errors were handled. No request leaves the machine.
+
+Usage:
+    python benchmarks/bench_scraper.py [--n 1000] [--rate 200] [--in-flight 16]
+                                       [--latency-ms 80] [--jitter-ms 40] [--error-rate 0.02]
+                                       [--server-rate-limit 0] [--url http://host:port/tracking]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import update_shipping
+from junan_stub import UNKNOWN_PREFIX, start_server
+
+
+def make_targets(n, seed, unknown_rate=0.01):
+    """ Synthetic (tracking_number, phone) pairs; a few use the prefix the stub does not know. """
+    rng = random.Random(seed)
+    targets = []
+    for i in range(n):
+        prefix = UNKNOWN_PREFIX if rng.random() < unknown_rate else "ZB"
+        targets.append((f"{prefix}{rng.randint(10 ** 9, 10 ** 10 - 1)}{i % 100:02d}VA",
+                        f"1{rng.randint(3, 9)}{rng.randint(10 ** 8, 10 ** 9 - 1)}"))
+    return targets
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def classify(status):
+    if status == "Update Failed":
+        return "update failed"
+    if status.startswith("Connection Failed"):
+        return status.lower()
+    if status == "Check Website (No Data)":
+        return "no data"
+    return "ok"
+
+
+def run(targets, rate, in_flight):
+    """ Returns: (elapsed seconds, per-target latencies, per-request latencies, outcome counts) """
+    target_latency = []
+    request_latency = []
+    lock = threading.Lock()
+
+    # Time every tracking number end to end (scrape_many looks the function up at call time)
+    original = update_shipping.scrape_junan_status
+
+    def timed_scrape(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            with lock:
+                target_latency.append(time.perf_counter() - start)
+
+    session = update_shipping.make_session(in_flight)
+    session.hooks['response'].append(lambda r, *a, **kw: request_latency.append(r.elapsed.total_seconds()))
+
+    outcomes = Counter()
+    update_shipping.scrape_junan_status = timed_scrape
+    try:
+        start = time.perf_counter()
+        for _, status in update_shipping.scrape_many(targets, rate=rate, max_in_flight=in_flight, session=session):
+            outcomes[classify(status)] += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        update_shipping.scrape_junan_status = original
+        session.close()
+
+    return elapsed, target_latency, request_latency, outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=1000, help="synthetic tracking numbers (1k-50k)")
+    parser.add_argument("--rate", type=float, default=200, help="scraper token-bucket rate (req/s)")
+    parser.add_argument("--in-flight", type=int, default=16, help="scraper max concurrent requests")
+    parser.add_argument("--backoff-base", type=float, default=0.05, help="scraper retry backoff base (s)")
+    parser.add_argument("--latency-ms", type=float, default=80)
+    parser.add_argument("--jitter-ms", type=float, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--server-rate-limit", type=float, default=0, help="stub answers 429 above this (0 = off)")
+    parser.add_argument("--url", help="use an already running stub instead of starting one")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # 1. Stub server (in-process unless --url is given)
+    config = None
+    if args.url:
+        url = args.url
+    else:
+        server, config, url = start_server(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                           error_rate=args.error_rate, rate_limit=args.server_rate_limit,
+                                           seed=args.seed)
+    update_shipping.JUNAN_URL = url
+    update_shipping.SCRAPER_BACKOFF_BASE = args.backoff_base
+
+    targets = make_targets(args.n, args.seed)
+    print(f"🧪 {args.n} tracking numbers -> {url}")
+    print(f"   scraper: {args.rate:g} req/s, {args.in_flight} in flight, "
+          f"{update_shipping.SCRAPER_MAX_RETRIES} retries (backoff base {args.backoff_base:g}s)")
+    if config:
+        limit = f"rate limit {args.server_rate_limit:g} req/s" if args.server_rate_limit else "no rate limit"
+        print(f"   stub:    {args.latency_ms:g}±{args.jitter_ms:g} ms, {args.error_rate:.0%} errors, {limit}")
+
+    # 2. Scrape
+    elapsed, target_latency, request_latency, outcomes = run(targets, args.rate, args.in_flight)
+
+    # 3. Report
+    print(f"✅ {args.n} tracking numbers in {elapsed:.2f}s  ->  {args.n / elapsed:.1f} tracking numbers/s")
+    print(f"   - Per tracking number: p50 {percentile(target_latency, 50) * 1000:7.1f} ms   "
+          f"p99 {percentile(target_latency, 99) * 1000:7.1f} ms")
+    print(f"   - Per HTTP request:    p50 {percentile(request_latency, 50) * 1000:7.1f} ms   "
+          f"p99 {percentile(request_latency, 99) * 1000:7.1f} ms   ({len(request_latency)} requests, "
+          f"{len(request_latency) - args.n} retries)")
+    print(f"   - Outcomes: {dict(outcomes)}")
+    if config:
+        print(f"   - Stub saw: {config.counts}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
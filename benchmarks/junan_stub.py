@@ -0,0 +1,158 @@
+"""
+Local stand-in for the JunAn tracking endpoint (POST t=query_code&code=...&mobile=...).
+
+Answers in the same {"success": ..., "message": [...]} shape the scraper parses, with
+configurable latency, 5xx error rate and a server-side rate limit (429 above it).
+
+Usage:
+    python benchmarks/junan_stub.py [--port 8765] [--latency-ms 80] [--jitter-ms 40]
+                                    [--error-rate 0.02] [--rate-limit 0]
+    JUNAN_TRACKING_URL=http://127.0.0.1:8765/tracking python update_shipping.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Status history a parcel walks through (newest entry is message[0]; its last key is the status)
+STATUS_STEPS = [
+    "已揽收",
+    "运输中",
+    "已到达【上海转运中心】",
+    "派送中",
+    "已签收，签收人：本人",
+]
+# Tracking numbers starting with this prefix are "unknown" to the stub (success: false)
+UNKNOWN_PREFIX = "NX"
+
+
+class StubConfig:
+    def __init__(self, latency_ms=80, jitter_ms=40, error_rate=0.02, rate_limit=0, seed=None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+
+        # Server-side token bucket (rate_limit <= 0 disables it)
+        self.tokens = float(max(1, rate_limit))
+        self.updated = time.monotonic()
+
+        # Counters, read by the benchmark
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, '200': 0, '404': 0, '429': 0, '503': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def allow(self):
+        """ Non-blocking token bucket: False means answer 429. """
+        if self.rate_limit <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def draw(self):
+        """ Returns: (delay in seconds, should fail) """
+        with self.lock:
+            delay = max(0.0, self.rng.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            return delay, self.rng.random() < self.error_rate
+
+
+def tracking_history(code):
+    """ Deterministic history for a tracking number, newest first. """
+    step = int(hashlib.md5(code.encode()).hexdigest(), 16) % len(STATUS_STEPS)
+    return [{"time": f"2025-01-{10 + i:02d} 10:00:00", STATUS_STEPS[i]: ""} for i in range(step, -1, -1)]
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real site
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, code, body, content_type='application/json; charset=utf-8'):
+            data = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            form = parse_qs(self.rfile.read(length).decode('utf-8'))
+            config.count('requests')
+
+            if not self.path.startswith('/tracking') or form.get('t', [''])[0] != 'query_code':
+                config.count('404')
+                return self.send_body(404, "not found", 'text/plain')
+
+            if not config.allow():
+                config.count('429')
+                return self.send_body(429, "too many requests", 'text/plain')
+
+            delay, fail = config.draw()
+            time.sleep(delay)
+            if fail:
+                config.count('503')
+                return self.send_body(503, "service unavailable", 'text/plain')
+
+            code = form.get('code', [''])[0]
+            if not code or code.startswith(UNKNOWN_PREFIX):
+                payload = {"success": False, "message": "查询不到该单号"}
+            else:
+                payload = {"success": True, "message": tracking_history(code)}
+            config.count('200')
+            self.send_body(200, json.dumps(payload, ensure_ascii=False))
+
+    return Handler
+
+
+def start_server(host='127.0.0.1', port=0, **options):
+    """
+    Serves the stub on a background thread (port=0 picks a free port).
+    Returns: (server, config, url)
+    """
+    config = StubConfig(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, config, f"http://{host}:{server.server_address[1]}/tracking"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=80, help="mean response latency")
+    parser.add_argument("--jitter-ms", type=float, default=40, help="latency standard deviation")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="fraction of requests answered with 503")
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests/s before answering 429 (0 = off)")
+    args = parser.parse_args()
+
+    server, config, url = start_server(args.host, args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                       error_rate=args.error_rate, rate_limit=args.rate_limit)
+    print(f"🛰️ JunAn stub listening on {url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"📊 {config.counts}")
+
+
+if __name__ == "__main__":
+    main()
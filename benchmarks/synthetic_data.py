@@ -0,0 +1,185 @@
+"""
+Synthetic workbooks for load-testing db_refresh.py at N times today's volume.
+
+Writes products / purchase_orders / shipping / incoming_orders / inventory_stats workbooks
+with the same columns and value shapes as data/*.xlsx:
+  - purchase orders: 'items' lists (incl. "(Gift Box)" names, returns with qty < 0),
+    signed / unsigned / return notes
+  - shipping: Chinese 'details' strings with groups in parentheses and multipliers
+  - incoming orders: UPS / FedEx tracking numbers joined to purchase order ids
+The product catalog and stats template are taken from the real workbooks in data/.
+
+Usage:
+    python benchmarks/synthetic_data.py --scale 10 --out /tmp/synthetic_x10 [--seed 42]
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd
+
+from bench_parse_shipping import random_details
+
+# Row counts of today's workbooks (scale 1)
+BASE_ROWS = {
+    'purchase_orders': 58,
+    'shipping': 63,
+    'incoming_orders': 103,
+}
+
+# Same file names as db_refresh.WORKBOOKS
+FILE_NAMES = {
+    'products': "products_data.xlsx",
+    'incoming_orders': "incoming_orders_data.xlsx",
+    'shipping': "shipping_data.xlsx",
+    'inventory_stats': "inventory_stats_data.xlsx",
+    'purchase_orders': "purchase_orders_data.xlsx",
+}
+
+SOURCES = ["Stanley1913", "Stanley1913", "LoveShackFancy", "Bloomingdales"]
+PO_NOTES = ["Gokou-已发货and已签收"] * 6 + ["CJ-已发货and已签收", "Gokou-已发货and未签收", "Gokou-已发货and未签收"]
+SHIPPING_NOTES = ["", "", "", "", "", "", "直邮要盒子(原盒发出)", "直邮，不要包装"]
+SURNAMES = "陈徐王李张刘杨赵黄周吴孙朱马胡郭林何高罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘蒋蔡余杜叶程苏魏吕丁任沈姚卢"
+GIVEN = "文云双晶欣悦月冬梦雨健婉茹琳晨嬴韬伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英"
+CITIES = ["秀洲区龙湖春江华庭{n}号楼{r}", "广东省广州市天河区凤凰街道{n}号{r}房", "上海市浦东新区张江路{n}弄{r}室",
+          "浙江省杭州市西湖区文三路{n}号{r}", "江苏省南京市鼓楼区中山路{n}号{r}"]
+JUNAN_STATUSES = ["包裹已预报", "包裹已预报", "运输中", "已到达【上海转运中心】", "派送中", "已签收，签收人：本人"]
+
+
+def load_catalog():
+    """ Real product catalog + stats template from data/. """
+    products = pd.read_excel(os.path.join(ROOT, "data", FILE_NAMES['products']))
+    stats = pd.read_excel(os.path.join(ROOT, "data", FILE_NAMES['inventory_stats']))
+    return products, stats
+
+
+def make_customers(rng, n):
+    customers = []
+    for _ in range(n):
+        name = rng.choice(SURNAMES) + "".join(rng.choice(GIVEN) for _ in range(rng.randint(1, 2)))
+        phone = int(f"1{rng.choice('3578')}{rng.randint(10 ** 8, 10 ** 9 - 1)}")
+        address = rng.choice(CITIES).format(n=rng.randint(1, 300), r=rng.randint(101, 2505))
+        customers.append((name, phone, address))
+    # Family members sharing a phone get separate profiles
+    for i in range(0, n - 1, 25):
+        customers[i + 1] = (customers[i + 1][0], customers[i][1], customers[i][2])
+    return customers
+
+
+def make_purchase_orders(rng, n, products, start):
+    names = products['name'].tolist()
+    images = dict(zip(products['name'], products['image']))
+    rows = []
+    for i in range(n):
+        is_return = rng.random() < 0.03
+        items = []
+        for name in rng.sample(names, rng.randint(1, 3)):
+            qty = rng.randint(1, 6) * (-1 if is_return else 1)
+            product = name + " (Gift Box)" if rng.random() < 0.05 else name
+            items.append({'product': product, 'qty': qty, 'image': images[name]})
+        rows.append({
+            'source': rng.choice(SOURCES),
+            'order_id': f"#{11600000 + i * 7 + rng.randint(0, 6)}",
+            'date': (start + timedelta(days=rng.randint(0, 120))).isoformat(),
+            'note': "退货" if is_return else rng.choice(PO_NOTES),
+            'items': repr(items),
+        })
+    return pd.DataFrame(rows)
+
+
+def make_shipping(rng, n, customers, start):
+    rows = []
+    for i in range(n):
+        name, phone, address = rng.choice(customers)
+        weight = round(rng.uniform(1, 12) * 2) / 2
+        rows.append({
+            'tracking_number': f"ZB{899000000 + i:09d}{rng.choice(['CA', 'IA', 'VA'])}",
+            'recipient': name,
+            'status': rng.choice(JUNAN_STATUSES),
+            'date': pd.Timestamp(start + timedelta(days=rng.randint(0, 120))),
+            'details': random_details(rng),
+            'weight': weight,
+            'fee': int(weight * 4),
+            'phone': phone,
+            'address': address,
+            'note': rng.choice(SHIPPING_NOTES),
+        })
+    # A few re-entered rows (the refresh skips duplicate tracking numbers)
+    for _ in range(max(1, n // 200)):
+        rows.append(dict(rng.choice(rows)))
+    return pd.DataFrame(rows)
+
+
+def make_incoming_orders(rng, n, purchase_orders):
+    order_ids = purchase_orders['order_id'].tolist()
+    sources = dict(zip(purchase_orders['order_id'], purchase_orders['source']))
+    rows = []
+    for i in range(n):
+        order_id = rng.choice(order_ids)
+        if rng.random() < 0.3:
+            tracking = f"1Z{rng.randint(10 ** 15, 10 ** 16 - 1)}"
+        else:
+            tracking = f"6129036042762{rng.randint(10 ** 6, 10 ** 7 - 1)}"
+        # Some rows carry no URL, or the bare tracking number (rebuilt by the refresh)
+        tracking_url = rng.choice(["", tracking, f"https://www.fedex.com/fedextrack/?trknbr={tracking}"])
+        rows.append({
+            'source': sources[order_id],
+            'order_id': order_id,
+            'status': "Fulfilled",
+            'tracking': tracking if rng.random() > 0.02 else "——",
+            'tracking_url': tracking_url,
+            'signed': "Yes" if rng.random() < 0.87 else "No",
+            'est_date': "——",
+        })
+    return pd.DataFrame(rows)
+
+
+def generate(out_dir, scale=1.0, seed=42):
+    """
+    Writes the five workbooks into out_dir.
+    Returns: { workbook name: path }
+    """
+    rng = random.Random(seed)
+    start = date(2025, 11, 1)
+    rows = {name: max(1, int(count * scale)) for name, count in BASE_ROWS.items()}
+
+    products, stats = load_catalog()
+    purchase_orders = make_purchase_orders(rng, rows['purchase_orders'], products, start)
+    customers = make_customers(rng, max(10, rows['shipping'] // 3))
+
+    frames = {
+        'products': products,
+        'inventory_stats': stats,
+        'purchase_orders': purchase_orders,
+        'shipping': make_shipping(rng, rows['shipping'], customers, start),
+        'incoming_orders': make_incoming_orders(rng, rows['incoming_orders'], purchase_orders),
+    }
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for name, df in frames.items():
+        paths[name] = os.path.join(out_dir, FILE_NAMES[name])
+        df.to_excel(paths[name], index=False)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=10, help="multiple of today's row counts")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    paths = generate(args.out, args.scale, args.seed)
+    for name, path in paths.items():
+        print(f"📄 {path}: {len(pd.read_excel(path))} rows")
+
+
+if __name__ == "__main__":
+    main()
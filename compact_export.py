@@ -0,0 +1,179 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from aggregation import get_junan_tracking_url, get_tracking_url
+
+# ==========================================
+# COMPACT EXPORT (data/<name>.min.json + .gz / .br)
+# ==========================================
+# Minified sibling of an export, with a versioned schema header first:
+#   {"schema":{"name":"shipping","version":1,"derived":["tracking_url"]},"data":[...]}
+# Fields listed in "derived" are dropped when they equal what the dashboard rebuilds
+# (js/app.js, expandCompact); hand-entered values that differ are kept as they are.
+# The .gz (and .br, if the brotli package is installed) siblings are for servers that serve
+# precompressed files (nginx gzip_static / brotli_static); their content is the same .min.json.
+
+SCHEMA_VERSION = 1
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def compact_path(path):
+    """ data/shipping.json -> data/shipping.min.json """
+    root, ext = os.path.splitext(path)
+    return f"{root}.min{ext}"
+
+
+def remove_compact(path):
+    """
+    Deletes the compact siblings of 'path' (.min.json, .gz, .br). The dashboard prefers the .min.json,
+    so one left behind by an earlier --compact export would hide every later plain export.
+    Returns: True if anything was removed
+    """
+    removed = False
+    for target in (compact_path(path), compact_path(path) + '.gz', compact_path(path) + '.br'):
+        if os.path.exists(target):
+            os.remove(target)
+            removed = True
+    return removed
+
+
+def _pop_if(doc, field, expected):
+    if field in doc and doc[field] == expected:
+        del doc[field]
+
+
+def _elide_shipment(doc):
+    phone = doc.get('phone')
+    # The dashboard can only rebuild the URL from a phone that prints the same in JS
+    if isinstance(phone, str) and phone or isinstance(phone, int) and not isinstance(phone, bool):
+        _pop_if(doc, 'tracking_url', get_junan_tracking_url(doc.get('tracking_number'), phone))
+
+
+def _elide_incoming_order(doc):
+    if isinstance(doc.get('tracking'), str):
+        _pop_if(doc, 'tracking_url', get_tracking_url(doc['tracking']))
+
+
+def _elide_purchase_order(doc):
+    for shipment in doc.get('shipments') or []:
+        if isinstance(shipment.get('tracking_number'), str):
+            _pop_if(shipment, 'tracking_url', get_tracking_url(shipment['tracking_number']))
+
+
+# schema name: (derived fields, elision applied to a copy of each document)
+SCHEMAS = {
+    'shipping': (['tracking_url'], _elide_shipment),
+    'orders': (['tracking_url'], _elide_incoming_order),
+    'purchase_orders': (['shipments.tracking_url'], _elide_purchase_order),
+}
+
+
+def _copy(doc):
+    """ Copy deep enough for the elisions (top level + nested shipments). """
+    doc = dict(doc)
+    if isinstance(doc.get('shipments'), list):
+        doc['shipments'] = [dict(s) if isinstance(s, dict) else s for s in doc['shipments']]
+    return doc
+
+
+class CompactWriter:
+    """
+    Streams documents into <path>.min.json (+ .gz / .br) next to the full export.
+    Nothing replaces the published files until publish(); abort() removes the temp files.
+    """
+
+    def __init__(self, path, default=None):
+        self.path = compact_path(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.derived, self.elide = SCHEMAS.get(self.name, ([], None))
+        self.default = default
+        self.count = 0
+        self.digest = hashlib.sha256()
+
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        self.targets = [self.path, self.path + '.gz'] + ([self.path + '.br'] if brotli else [])
+        self.tmp_paths = [target + suffix for target in self.targets]
+        self.raw = open(self.tmp_paths[0], 'wb')
+        # mtime=0 and no file name keep the .gz bytes stable across runs
+        self.gz_file = open(self.tmp_paths[1], 'wb')
+        self.gz = gzip.GzipFile(filename='', mode='wb', fileobj=self.gz_file, mtime=0, compresslevel=9)
+        self.br_file = open(self.tmp_paths[2], 'wb') if brotli else None
+        self.br = brotli.Compressor(quality=11) if brotli else None
+
+        header = {'name': self.name, 'version': SCHEMA_VERSION, 'derived': self.derived}
+        self._write('{"schema":' + json.dumps(header, ensure_ascii=False, separators=(',', ':')) + ',"data":[')
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self.digest.update(data)
+        self.raw.write(data)
+        self.gz.write(data)
+        if self.br:
+            self.br_file.write(self.br.process(data))
+
+    def add(self, doc):
+        if self.elide:
+            doc = _copy(doc)
+            self.elide(doc)
+        encoded = json.dumps(doc, ensure_ascii=False, separators=(',', ':'), default=self.default)
+        self._write(("," if self.count else "") + encoded)
+        self.count += 1
+
+    def tee(self, docs):
+        """ Yields 'docs' unchanged, adding each one on the way (one pass over the cursor). """
+        for doc in docs:
+            self.add(doc)
+            yield doc
+
+    def _close(self):
+        self.raw.close()
+        self.gz.close()
+        self.gz_file.close()
+        if self.br:
+            self.br_file.write(self.br.finish())
+            self.br_file.close()
+
+    def abort(self):
+        self._close()
+        for tmp_path in self.tmp_paths:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    def publish(self, previous_digest=None):
+        """
+        Renames the temp files into place, unless the content digest did not change.
+        Returns: (digest, written)
+        """
+        self._write(']}')
+        self._close()
+        digest = self.digest.hexdigest()
+
+        if digest == previous_digest and all(os.path.exists(target) for target in self.targets):
+            for tmp_path in self.tmp_paths:
+                os.remove(tmp_path)
+            return digest, False
+
+        for tmp_path, target in zip(self.tmp_paths, self.targets):
+            os.replace(tmp_path, target)
+        # Written without brotli: a .br left from an earlier run would be stale
+        if not brotli and os.path.exists(self.path + '.br'):
+            os.remove(self.path + '.br')
+        return digest, True
+
+
+def publish_compact(path, docs, default=None, previous_digest=None):
+    """ Writes the compact siblings of 'path' from 'docs'. Returns: (digest, written) """
+    writer = CompactWriter(path, default)
+    try:
+        for doc in docs:
+            writer.add(doc)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.publish(previous_digest)
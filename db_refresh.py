@@ -1,17 +1,27 @@
-from pymongo import MongoClient
-from bson.objectid import ObjectId
-import re
-import sys
+import argparse
+import ast
+import hashlib
 import io
+import json
 import os
-import pandas as pd
-import ast
-from collections import defaultdict
-
-# Fix emoji output on Windows consoles with GBK encoding
-if sys.stdout.encoding and sys.stdout.encoding.lower() in ('gbk', 'gb2312', 'gb18030', 'cp936'):
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
-    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+import re
+import sys
+from datetime import date
+
+# parse_shipping_details, get_tracking_url and format_details are re-exported for older scripts
+from aggregation import (aggregate, StockCounts, ShippedCounts, ProductStats, TrackingJoin, STOCK_NAME_ALIASES,
+                         format_details, get_junan_tracking_url, get_tracking_url)
+from instrumentation import command_listener, count, stage, start_run
+from inventory_ledger import LedgerEvents, refresh_ledger
+from mongo_utils import (BULK_BATCH_SIZE, STAGING_SUFFIX, bulk_write_chunked, create_staging, ensure_indexes,
+                         swap_in, touch_collections)
+from shipping_parser import NAME_MAP, PARSER_VERSION, items_from_details, parse_shipping_details
+from stats_pipeline import ProductStatsMeta, write_product_stats
+from status_store import apply_statuses
+
+# Importing this module has no side effects: nothing is loaded until a stage asks for it.
+# Heavy dependencies (pandas via excel_cache, pymongo) are imported inside the stages
+# that need them, so `from db_refresh import get_tracking_url` stays cheap.
 
 # --- CONFIGURATION ---
 # Load .env file if present (for local development)
@@ -27,232 +37,35 @@ if os.path.exists(_env_path):
 MONGO_URI = os.environ.get("MONGO_URI", "")
 DB_NAME = os.environ.get("MONGO_DB_NAME", "tracking_db")
 
+# Source workbooks (also fingerprinted for --incremental)
+WORKBOOKS = {
+    'products': "data/products_data.xlsx",
+    'incoming_orders': "data/incoming_orders_data.xlsx",
+    'shipping': "data/shipping_data.xlsx",
+    'inventory_stats': "data/inventory_stats_data.xlsx",
+    'purchase_orders': "data/purchase_orders_data.xlsx",
+}
 
-# .fillna("") converts empty cells (floats) to empty strings (""), preventing the crash
-products_data = pd.read_excel("data/products_data.xlsx").fillna("").to_dict(orient='records')
-incoming_orders_data = pd.read_excel("data/incoming_orders_data.xlsx").fillna("").to_dict(orient='records')
-shipping_data_raw = pd.read_excel("data/shipping_data.xlsx").fillna("").to_dict(orient='records')
-inventory_stats_data = pd.read_excel("data/inventory_stats_data.xlsx").fillna("").to_dict(orient='records')
-purchase_orders_raw = pd.read_excel("data/purchase_orders_data.xlsx").fillna("").to_dict(orient='records')
-# Parse 'items' field from string to list
-purchase_orders_data = []
-
-for row in purchase_orders_raw:
-    # If 'items' is a string looking like a list, parse it.
-    if isinstance(row.get('items'), str):
-        try:
-            row['items'] = ast.literal_eval(row['items'])
-        except (ValueError, SyntaxError):
-            print(f"⚠️ Warning: Could not parse items for Order {row.get('order_id')}")
-            row['items'] = []
-    purchase_orders_data.append(row)
-
-
-# ==========================================
-# 2. LOGIC: CALCULATE STOCK & SHIPPED AUTOMATICALLY
-# ==========================================
-
-print("🔄 Recalculating Total Stock from Purchase Orders...")
-
-# A. Tally up all purchase orders
-# Structure: { "Product Name": { "total": 0, "signed": 0, "unsigned": 0 } }
-stock_counts = {}
-
-for order in purchase_orders_data:
-    # 1. Determine if this order is "Signed" (Secured/Shipped) based on Note
-    note = order.get('note', '')
-
-    # LOGIC: If note contains "已发货" OR "已签收" -> Signed. Otherwise -> Unsigned.
-    is_signed = "已发货" in note and "已签收" in note
-
-    for item in order['items']:
-        p_name = item['product'].replace(" (Gift Box)", "")
-        qty = item['qty']
-
-        # Normalize names to match products_data keys
-        if p_name == "Flip Straw Tumbler 30 OZ Rose Quartz": p_name = "The IceFlow™ Flip Straw Tumbler 30 OZ Rose Quartz"
-
-        # Initialize if not exists
-        if p_name not in stock_counts:
-            stock_counts[p_name] = {'total': 0, 'signed': 0, 'unsigned': 0}
-
-        # Add Totals
-        stock_counts[p_name]['total'] += qty
-
-        if qty < 0:
-            # It is a return.
-            # Returns should reduce the 'Signed' (On Hand) stock, NOT 'Unsigned'.
-            stock_counts[p_name]['signed'] += qty
-        else:
-            # It is a purchase (Positive Qty). Use standard logic.
-            if is_signed:
-                stock_counts[p_name]['signed'] += qty
-            else:
-                stock_counts[p_name]['unsigned'] += qty
-
-
-# B. Calculate Shipped from Shipping Data (Outgoing)
-def parse_shipping_details(details_str):
-    """
-    Parses a shipping details string and extracts product items, quantities, and packaging status.
-    Returns: A list of tuples: (product_name, qty, is_packaged_bool)
-    """
-    items = []
-    # 1. Standardize string format
-    # Replace x/X with *, standardize brackets, remove spaces
-    s = details_str.replace("x", "*").replace("X", "*").replace("（", "(").replace("）", ")").replace(" ", "")
-
-    # 2. Product Name Mapping
-    # Maps keywords to the canonical Product Name in your database
-    name_map = {
-        # 20oz Blue
-        "20oz蓝": "蓝底 20oz", "蓝20oz": "蓝底 20oz", "蓝底20oz": "蓝底 20oz",
-        # 40oz Blue
-        "40oz蓝": "蓝底 40oz", "蓝40oz": "蓝底 40oz", "蓝底40oz": "蓝底 40oz", "40蓝": "蓝底 40oz",
-        # 30oz Blue
-        "30oz蓝": "蓝底 30oz", "蓝30oz": "蓝底 30oz", "蓝底30oz": "蓝底 30oz",
-        # 20oz White
-        "20oz白": "白底 20oz", "白20oz": "白底 20oz", "白底20oz": "白底 20oz",
-        "30oz白": "白底 30oz", "白30oz": "白底 30oz", "白底30oz": "白底 30oz",
-        # 40oz White
-        "40oz白": "白底 40oz", "白40oz": "白底 40oz", "白底40oz": "白底 40oz", "40白": "白底 40oz",
-        # 20oz pink
-        "20oz粉": "粉底 20oz", "粉20oz": "粉底 20oz", "粉底20oz": "粉底 20oz",
-        "40oz粉": "粉底 40oz", "粉40oz": "粉底 40oz", "粉底40oz": "粉底 40oz", "40粉": "粉底 40oz",
-        # Slim Bottle
-        "SlimBottle": "Slim Bottle", "Slim": "Slim Bottle",  # Spaceless due to earlier replace
-        "礼盒": "礼盒",
-        "HolidayReserveAllDayWineSet": "Holiday Reserve All Day Wine Set",
-        "TheReserveWineTumblerSet|11oz": "The Reserve Wine Tumbler Set | 11 oz",
-        "Everyday Camp Mug Set": "Everyday Camp Mug Set", "EverydayCampMugSet": "Everyday Camp Mug Set",
-        "Holiday The Quencher Details ProTour Tumbler Set": "Holiday The Quencher Details ProTour Tumbler Set",
-        "HolidayTheQuencherDetailsProTourTumblerSet": "Holiday The Quencher Details ProTour Tumbler Set",
-        "Coquette Bow Chantilly 20oz": "Coquette Bow Chantilly 20oz", "CoquetteBowChantilly20oz": "Coquette Bow Chantilly 20oz",
-        "情人节款20oz": "情人节款20oz", "情人节款30oz": "情人节款30oz", "情人节款40oz": "情人节款40oz",
-        "情人节款红色20oz": "情人节款红色20oz", "情人节款红色30oz": "情人节款红色30oz", "情人节款红色40oz": "情人节款红色40oz",
-    }
-
-    # 3. Handle Parentheses Groups
-    # We replace '+' inside parentheses with '&' to split safely later
-    temp_s = ""
-    depth = 0
-    for char in s:
-        if char == '(':
-            depth += 1
-        elif char == ')':
-            depth -= 1
-        if char == '+' and depth > 0:
-            temp_s += '&'
-        else:
-            temp_s += char
-
-    parts = temp_s.split('+')
-
-    # 4. Handle Special "Packaging Only" item
-    if "压扁包装" in s:
-        match = re.search(r'(\d+)\*?压扁包装', s)
-        qty = int(match.group(1)) if match else 1
-        items.append(("压扁包装", qty, True))
-
-        # 5. Process each part
-    for part in parts:
-        part = part.strip()
-        if not part: continue
-
-        mult = 1
-        content = part
-
-        # Extract multiplier (e.g., "3*...")
-        if '*' in part:
-            try:
-                m_str, _content = part.split('*', 1)
-                mult = int(m_str)
-                content = _content
-            except:
-                pass
-
-        content = content.replace('&', '+')
-
-        # --- Helper to process a single item string ---
-        def process_single_item(item_str, multiplier):
-            # A. Check for Packaging Keyword
-            is_pkg = "包装" in item_str or "带包装" in item_str
-
-            # B. Clean the string for matching (Remove "包装" so "蓝包装20oz" becomes "蓝20oz")
-            clean_str = item_str.replace("包装", "").replace("带包装", "")
-
-            # C. Match against map
-            matched = False
-            # Sort keys by length desc to match longest first (e.g. avoid matching "Slim" inside "Slim Bottle")
-            sorted_keys = sorted(name_map.keys(), key=len, reverse=True)
-
-            for key in sorted_keys:
-                if key in clean_str:
-                    items.append((name_map[key], multiplier, is_pkg))
-                    matched = True
-                    break
-
-            # Debugging check (Optional)
-            # if not matched and "压扁包装" not in item_str:
-            #    print(f"Warning: Could not identify product in '{item_str}'")
-
-        # Check for groups (...)
-        if '(' in content:
-            match = re.search(r'\((.*?)\)', content)
-            if match:
-                inner = match.group(1)
-                sub_items = inner.split('+')
-                for sub in sub_items:
-                    # Handle inner multiplier if exists (e.g. inside group)
-                    sub_mult = 1
-                    sub_content = sub
-                    if '*' in sub:
-                        try:
-                            sm, sc = sub.split('*', 1)
-                            sub_mult = int(sm)
-                            sub_content = sc
-                        except:
-                            pass
-
-                    final_mult = mult * sub_mult
-                    process_single_item(sub_content, final_mult)
-        else:
-            # Single Item
-            process_single_item(content, mult)
-
-    return items
-
-shipped_counts = {}
-for ship in shipping_data_raw:
-    parsed_items = parse_shipping_details(ship['details'])
-    for (p_name, qty, is_packaged) in parsed_items:  # Fixed unpacking
-        shipped_counts[p_name] = shipped_counts.get(p_name, 0) + qty
-
-# C. Update 'products_data' with Stock, Signed/Unsigned, and Shipped
-for product in products_data:
-    p_name = product['name']
-
-    # 1. Update Purchase Stats (Total, Signed, Unsigned)
-    if p_name in stock_counts:
-        product['total_stock'] = stock_counts[p_name]['total']
-        product['us_signed'] = stock_counts[p_name]['signed']
-        product['us_unsigned'] = stock_counts[p_name]['unsigned']
-
-    # 2. Update Shipped to China Count
-    if p_name in shipped_counts:
-        product['shipped_cn'] = shipped_counts[p_name]
-
-# D. Update 'inventory_stats_data' with Stock
-# Use the NEW recalculate function to auto-update stats
-# ---------------------------------------------------
+# Stable key of each row per collection (used by --incremental to diff rows)
+COLLECTION_KEYS = {
+    'products': ('name',),
+    'incoming_orders': ('order_id', 'tracking'),
+    'product_stats': ('产品名称',),
+    'purchase_orders': ('order_id',),
+    'customers': ('phone', 'name'),
+    'outgoing_shipments': ('tracking_number',),
+}
 
-def format_details(detail_dict):
-    if not detail_dict: return "——"
-    return ", ".join([f"{name}({qty})" for name, qty in detail_dict.items()])
+# Stored with the workbook hashes: the parser / maps changing makes --incremental recompute every row
+CODE_STATE_KEY = "code:parser+maps"
 
+# Set USE_EXCEL_CACHE=0 to always re-parse the workbooks with openpyxl
+USE_EXCEL_CACHE = os.environ.get("USE_EXCEL_CACHE", "1") != "0"
 
-product_image_lookup = {p['name']: p['image'] for p in products_data}
+# Set STATS_PIPELINE=1 (or --stats-pipeline) to build product_stats in MongoDB (see stats_pipeline.py)
+STATS_PIPELINE = os.environ.get("STATS_PIPELINE", "0") == "1"
 
+# Fallback images for products that are not in products_data
 IMAGE_MAP = {
     "压扁包装": "img/s-l1600.png",
     "礼盒": "img/Stanley 1913 x LoveShackFancy Holiday Quencher ProTour Ornament Set.png",
@@ -280,253 +93,352 @@ IMAGE_MAP = {
     # Add any other missing products here
 }
 
+# ==========================================
+# 1. LOAD
+# ==========================================
+
+def parse_purchase_order_items(df):
+    """ Parse 'items' field from string to list. """
+    def parse(items, order_id):
+        # If 'items' is a string looking like a list, parse it.
+        if isinstance(items, str):
+            try:
+                return ast.literal_eval(items)
+            except (ValueError, SyntaxError):
+                print(f"⚠️ Warning: Could not parse items for Order {order_id}")
+                return []
+        return items
 
-def recalculate_inventory_stats(shipping_data_raw, current_inventory_stats):
-    product_metadata = {}
+    if 'items' in df.columns:
+        order_ids = df['order_id'] if 'order_id' in df.columns else [None] * len(df)
+        df['items'] = [parse(items, order_id) for items, order_id in zip(df['items'], order_ids)]
+    return df
 
-    # 1. Pre-populate from existing stats template
-    for stat in current_inventory_stats:
-        product_metadata[stat['产品名称']] = {
-            'image': stat.get('image', 'img/default.png'),
-            'type': stat.get('类型', 'product'),
-            '已发总数': 0, '带包装': 0, '带包装详情': defaultdict(int),
-            '不带包装': 0, '不带包装详情': defaultdict(int)
-        }
 
-    # 2. Iterate through shipping data
-    for ship in shipping_data_raw:
-        recipient = ship['recipient']
-        parsed_items = parse_shipping_details(ship['details'])
-
-        # REMOVED: Global note logic (as per your previous request)
-
-        for p_name, qty, is_packaged in parsed_items:
-            # Init if new (e.g. found in shipping but not in manual stats list)
-            if p_name not in product_metadata:
-                # FIX: Check products_data first!
-                img_path = product_image_lookup.get(p_name)
-
-                # If not in products_data, check IMAGE_MAP
-                if not img_path:
-                    img_path = IMAGE_MAP.get(p_name, 'img/default.png')
-
-                # Determine type
-                p_type = 'product'
-                if "礼盒" in p_name:
-                    p_type = 'accessory'
-                elif "包装" in p_name:
-                    p_type = 'packaging'
-
-                product_metadata[p_name] = {
-                    'image': img_path,
-                    'type': p_type,
-                    '已发总数': 0, '带包装': 0, '带包装详情': defaultdict(int),
-                    '不带包装': 0, '不带包装详情': defaultdict(int)
-                }
-
-            p_data = product_metadata[p_name]
-            p_data['已发总数'] += qty
-
-            # --- STRICT PACKAGING LOGIC ---
-            final_pack = is_packaged
-
-            # Special Case: "Packaging Only" is implicitly "Packaged"
-            if p_name == "压扁包装":
-                final_pack = True
-
-            # Assign to correct column
-            if final_pack:
-                p_data['带包装'] += qty
-                p_data['带包装详情'][recipient] += qty
-            else:
-                p_data['不带包装'] += qty
-                p_data['不带包装详情'][recipient] += qty
+def load_workbooks(use_cache=USE_EXCEL_CACHE):
+    """
+    Reads the five workbooks in data/ as lists of records.
+    Returns: { 'products', 'incoming_orders', 'shipping', 'inventory_stats', 'purchase_orders': [dict] }
+    """
+    from excel_cache import read_workbook
+
+    # .fillna("") converts empty cells (floats) to empty strings (""), preventing the crash
+    # Workbooks are served from data/.cache when their content hash has not changed
+    data = {}
+    for name, path in WORKBOOKS.items():
+        if name == 'purchase_orders':
+            df = read_workbook(path, postprocess=parse_purchase_order_items, tag="items", use_cache=use_cache)
+        else:
+            df = read_workbook(path, use_cache=use_cache)
+        data[name] = df.to_dict(orient='records')
+    return data
 
-    final_stats_list = []
 
-    # Sort
-    sorted_names = sorted(product_metadata.keys(),
-                          key=lambda x: (product_metadata[x]['type'] == 'packaging', -product_metadata[x]['已发总数']))
+# ==========================================
+# 2. NORMALIZE
+# ==========================================
+
+# Leading number of a cell, like JavaScript's parseFloat ("12.5元" -> 12.5)
+NUMBER_PREFIX = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+# Hand-typed dates: "YYYY-MM-DD" / "YYYY/MM/DD" (a day or time may follow) and "MM/DD/YYYY"
+YEAR_FIRST_DATE = re.compile(r'\s*(\d{4})[-/.](\d{1,2})(?!\d)')
+MONTH_FIRST_DATE = re.compile(r'\s*(\d{1,2})/\d{1,2}/(\d{4})')
+
+
+def cell_number(value):
+    """ A numeric cell, or the leading number of a text one; 0 when there is none. """
+    if isinstance(value, bool):
+        return 0
+    if isinstance(value, (int, float)):
+        return value if value == value else 0  # NaN (empty Excel cell)
+    match = NUMBER_PREFIX.match(str(value))
+    return float(match.group(0)) if match else 0
+
+
+def cell_month(value):
+    """ 'YYYY-MM' of a date cell (a date, or text in one of the formats above), else None. """
+    if isinstance(value, date):
+        if value != value:  # NaT (empty Excel date cell)
+            return None
+        return f"{value.year:04d}-{value.month:02d}"
+    text = str(value or '')
+    match = YEAR_FIRST_DATE.match(text)
+    if match:
+        year, month = match.groups()
+    else:
+        match = MONTH_FIRST_DATE.match(text)
+        if not match:
+            return None
+        month, year = match.groups()
+    return f"{year}-{int(month):02d}" if 1 <= int(month) <= 12 else None
 
-    for p_name in sorted_names:
-        p_data = product_metadata[p_name]
 
-        if p_data['已发总数'] <= 0: continue
+def build_customers_and_shipments(shipping_data_raw):
+    """
+    Builds the customer profiles and shipment documents from the shipping sheet.
+    Returns: ({ (phone, name): customer_doc }, [ (customer_key, shipment_doc) ])
+    shipment_doc['customer_id'] is left as None until the customer is resolved in the DB.
+    """
+    customers = {}
+    shipments = []
+    shipment_by_tracking_number = {}
 
-        total_stock = 0
-        if p_name in stock_counts:
-            total_stock = stock_counts[p_name]['total']
-        if p_data['type'] == 'packaging': total_stock = 'N/A'
+    for row, item in enumerate(shipping_data_raw):
+        tracking_num = item['tracking_number']
 
-        final_stats_list.append({
-            "产品名称": p_name,
-            "image": p_data['image'],
-            "已发总数": p_data['已发总数'],
-            "带包装": p_data['带包装'],
-            "带包装详情": format_details(p_data['带包装详情']),
-            "不带包装": p_data['不带包装'],
-            "不带包装详情": format_details(p_data['不带包装详情']),
-            "总库存": total_stock,
-            "类型": p_data['type']
-        })
+        # 1. Skip Duplicate Shipments (their lines are kept for the product stats, which count every row)
+        if tracking_num in shipment_by_tracking_number:
+            print(f"⚠️ Skipping duplicate tracking number: {tracking_num}")
+            shipment_by_tracking_number[tracking_num].setdefault('duplicate_rows', []).append(
+                {'row': row, 'recipient': str(item['recipient']).strip(), 'details': item['details'],
+                 'items': items_from_details(item['details'])})
+            continue
 
-    return final_stats_list
+        # 2. CLEAN DATA (Crucial Step)
+        # Convert to string and strip whitespace to prevent "Alice" and "Alice " being two people
+        raw_phone = str(item['phone']).strip()
+        raw_name = str(item['recipient']).strip()
 
-# Update the variable
-inventory_stats_data = recalculate_inventory_stats(shipping_data_raw, inventory_stats_data)
+        # 3. CUSTOMER IDENTIFICATION (Phone + Name)
+        # Using both ensures family members sharing a phone get separate profiles
+        customer_key = (raw_phone, raw_name)
 
-print("✅ Stock & Shipped counts updated successfully!")
+        if customer_key not in customers:
+            customers[customer_key] = {
+                "name": raw_name,
+                "phone": raw_phone,
+                "address": item['address']  # Address from the first shipment seen for this person
+            }
 
-# ==========================================
-# 3. MERGE TRACKING INFO INTO PURCHASE ORDERS
-# ==========================================
-print("🔗 Merging Tracking IDs into Purchase Orders...")
+        # 4. CREATE SHIPMENT
+        # We allow the shipment to store its own snapshot of the address
+        shipment_data = {
+            "tracking_number": tracking_num,
+            "tracking_url": get_junan_tracking_url(tracking_num, raw_phone),
+            "customer_id": None,
+            "recipient": raw_name,
+            "details": item['details'],
+            # Parsed once here, so readers never need the parser (see shipping_parser.PARSER_VERSION)
+            "items": items_from_details(item['details']),
+            "parser_version": PARSER_VERSION,
+            # Position in the shipping sheet (first-seen order of the product stats)
+            "row": row,
+            # Month / fee / weight as numbers whatever way the cells were typed (summary_shipping_by_month)
+            "billing": {"month": cell_month(item.get('date')), "fee": cell_number(item.get('fee', 0)),
+                        "weight": cell_number(item['weight'])},
+            "weight": item['weight'],
+            "fee": item.get('fee', 0),
+            "status": item['status'],
+            "date": item.get('date', ''),
+            "carrier": "JunAn Express",
+            "address": item['address'],  # Store specific address for this shipment history
+            "note": item.get('note', '')
+        }
+        shipments.append((customer_key, shipment_data))
+        shipment_by_tracking_number[tracking_num] = shipment_data
 
+    return customers, shipments
 
-# 1. Helper function to generate tracking URLs
-def get_tracking_url(tracking_num):
-    if not tracking_num or tracking_num == "——":
-        return ""
-    tracking_num = tracking_num.strip()
-    if tracking_num.upper().startswith("1Z"):
-        return f"https://www.ups.com/track?track=yes&trackNums={tracking_num}"
-    return f"https://www.fedex.com/fedextrack/?trknbr={tracking_num}"
 
+# ==========================================
+# 3. AGGREGATE
+# ==========================================
 
-# 2. Build map
-tracking_map = {}
-for entry in incoming_orders_data:
-    o_id = entry.get('order_id')
-    t_num = entry.get('tracking')
+def recalculate_inventory_stats(shipping_data_raw, current_inventory_stats, products_data=(), stock_counts=None):
+    """ Standalone product_stats rebuild (the refresh pipeline gets it from the single pass). """
+    product_image_lookup = {p['name']: p['image'] for p in products_data}
+    stats = ProductStats(current_inventory_stats, product_image_lookup, IMAGE_MAP, stock_counts or {})
+    return aggregate([stats], shipments=shipping_data_raw)[stats.name]
 
-    if not o_id or not t_num or t_num == "——": continue
 
-    t_url = entry.get('tracking_url', '')
-    if not t_url or t_url == t_num:
-        t_url = get_tracking_url(t_num)
+def aggregate_all(data, stats_pipeline=False):
+    """
+    A. Stock from purchase orders, B. shipped / packaged / per-recipient stats from shipping data,
+    C. tracking numbers joined onto purchase orders, D. inventory ledger events -- every record is read exactly once.
+    Note: sets 'shipments' on each purchase order record in data['purchase_orders'].
+    Returns: { 'stock_counts', 'shipped_counts', 'product_stats', 'tracking_map', 'ledger_events' }
+    With stats_pipeline, 'product_stats_meta' (the input of stats_pipeline.py) replaces 'product_stats'.
+    """
+    product_image_lookup = {p['name']: p['image'] for p in data['products']}
+
+    stock_reducer = StockCounts()
+    stats_reducer = ProductStatsMeta if stats_pipeline else ProductStats
+    reducers = [
+        stock_reducer,
+        ShippedCounts(),
+        stats_reducer(data['inventory_stats'], product_image_lookup, IMAGE_MAP, stock_reducer.counts),
+        TrackingJoin(),
+        LedgerEvents(),
+    ]
+    return aggregate(reducers,
+                     incoming_orders=data['incoming_orders'],
+                     purchase_orders=data['purchase_orders'],
+                     shipments=data['shipping'])
 
-    shipment_info = {
-        "tracking_number": t_num,
-        "tracking_url": t_url,
-        "status": entry.get('status', 'Unknown'),
-        "carrier": "UPS" if t_num.upper().startswith("1Z") else "FedEx",
-        "signed": entry.get('signed', 'No')  # <--- ADD THIS LINE
-    }
 
-    if o_id not in tracking_map: tracking_map[o_id] = []
+# ==========================================
+# 4. JOIN
+# ==========================================
 
-    exists = False
-    for s in tracking_map[o_id]:
-        if s['tracking_number'] == t_num:
-            exists = True
-            break
-    if not exists: tracking_map[o_id].append(shipment_info)
+def apply_counts_to_products(products_data, stock_counts, shipped_counts):
+    """ Update 'products_data' with Stock, Signed/Unsigned, and Shipped (in place). """
+    for product in products_data:
+        p_name = product['name']
 
-# 3. Inject
-for order in purchase_orders_data:
-    o_id = order['order_id']
-    if o_id in tracking_map:
-        order['shipments'] = tracking_map[o_id]
-    else:
-        order['shipments'] = []
+        # 1. Update Purchase Stats (Total, Signed, Unsigned)
+        if p_name in stock_counts:
+            product['total_stock'] = stock_counts[p_name]['total']
+            product['us_signed'] = stock_counts[p_name]['signed']
+            product['us_unsigned'] = stock_counts[p_name]['unsigned']
 
-print("✅ Tracking info merged successfully!")
+        # 2. Update Shipped to China Count
+        if p_name in shipped_counts:
+            product['shipped_cn'] = shipped_counts[p_name]
+    return products_data
 
 
 # ==========================================
-# 4. DB INITIALIZATION
+# 5. WRITE (DB INITIALIZATION)
 # ==========================================
 
-def init_db():
+def connect_db():
+    """ Returns the database handle, or None if the connection failed. """
+    from pymongo import MongoClient
+
     try:
-        client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True)
+        client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True, event_listeners=[command_listener()])
         db = client[DB_NAME]
         print("✅ Connected to MongoDB Atlas!")
+        return db
     except Exception as e:
         print(f"❌ Connection Failed: {e}")
-        return
+        return None
 
-    print("🔄 Resetting Collections...")
-    db.products.drop()
-    db.incoming_orders.drop()
-    db.customers.drop()
-    db.outgoing_shipments.drop()
-    db.product_stats.drop()
-    db.purchase_orders.drop()
 
-    print("📦 Inserting Data...")
-    if products_data: db.products.insert_many(products_data)
+def code_fingerprint():
+    """ sha256 of the code-side inputs of the refresh: PARSER_VERSION, NAME_MAP, STOCK_NAME_ALIASES, IMAGE_MAP. """
+    payload = json.dumps({'parser_version': PARSER_VERSION, 'name_map': NAME_MAP,
+                          'stock_name_aliases': STOCK_NAME_ALIASES, 'image_map': IMAGE_MAP},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-    print(f"🚚 Checking Incoming Orders... found {len(incoming_orders_data)} items.")
-    if incoming_orders_data: db.incoming_orders.insert_many(incoming_orders_data)
 
-    if inventory_stats_data: db.product_stats.insert_many(inventory_stats_data)
-    if purchase_orders_data: db.purchase_orders.insert_many(purchase_orders_data)
+def refresh_incremental(db, collections, fingerprints, workbook_hashes, customer_key_by_tracking,
+                        batch_size=BULK_BATCH_SIZE, dry_run=False):
+    """
+    Writes only new / changed / deleted rows (by fingerprint) as bulk upserts and deletes.
+    Returns False if there is no previous state to diff against (caller should do a full refresh).
+    """
+    from incremental import plan_changes, load_state, save_state
 
-    print("✈️ Processing Customers and Shipments...")
-    customers_map = {}
-    seen_tracking_numbers = set()
+    old_hashes, previous = load_state(db)
+    if old_hashes is None or any(name not in previous for name in collections):
+        print("⚠️ No previous fingerprints found, falling back to a full refresh.")
+        return False
 
-    for item in shipping_data_raw:
-        tracking_num = item['tracking_number']
+    if old_hashes == workbook_hashes:
+        print("✅ No workbook (nor the parser / name maps) changed since the last refresh. Nothing to do.")
+        return True
 
-        # 1. Skip Duplicate Shipments
-        if tracking_num in seen_tracking_numbers:
-            print(f"⚠️ Skipping duplicate tracking number: {tracking_num}")
-            continue
-        seen_tracking_numbers.add(tracking_num)
+    changed_books = [path for path, sha in workbook_hashes.items() if old_hashes.get(path) != sha]
+    print(f"🔍 Changed inputs: {', '.join(changed_books)}")
 
-        # 2. CLEAN DATA (Crucial Step)
-        # Convert to string and strip whitespace to prevent "Alice" and "Alice " being two people
-        raw_phone = str(item['phone']).strip()
-        raw_name = str(item['recipient']).strip()
+    # Customers go first, so new shipments can reference their _id
+    touched = []
+    for name in collections:
+        prepare = None
+        if name == 'outgoing_shipments' and not dry_run:
+            customer_ids = {(c['phone'], c['name']): c['_id'] for c in db.customers.find({}, {'phone': 1, 'name': 1})}
 
-        # 3. CUSTOMER IDENTIFICATION (Phone + Name)
-        # Using both ensures family members sharing a phone get separate profiles
-        customer_key = (raw_phone, raw_name)
+            def prepare(doc):
+                doc['customer_id'] = customer_ids[customer_key_by_tracking[doc['tracking_number']]]
 
-        customer_data = {
-            "name": raw_name,
-            "phone": raw_phone,
-            "address": item['address']  # This stores the LATEST address in the customer profile
-        }
+        ops, counts = plan_changes(fingerprints[name], previous[name], COLLECTION_KEYS[name], prepare)
+        if not dry_run and ops:
+            bulk_write_chunked(db[name], ops, batch_size)
+            touched.append(name)
+        print(f"   - {name}: {counts['new']} new, {counts['changed']} changed, {counts['deleted']} deleted")
+
+    if dry_run:
+        print("\n🧪 Dry run: nothing was written.")
+        return True
+
+    touch_collections(db, touched)
+    save_state(db, workbook_hashes, fingerprints, COLLECTION_KEYS, previous, batch_size)
+    print("\n✅ Incremental Refresh Complete!")
+    return True
+
+
+def write_collections(db, collections, customers, shipments, incremental=False, batch_size=BULK_BATCH_SIZE,
+                      dry_run=False):
+    """ Writes the joined collections to MongoDB (full drop-and-reinsert, or --incremental). """
+    from bson.objectid import ObjectId
+
+    from incremental import file_fingerprint, fingerprint_rows, plan_changes, save_state
+
+    customer_key_by_tracking = {doc['tracking_number']: key for key, doc in shipments}
+
+    # Fingerprint every row BEFORE writing (insert_many adds '_id' to the dicts)
+    fingerprints = {
+        name: fingerprint_rows(docs, COLLECTION_KEYS[name], exclude=('_id', 'customer_id'))
+        for name, docs in collections.items()
+    }
+    workbook_hashes = {path: file_fingerprint(path) for path in WORKBOOKS.values()}
+    # The parser and the name / image maps shape the rows too: a change to them is a change to the inputs
+    workbook_hashes[CODE_STATE_KEY] = code_fingerprint()
+
+    # Statuses scraped by update_shipping.py are newer than the workbook's (applied after
+    # fingerprinting, so a status change alone does not make a row "changed")
+    apply_statuses(db, collections['outgoing_shipments'])
+
+    if incremental:
+        print("🔄 Incremental Refresh...")
+        if not dry_run:
+            ensure_indexes(db, collections)
+        if refresh_incremental(db, collections, fingerprints, workbook_hashes, customer_key_by_tracking,
+                               batch_size, dry_run):
+            return
+
+    if dry_run:
+        print("🧪 Dry run: a full refresh would write")
+        for name, docs in collections.items():
+            print(f"   - {name}: {len(docs)}")
+        return
 
-        # Check if this specific person (Phone + Name) exists
+    # Build every collection in a staging copy (indexes first), then rename them over the live ones:
+    # readers see the old or the new collection, never an empty or half-written one,
+    # and a refresh that dies before the swap leaves the live data as it was.
+    print("🔄 Building Staging Collections...")
+    create_staging(db, collections)
+
+    print("✈️ Processing Customers and Shipments...")
+    # Resolve customers client-side: one read of the existing profiles, new ones get their
+    # ObjectId here, so shipments can reference them without a round trip per row.
+    customers_map = {(c['phone'], c['name']): c['_id'] for c in db.customers.find({}, {'phone': 1, 'name': 1})}
+    for customer_key, customer_data in customers.items():
         if customer_key not in customers_map:
-            existing_customer = db.customers.find_one({
-                "phone": raw_phone,
-                "name": raw_name
-            })
+            customers_map[customer_key] = ObjectId()
+        customer_data['_id'] = customers_map[customer_key]
 
-            if existing_customer:
-                customer_id = existing_customer['_id']
-                # Update address to the most recent one used
-                db.customers.update_one({"_id": customer_id}, {"$set": {"address": item['address']}})
-            else:
-                res = db.customers.insert_one(customer_data)
-                customer_id = res.inserted_id
+    for customer_key, shipment_data in shipments:
+        shipment_data['customer_id'] = customers_map[customer_key]
 
-            customers_map[customer_key] = customer_id
-        else:
-            customer_id = customers_map[customer_key]
+    # Every row is an upsert against its collection key (rows sharing a key are written as a group),
+    # so re-running a refresh that failed halfway never duplicates documents.
+    print(f"📦 Upserting Data... ({len(collections['incoming_orders'])} incoming orders)")
+    round_trips = 0
+    for name in collections:
+        ops, _counts = plan_changes(fingerprints[name], {}, COLLECTION_KEYS[name])
+        round_trips += bulk_write_chunked(db[name + STAGING_SUFFIX], ops, batch_size)
+    print(f"   - {sum(len(docs) for docs in collections.values())} documents in {round_trips} bulk writes")
 
-        # 4. CREATE SHIPMENT
-        # We allow the shipment to store its own snapshot of the address
-        shipment_data = {
-            "tracking_number": tracking_num,
-            "tracking_url": f"https://www.junanex.com/tracking?code={tracking_num}&mobile={raw_phone}",
-            "customer_id": customer_id,
-            "recipient": raw_name,
-            "details": item['details'],
-            "weight": item['weight'],
-            "fee": item.get('fee', 0),
-            "status": item['status'],
-            "date": item.get('date', ''),
-            "carrier": "JunAn Express",
-            "address": item['address'],  # Store specific address for this shipment history
-            "note": item.get('note', '')
-        }
-        db.outgoing_shipments.insert_one(shipment_data)
+    # Each rename is atomic. Customers go first, so new shipments never point at a missing profile.
+    print("🔀 Swapping in the new collections...")
+    swap_in(db, sorted(collections, key=lambda n: n != 'customers'))
+
+    # Remember what was written, so the next --incremental run can diff against it
+    touch_collections(db, collections)
+    save_state(db, workbook_hashes, fingerprints, COLLECTION_KEYS, batch_size=batch_size)
 
     # --- SUMMARY ---
     print("\n✅ Database Reset Complete!")
@@ -537,5 +449,220 @@ def init_db():
     print(f"   - Outgoing Shipments: {db.outgoing_shipments.count_documents({})}")
 
 
+def backfill_shipment_items(db, batch_size=BULK_BATCH_SIZE):
+    """
+    Re-parses 'details' into 'items' on the outgoing_shipments documents stamped with another
+    parser version (or none), e.g. after a NAME_MAP change. Up-to-date documents are not read.
+    Returns: number of documents updated
+    """
+    from pymongo import UpdateOne
+
+    ops = []
+    stale = db.outgoing_shipments.find({'parser_version': {'$ne': PARSER_VERSION}}, {'details': 1, 'duplicate_rows': 1})
+    for doc in stale:
+        update = {'items': items_from_details(str(doc.get('details') or '')), 'parser_version': PARSER_VERSION}
+        if doc.get('duplicate_rows'):
+            update['duplicate_rows'] = [dict(dup, items=items_from_details(str(dup.get('details') or '')))
+                                        for dup in doc['duplicate_rows']]
+        ops.append(UpdateOne({'_id': doc['_id']}, {'$set': update}))
+    bulk_write_chunked(db.outgoing_shipments, ops, batch_size, ordered=False)
+    if ops:
+        touch_collections(db, ['outgoing_shipments'])
+    count(rows=len(ops))
+    return len(ops)
+
+
+# ==========================================
+# PIPELINE: load -> normalize -> aggregate -> join -> write
+# ==========================================
+
+STAGES = ('load', 'normalize', 'aggregate', 'join', 'write')
+
+
+class RefreshPipeline:
+    """
+    Lazily evaluated refresh stages. Each stage runs at most once, the first time it
+    (or a later stage that depends on it) is asked for, and its result is kept.
+    """
+
+    def __init__(self, use_cache=USE_EXCEL_CACHE, stats_pipeline=STATS_PIPELINE):
+        self.use_cache = use_cache
+        self.stats_pipeline = stats_pipeline
+        self._results = {}
+
+    def _stage(self, name, fn, requires=()):
+        if name not in self._results:
+            # Earlier stages run first, outside this one, so every stage is timed on its own
+            for earlier in requires:
+                getattr(self, earlier)()
+            with stage(name):
+                self._results[name] = fn()
+        return self._results[name]
+
+    def load(self):
+        def run():
+            print("📂 Loading Workbooks...")
+            data = load_workbooks(self.use_cache)
+            count(rows=sum(len(rows) for rows in data.values()))
+            return data
+        return self._stage('load', run)
+
+    def normalize(self):
+        """ Returns: { 'customers': { key: doc }, 'shipments': [ (customer_key, doc) ] } """
+        def run():
+            customers, shipments = build_customers_and_shipments(self.load()['shipping'])
+            count(rows=len(shipments))
+            return {'customers': customers, 'shipments': shipments}
+        return self._stage('normalize', run, requires=('load',))
+
+    def aggregate(self):
+        def run():
+            data = self.load()
+            print("🔄 Aggregating Purchase Orders, Shipments & Tracking (single pass)...")
+            results = aggregate_all(data, self.stats_pipeline)
+            count(rows=len(data['incoming_orders']) + len(data['purchase_orders']) + len(data['shipping']))
+            print("✅ Stock & Shipped counts updated successfully!")
+            print("✅ Tracking info merged successfully!")
+            return results
+        return self._stage('aggregate', run, requires=('load',))
+
+    def join(self):
+        """ Returns the documents to write: { collection_name: [doc] } """
+        def run():
+            data = self.load()
+            normalized = self.normalize()
+            results = self.aggregate()
+            collections = {
+                'products': apply_counts_to_products(data['products'], results['stock_counts'],
+                                                     results['shipped_counts']),
+                'incoming_orders': data['incoming_orders'],
+                # Rows keep their ProductStats position: the export sorts on 'order', so rows can be upserted alone
+                'product_stats': [dict(doc, order=i) for i, doc in enumerate(results.get('product_stats') or [])],
+                'purchase_orders': data['purchase_orders'],
+                'customers': list(normalized['customers'].values()),
+                'outgoing_shipments': [doc for _key, doc in normalized['shipments']],
+            }
+            if self.stats_pipeline:
+                # Built in MongoDB by the write stage
+                del collections['product_stats']
+            count(rows=sum(len(docs) for docs in collections.values()))
+            return collections
+        return self._stage('join', run, requires=('load', 'normalize', 'aggregate'))
+
+    def write(self, db=None, incremental=False, batch_size=BULK_BATCH_SIZE, dry_run=False, rebuild_ledger=False):
+        collections = self.join()
+        normalized = self.normalize()
+        with stage('write'):
+            if db is None:
+                db = connect_db()
+                if db is None:
+                    return
+            write_collections(db, collections, normalized['customers'], normalized['shipments'],
+                              incremental=incremental, batch_size=batch_size, dry_run=dry_run)
+        if incremental and not dry_run:
+            # Rows of unchanged workbooks keep the items of an older parser until backfilled
+            with stage('backfill_items'):
+                n = backfill_shipment_items(db, batch_size)
+                if n:
+                    print(f"🧩 Re-parsed the items of {n} shipments (parser v{PARSER_VERSION})")
+        if self.stats_pipeline and not dry_run:
+            with stage('product_stats'):
+                print("📊 Building product_stats in MongoDB...")
+                n = write_product_stats(db, self.aggregate()['product_stats_meta'], batch_size)
+                count(rows=n)
+                print(f"   - Stats: {n}")
+        if not dry_run:
+            with stage('ledger'):
+                refresh_ledger(db, self.aggregate(), rebuild=rebuild_ledger, batch_size=batch_size,
+                               incremental=incremental)
+
+    def run(self, stages=STAGES, **write_options):
+        for name in STAGES:
+            if name not in stages:
+                continue
+            if name == 'write':
+                self.write(**write_options)
+            else:
+                getattr(self, name)()
+        return self._results
+
+
+def init_db(incremental=False, batch_size=BULK_BATCH_SIZE):
+    """ Full pipeline: rebuild MongoDB from the workbooks. """
+    with start_run('db_refresh'):
+        RefreshPipeline().write(incremental=incremental, batch_size=batch_size)
+
+
+def print_summary(results):
+    if 'load' in results:
+        print("📂 Loaded: " + ", ".join(f"{name} {len(rows)}" for name, rows in results['load'].items()))
+    if 'normalize' in results:
+        print(f"👥 Customers: {len(results['normalize']['customers'])}, "
+              f"Shipments: {len(results['normalize']['shipments'])}")
+    if 'aggregate' in results:
+        agg = results['aggregate']
+        stats = (f"Stats rows: {len(agg['product_stats'])}" if 'product_stats' in agg
+                 else f"Stats products: {len(agg['product_stats_meta'])}")
+        print(f"📊 Stock rows: {len(agg['stock_counts'])}, Shipped products: {len(agg['shipped_counts'])}, "
+              f"{stats}, Orders with tracking: {len(agg['tracking_map'])}, "
+              f"Ledger events: {len(agg['ledger_events'])}")
+    if 'join' in results:
+        print("📦 Ready to write: " + ", ".join(f"{name} {len(docs)}" for name, docs in results['join'].items()))
+
+
+def main(argv=None):
+    # Fix emoji output on Windows consoles with GBK encoding
+    if sys.stdout.encoding and sys.stdout.encoding.lower() in ('gbk', 'gb2312', 'gb18030', 'cp936'):
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+    parser = argparse.ArgumentParser(description="Rebuild the MongoDB collections from the Excel workbooks in data/.")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"comma-separated stages to run, earlier stages run as needed (default: {','.join(STAGES)})")
+    parser.add_argument("--no-db", action="store_true", help="never connect to MongoDB (skips the write stage)")
+    parser.add_argument("--dry-run", action="store_true", help="compute and report the writes without making them")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only write rows that changed since the last refresh (falls back to a full refresh)")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE,
+                        help=f"operations per bulk_write round trip (default: {BULK_BATCH_SIZE})")
+    parser.add_argument("--no-cache", action="store_true", help="re-parse the workbooks instead of using data/.cache")
+    parser.add_argument("--ensure-indexes", action="store_true", help="only create the MongoDB indexes, then exit")
+    parser.add_argument("--stats-pipeline", action="store_true", default=STATS_PIPELINE,
+                        help="build product_stats with a MongoDB aggregation pipeline (MongoDB 4.2+)")
+    parser.add_argument("--backfill-items", action="store_true",
+                        help="only re-parse the items of shipments stored by an older parser version, then exit")
+    parser.add_argument("--rebuild-ledger", action="store_true",
+                        help="drop the inventory ledger and record every event again (counters rebuilt from scratch)")
+    args = parser.parse_args(argv)
+
+    if args.ensure_indexes:
+        db = connect_db()
+        if db is not None:
+            print(f"🗂️ Indexes in place on {ensure_indexes(db)} collections")
+        return
+
+    if args.backfill_items:
+        db = connect_db()
+        if db is not None:
+            with start_run('db_refresh'):
+                n = backfill_shipment_items(db, args.batch_size)
+            print(f"🧩 Re-parsed the items of {n} shipments (parser v{PARSER_VERSION})")
+        return
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)} (choose from {', '.join(STAGES)})")
+    if args.no_db and 'write' in stages:
+        stages.remove('write')
+
+    pipeline = RefreshPipeline(use_cache=USE_EXCEL_CACHE and not args.no_cache, stats_pipeline=args.stats_pipeline)
+    with start_run('db_refresh'):
+        results = pipeline.run(stages, incremental=args.incremental, batch_size=args.batch_size,
+                               dry_run=args.dry_run, rebuild_ledger=args.rebuild_ledger)
+        if 'write' not in stages:
+            print_summary(results)
+
+
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    main()
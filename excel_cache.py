@@ -0,0 +1,67 @@
+import os
+import pickle
+import re
+
+import pandas as pd
+
+from incremental import file_fingerprint
+
+# ==========================================
+# ON-DISK CACHE FOR THE EXCEL INPUTS
+# ==========================================
+# openpyxl parsing is the slowest part of startup, and the workbooks rarely change.
+# Each workbook is stored as a pickled DataFrame (columnar blocks, already .fillna("")
+# and post-processed, e.g. parsed 'items' lists), keyed by the file's content hash.
+
+CACHE_DIR = os.path.join("data", ".cache")
+
+# Bump when the cached format or a postprocess function changes
+CACHE_VERSION = 1
+
+
+def _cache_stem(path, tag):
+    base = os.path.splitext(os.path.basename(path))[0]
+    return f"{base}{'.' + tag if tag else ''}"
+
+
+def _cache_path(path, digest, tag):
+    return os.path.join(CACHE_DIR, f"{_cache_stem(path, tag)}.v{CACHE_VERSION}.{digest[:16]}.pkl")
+
+
+def read_workbook(path, postprocess=None, tag="", use_cache=True):
+    """
+    pd.read_excel(path).fillna("") with an on-disk cache.
+    postprocess(df) -> df runs only on a cache miss, and its output is what gets cached
+    (give it a distinct 'tag' so different postprocessing never shares a cache file).
+    """
+    if not use_cache:
+        df = pd.read_excel(path).fillna("")
+        return postprocess(df) if postprocess else df
+
+    digest = file_fingerprint(path)
+    cache_file = _cache_path(path, digest, tag)
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable cache {cache_file}: {e}")
+
+    df = pd.read_excel(path).fillna("")
+    if postprocess:
+        df = postprocess(df)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # Drop stale entries for this workbook (older contents and any CACHE_VERSION), then write-to-temp-then-rename
+    stale = re.compile(re.escape(_cache_stem(path, tag)) + r'\.v\d+\.[0-9a-f]{16}\.pkl')
+    for name in os.listdir(CACHE_DIR):
+        if stale.fullmatch(name) and name != os.path.basename(cache_file):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return df
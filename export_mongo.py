@@ -1,9 +1,17 @@
+import argparse
+import hashlib
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pymongo import MongoClient
 from bson import ObjectId
 from datetime import datetime, date
 
+from compact_export import CompactWriter, compact_path, remove_compact
+from instrumentation import command_listener, count, stage, start_run
+from mongo_utils import load_watermarks
+
 # CONFIG
 # Load .env file if present (for local development)
 _env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
@@ -18,83 +26,423 @@ if os.path.exists(_env_path):
 MONGO_URI = os.environ.get("MONGO_URI", "")
 DB_NAME = os.environ.get("MONGO_DB_NAME", "tracking_db")
 
+# Documents fetched per cursor batch / written per file write. Peak memory per export
+# is one batch, however large the collection grows.
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+
+# Also write minified data/<name>.min.json (+ .gz / .br) siblings (see compact_export.py)
+EXPORT_COMPACT = os.environ.get("EXPORT_COMPACT", "0") == "1"
+
+# Digest + watermark of every output, from the last export
+MANIFEST_PATH = 'data/export_manifest.json'
+
+
+# --- HELPER: Fix Date & ID Errors ---
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+    if isinstance(obj, (datetime, date)):
+        return obj.strftime("%Y-%m-%d")  # Format date as YYYY-MM-DD
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def write_json_stream(path, docs, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Streams 'docs' into a JSON array file, one batch at a time.
+    Output is byte-identical to json.dump(list(docs), f, ensure_ascii=False, indent=4, default=json_serial).
+    Returns: (number of documents written, sha256 of the file contents)
+    """
+    count = 0
+    buffer = []
+    digest = hashlib.sha256()
+
+    def flush():
+        data = "".join(buffer).encode('utf-8')
+        digest.update(data)
+        f.write(data)
+        buffer.clear()
+
+    with open(path, 'wb') as f:
+        for doc in docs:
+            encoded = json.dumps(doc, ensure_ascii=False, indent=4, default=json_serial)
+            # Nest one level deeper inside the array
+            buffer.append(("[\n    " if count == 0 else ",\n    ") + encoded.replace("\n", "\n    "))
+            count += 1
+            if len(buffer) >= batch_size:
+                flush()
+        buffer.append("\n]" if count else "[]")
+        flush()
+    return count, digest.hexdigest()
+
+
+def publish_json_stream(path, docs, previous_digest=None):
+    """
+    Write-to-temp-then-rename, so the dashboard never reads a half-written file.
+    The file is left untouched if its content digest did not change.
+    Returns: (count, digest, written)
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        count, digest = write_json_stream(tmp_path, docs)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+    if digest == previous_digest and os.path.exists(path):
+        os.remove(tmp_path)
+        return count, digest, False
+
+    os.replace(tmp_path, path)
+    return count, digest, True
 
-def export_data():
+
+# ==========================================
+# EXPORT MANIFEST
+# ==========================================
+# { output_path: { "sha256": ..., "count": n, "watermark": ... } }
+# Only changes when an output changes, so the scheduled workflow has nothing to commit otherwise.
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
     try:
-        client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True)
-        db = client[DB_NAME]
-        print("✅ Connected to MongoDB")
-    except Exception as e:
-        print(f"❌ Connection Failed: {e}")
-        return
-
-    # --- HELPER: Fix Date & ID Errors ---
-    def json_serial(obj):
-        """JSON serializer for objects not serializable by default json code"""
-        if isinstance(obj, (datetime, date)):
-            return obj.strftime("%Y-%m-%d")  # Format date as YYYY-MM-DD
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        raise TypeError(f"Type {type(obj)} not serializable")
-
-    # 1. EXPORT PRODUCTS
-    products = list(db.products.find({}, {'_id': 0}))  # Exclude _id
-    with open('data/products.json', 'w', encoding='utf-8') as f:
-        # Added default=json_serial
-        json.dump(products, f, ensure_ascii=False, indent=4, default=json_serial)
-    print(f"📦 Exported {len(products)} products")
-
-    # 2. EXPORT OUTGOING SHIPMENTS (JunAn)
-    # We join with 'customers' to get the phone/address data
-    shipments = list(db.outgoing_shipments.find())
-    export_shipments = []
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, OSError) as e:
+        print(f"⚠️ Ignoring unreadable manifest: {e}")
+        return {}
+
+
+def save_manifest(manifest):
+    tmp_path = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+# ==========================================
+# EXPORTS (one per output file)
+# ==========================================
+
+def iter_products(db):
+    # Exclude _id
+    return db.products.find({}, {'_id': 0}).batch_size(EXPORT_BATCH_SIZE)
+
+
+CUSTOMER_LOOKUP = {'$lookup': {'from': 'customers', 'localField': 'customer_id', 'foreignField': '_id',
+                               'as': '_customer'}}
+
+# Stored for MongoDB-side readers (stats_pipeline.py, the read API's product filter), not for the dashboard
+SHIPMENT_INTERNAL_FIELDS = {'$project': {'items': 0, 'parser_version': 0, 'row': 0, 'duplicate_rows': 0,
+                                         'billing': 0}}
+
+
+def iter_shipments(db):
+    # OUTGOING SHIPMENTS (JunAn)
+    # We join with 'customers' to get the phone/address data.
+    # The join runs server-side ($lookup), so this is one query whatever the shipment count.
+    shipments = db.outgoing_shipments.aggregate([SHIPMENT_INTERNAL_FIELDS, CUSTOMER_LOOKUP],
+                                                batchSize=EXPORT_BATCH_SIZE)
 
     for s in shipments:
-        # Join with 'customers' only to fill MISSING data
-        if 'customer_id' in s:
-            customer = db.customers.find_one({'_id': s['customer_id']})
-            if customer:
-                # Only use customer profile data if shipment data is missing
-                if 'phone' not in s or not s['phone']:
-                    s['phone'] = customer.get('phone')
-                
-                # CRITICAL FIX: Do NOT overwrite the shipment address if it already exists
-                if 'address' not in s or not s['address']:
-                    s['address'] = customer.get('address')
-                
-                if 'recipient' not in s or not s['recipient']:
-                    s['recipient'] = customer.get('name')
-        
-        # Clean up ObjectId
-        s['_id'] = str(s['_id'])
-        if 'customer_id' in s: s['customer_id'] = str(s['customer_id'])
-        
-        export_shipments.append(s)
-
-    with open('data/shipping.json', 'w', encoding='utf-8') as f:
-        json.dump(export_shipments, f, ensure_ascii=False, indent=4, default=json_serial)
-    print(f"✈️ Exported {len(export_shipments)} shipments")
-
-    # 3. EXPORT INCOMING ORDERS
-    orders = list(db.incoming_orders.find({}, {'_id': 0}))
-    with open('data/orders.json', 'w', encoding='utf-8') as f:
-        json.dump(orders, f, ensure_ascii=False, indent=4, default=json_serial)
-    print(f"🚚 Exported {len(orders)} incoming orders")
-
-    # 4. EXPORT STATS
-    stats = list(db.product_stats.find({}, {'_id': 0}))
-    with open('data/stats.json', 'w', encoding='utf-8') as f:
-        json.dump(stats, f, ensure_ascii=False, indent=4, default=json_serial)
-    print(f"📊 Exported {len(stats)} stats to data/stats.json")
-
-    # 5. EXPORT PURCHASE ORDERS
+        yield join_customer(s)
+
+
+def join_customer(s):
+    """ Fills a shipment's missing contact fields from its $lookup'ed '_customer' (also used by read_api.py). """
+    matches = s.pop('_customer', [])
+
+    # Join with 'customers' only to fill MISSING data
+    if 'customer_id' in s:
+        customer = matches[0] if matches else None
+        if customer:
+            # Only use customer profile data if shipment data is missing
+            if 'phone' not in s or not s['phone']:
+                s['phone'] = customer.get('phone')
+
+            # CRITICAL FIX: Do NOT overwrite the shipment address if it already exists
+            if 'address' not in s or not s['address']:
+                s['address'] = customer.get('address')
+
+            if 'recipient' not in s or not s['recipient']:
+                s['recipient'] = customer.get('name')
+
+    # Clean up ObjectId
+    s['_id'] = str(s['_id'])
+    if 'customer_id' in s: s['customer_id'] = str(s['customer_id'])
+
+    return s
+
+
+def iter_incoming_orders(db):
+    return db.incoming_orders.find({}, {'_id': 0}).batch_size(EXPORT_BATCH_SIZE)
+
+
+def iter_stats(db):
+    # Stored order is not kept by upserts / $merge: 'order' is the ProductStats position
+    return db.product_stats.find({}, {'_id': 0, 'order': 0}).sort('order', 1).batch_size(EXPORT_BATCH_SIZE)
+
+
+def iter_purchase_orders(db):
     # We sort by date (descending) so newest orders show first
-    purchase_orders = list(db.purchase_orders.find({}, {'_id': 0}).sort("date", -1))
+    return db.purchase_orders.find({}, {'_id': 0}).sort("date", -1).batch_size(EXPORT_BATCH_SIZE)
+
+
+# (output file, source collections, documents, message)
+EXPORTS = [
+    ('data/products.json', ['products'], iter_products, "📦 Exported {count} products"),
+    ('data/shipping.json', ['outgoing_shipments', 'customers'], iter_shipments, "✈️ Exported {count} shipments"),
+    ('data/orders.json', ['incoming_orders'], iter_incoming_orders, "🚚 Exported {count} incoming orders"),
+    ('data/stats.json', ['product_stats'], iter_stats, "📊 Exported {count} stats to data/stats.json"),
+    ('data/purchase_orders.json', ['purchase_orders'], iter_purchase_orders,
+     "🛍️ Exported {count} purchase orders to data/purchase_orders.json"),
+]
+
+
+# ==========================================
+# DASHBOARD SUMMARY (data/summary.json)
+# ==========================================
+# The figures js/app.js shows on first paint (metric cards, shipping cost chart, analytics KPIs,
+# source performance), aggregated server-side so the dashboard does not need the raw files for them.
+
+SUMMARY_PATH = 'data/summary.json'
+# Deposits / refunds are kept by hand in this file, not in MongoDB
+FINANCE_PATH = 'data/finance.json'
+SUMMARY_COLLECTIONS = ['products', 'product_stats', 'outgoing_shipments', 'incoming_orders', 'purchase_orders']
+
+
+def _sum_fields(collection, fields):
+    """ { field: sum over the collection } in one $group (non-numeric values are ignored, like || 0). """
+    group = {'_id': None}
+    group.update({f: {'$sum': f'${f}'} for f in fields})
+    rows = list(collection.aggregate([{'$group': group}]))
+    return {f: (rows[0][f] if rows else 0) for f in fields}
+
+
+def summary_metrics(db):
+    """ Dashboard metric cards: totals over products. """
+    return _sum_fields(db.products, ['us_signed', 'us_unsigned', 'shipped_cn', 'total_stock'])
+
+
+def summary_shipping_by_month(db):
+    """ { 'YYYY-MM': { 'cost', 'weight' } } of shipments with a date and a fee. """
+    rows = db.outgoing_shipments.aggregate([
+        # 'billing' is the date / fee / weight parsed at refresh time (db_refresh.cell_month, cell_number),
+        # so "MM/DD/YYYY" dates and "12元" fees count the same as they did in the browser
+        {'$match': {'fee': {'$nin': [0, '', None]}, 'billing.month': {'$ne': None}}},
+        # One streaming $group: no stage ever holds every shipment in one document
+        {'$group': {
+            '_id': '$billing.month',
+            'cost': {'$sum': '$billing.fee'},
+            'weight': {'$sum': '$billing.weight'},
+        }},
+    ])
+    return {row['_id']: {'cost': round(row['cost'], 2), 'weight': round(row['weight'], 2)} for row in rows}
+
+
+def _to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def load_finance():
+    """ { 'YYYY-MM': { 'deposit', 'refund' } } from data/finance.json. """
+    if not os.path.exists(FINANCE_PATH):
+        return {}
+    with open(FINANCE_PATH, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+
+    months = {}
+    for entry in entries:
+        if not entry.get('month'):
+            continue
+        month = months.setdefault(entry['month'], {'deposit': 0, 'refund': 0})
+        month['deposit'] += _to_number(entry.get('deposit'))
+        month['refund'] += _to_number(entry.get('refund'))
+    return months
+
+
+def summary_analytics(db):
+    """ Analytics page KPIs. """
+    stats = _sum_fields(db.product_stats, ['已发总数', '总库存'])
+    total_shipped, total_stock = stats['已发总数'], stats['总库存']
+    total_orders = db.incoming_orders.estimated_document_count() + db.purchase_orders.estimated_document_count()
+    return {
+        'total_shipped': total_shipped,
+        'total_stock': total_stock,
+        'total_orders': total_orders,
+        'avg_per_order': round(total_shipped / total_orders, 1) if total_orders else 0,
+        'turnover': round(total_shipped / total_stock, 1) if total_stock else 0,
+    }
+
+
+def summary_sources(db):
+    """ [{ source, orders, items }]: incoming + purchase orders per source, items = sum of |qty|. """
+    sources = {}
+    for row in db.incoming_orders.aggregate([
+        {'$group': {'_id': '$source', 'orders': {'$sum': 1}, 'first': {'$min': '$_id'}}},
+        {'$sort': {'first': 1}},
+    ]):
+        sources[row['_id']] = {'source': row['_id'], 'orders': row['orders'], 'items': 0}
+
+    for row in db.purchase_orders.aggregate([
+        {'$project': {'source': 1, 'items': 1}},
+        {'$unwind': {'path': '$items', 'preserveNullAndEmptyArrays': True}},
+        {'$group': {'_id': {'source': '$source', 'order': '$_id'}, 'items': {'$sum': {'$abs': '$items.qty'}}}},
+        {'$group': {'_id': '$_id.source', 'orders': {'$sum': 1}, 'items': {'$sum': '$items'},
+                    'first': {'$min': '$_id.order'}}},
+        {'$sort': {'first': 1}},
+    ]):
+        source = sources.setdefault(row['_id'], {'source': row['_id'], 'orders': 0, 'items': 0})
+        source['orders'] += row['orders']
+        source['items'] += row['items']
+
+    return list(sources.values())
+
+
+def build_summary(db):
+    shipping = summary_shipping_by_month(db)
+    finance = load_finance()
+    monthly = [
+        {'month': month,
+         'cost': shipping.get(month, {}).get('cost', 0),
+         'weight': shipping.get(month, {}).get('weight', 0),
+         'deposit': finance.get(month, {}).get('deposit', 0),
+         'refund': finance.get(month, {}).get('refund', 0)}
+        for month in sorted(set(shipping) | set(finance))
+    ]
+    return {
+        'metrics': summary_metrics(db),
+        'monthly': monthly,
+        'analytics': summary_analytics(db),
+        'sources': summary_sources(db),
+    }
+
+
+def publish_json(path, obj, previous_digest=None):
+    """ Same as publish_json_stream, for one JSON value. Returns: (digest, written) """
+    data = json.dumps(obj, ensure_ascii=False, indent=4, default=json_serial).encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == previous_digest and os.path.exists(path):
+        return digest, False
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return digest, True
+
+
+def file_digest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def run_summary_export(db, entry, watermarks, force=False):
+    """ Returns: (message, new manifest entry) """
+    watermark = None
+    if all(c in watermarks for c in SUMMARY_COLLECTIONS):
+        watermark = max(watermarks[c] for c in SUMMARY_COLLECTIONS)
+    finance_digest = file_digest(FINANCE_PATH)
+
+    if (not force and entry and watermark and entry.get('watermark') == watermark
+            and entry.get('finance_sha256') == finance_digest and os.path.exists(SUMMARY_PATH)):
+        return f"⏭️ Skipped {SUMMARY_PATH} (no changes since last export)", entry
+
+    with stage(SUMMARY_PATH):
+        digest, written = publish_json(SUMMARY_PATH, build_summary(db), entry.get('sha256') if entry else None)
+    text = f"🧮 Exported dashboard summary to {SUMMARY_PATH}" + ("" if written else " (unchanged, file kept)")
+    return text, {'sha256': digest, 'watermark': watermark, 'finance_sha256': finance_digest}
+
+
+def _removed_note(path, removed):
+    return f" (removed stale {compact_path(path)})" if removed else ""
+
+
+def run_export(db, path, collections, iter_docs, message, entry, watermarks, force=False, compact=False):
+    """ Returns: (message, new manifest entry) """
+    # The newest watermark of the source collections (None if any of them is not tracked)
+    watermark = None
+    if all(c in watermarks for c in collections):
+        watermark = max(watermarks[c] for c in collections)
+    entry = entry or {}
+
+    # Without --compact the full file is the only one kept current
+    stale_removed = not compact and remove_compact(path)
+    if stale_removed:
+        entry = {k: v for k, v in entry.items() if k != 'compact_sha256'}
+
+    # No document modified since the last export -> skip without reading the collection
+    up_to_date = os.path.exists(path) and (not compact or 'compact_sha256' in entry and os.path.exists(compact_path(path)))
+    if not force and watermark and entry.get('watermark') == watermark and up_to_date:
+        return f"⏭️ Skipped {path} (no changes since last export)" + _removed_note(path, stale_removed), entry
+
+    with stage(path):
+        docs = iter_docs(db)
+        # The compact file is written from the same cursor pass
+        writer = CompactWriter(path, default=json_serial) if compact else None
+        try:
+            n, digest, written = publish_json_stream(path, writer.tee(docs) if writer else docs, entry.get('sha256'))
+        except BaseException:
+            if writer: writer.abort()
+            raise
+        count(rows=n)
+
+    text = message.format(count=n) + ("" if written else " (unchanged, file kept)") + _removed_note(path, stale_removed)
+    new_entry = {'sha256': digest, 'count': n, 'watermark': watermark}
+    if writer:
+        new_entry['compact_sha256'], compact_written = writer.publish(entry.get('compact_sha256'))
+        if compact_written: text += f" (+ {compact_path(path)})"
+    return text, new_entry
+
+
+def export_data(force=False, compact=EXPORT_COMPACT, db=None):
+    """ db: an already connected database (worker.py keeps one warm); connects to MONGO_URI otherwise. """
+    if db is None:
+        try:
+            # One client (and connection pool) shared by all export threads
+            client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True, maxPoolSize=max(len(EXPORTS) + 1, 10),
+                                 event_listeners=[command_listener()])
+            db = client[DB_NAME]
+            print("✅ Connected to MongoDB")
+        except Exception as e:
+            print(f"❌ Connection Failed: {e}")
+            return
+
+    manifest = load_manifest()
+    new_manifest = dict(manifest)
+    # Read before any collection, so a write that lands mid-export is picked up next time
+    watermarks = load_watermarks(db)
+
+    # The exports are independent, so run them concurrently:
+    # wall-clock time is roughly that of the slowest collection, not the sum.
+    with ThreadPoolExecutor(max_workers=len(EXPORTS) + 1) as pool:
+        futures = {
+            pool.submit(run_export, db, path, collections, iter_docs, message, manifest.get(path), watermarks, force,
+                        compact): path
+            for path, collections, iter_docs, message in EXPORTS
+        }
+        futures[pool.submit(run_summary_export, db, manifest.get(SUMMARY_PATH), watermarks, force)] = SUMMARY_PATH
+        for future in as_completed(futures):
+            text, new_manifest[futures[future]] = future.result()
+            print(text)
 
-    with open('data/purchase_orders.json', 'w', encoding='utf-8') as f:
-        json.dump(purchase_orders, f, ensure_ascii=False, indent=4, default=json_serial)
-    print(f"🛍️ Exported {len(purchase_orders)} purchase orders to data/purchase_orders.json")
+    if new_manifest != manifest:
+        save_manifest(new_manifest)
 
 
 if __name__ == "__main__":
-    export_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Export the MongoDB collections to the JSON files in data/.")
+    parser.add_argument("--force", action="store_true", help="re-read every collection, even if its watermark did not move")
+    parser.add_argument("--compact", action="store_true", default=EXPORT_COMPACT,
+                        help="also write minified data/<name>.min.json (+ .gz / .br) files")
+    args = parser.parse_args()
+    with start_run('export_mongo'):
+        export_data(force=args.force, compact=args.compact)
@@ -0,0 +1,182 @@
+import hashlib
+import json
+
+# ==========================================
+# INCREMENTAL REFRESH (FINGERPRINTS)
+# ==========================================
+# Each source workbook is fingerprinted by content hash, and every output row by
+# a stable key (order_id, tracking_number, product name, ...). The last-seen
+# fingerprints live in the 'refresh_state' collection, next to the data they
+# describe. An incremental run only writes rows whose fingerprint changed.
+#
+# refresh_state holds, per collection, a header { _id: name, key_fields } and one
+# document per row { _id: { c: name, k: row key }, key: [values], fp }, so no document
+# grows with the data and a run only rewrites the rows that changed.
+# { _id: '_workbooks', workbooks: [ { path, sha256 } ] } is written last: without it
+# the state is incomplete and the next run falls back to a full refresh.
+
+STATE_COLLECTION = "refresh_state"
+WORKBOOKS_STATE_ID = "_workbooks"
+
+
+def file_fingerprint(path):
+    """ sha256 of the file contents. """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def row_fingerprint(doc, exclude=('_id',)):
+    """ Stable hash of a document (key order independent). Fields in 'exclude' are ignored. """
+    clean = {k: v for k, v in doc.items() if k not in exclude}
+    payload = json.dumps(clean, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def row_key(doc, key_fields):
+    return "\x1f".join(str(doc.get(f, "")) for f in key_fields)
+
+
+def fingerprint_rows(docs, key_fields, exclude=('_id',)):
+    """
+    Groups docs by key and fingerprints each group.
+    Returns: { key: (fingerprint, [docs]) }
+    Rows sharing a key are handled as one unit, so duplicates never get mixed up.
+    """
+    groups = {}
+    for doc in docs:
+        groups.setdefault(row_key(doc, key_fields), []).append(doc)
+
+    return {
+        key: ("|".join(row_fingerprint(d, exclude) for d in group), group)
+        for key, group in groups.items()
+    }
+
+
+def plan_changes(fingerprinted, previous, key_fields, prepare=None):
+    """
+    Diffs the current rows against the last-seen fingerprints ({ key: (fingerprint, key_filter) }).
+    Returns: (bulk_write operations, { 'new': n, 'changed': n, 'deleted': n })
+    'prepare' is called on each doc that is about to be written (e.g. to resolve references).
+    """
+    from pymongo import DeleteMany, InsertOne, ReplaceOne
+
+    ops = []
+    counts = {'new': 0, 'changed': 0, 'deleted': 0}
+
+    for key, (fp, group) in fingerprinted.items():
+        old_fp = previous.get(key, (None, None))[0]
+        if old_fp == fp:
+            continue
+        counts['changed' if old_fp is not None else 'new'] += 1
+
+        if prepare:
+            for doc in group:
+                prepare(doc)
+
+        key_filter = {f: group[0].get(f) for f in key_fields}
+        if len(group) == 1:
+            # Replace in place, so the document keeps its _id
+            ops.append(ReplaceOne(key_filter, group[0], upsert=True))
+        else:
+            ops.append(DeleteMany(key_filter))
+            ops.extend(InsertOne(doc) for doc in group)
+
+    for key in previous.keys() - fingerprinted.keys():
+        counts['deleted'] += 1
+        ops.append(DeleteMany(previous[key][1]))
+
+    return ops, counts
+
+
+def load_state(db):
+    """
+    Returns: (workbook_hashes or None, { collection: { key: (fingerprint, key_filter) } })
+    """
+    workbook_hashes = None
+    key_fields_by_collection = {}
+    previous = {}
+    rows = []
+    for doc in db[STATE_COLLECTION].find():
+        if doc['_id'] == WORKBOOKS_STATE_ID:
+            workbook_hashes = {w['path']: w['sha256'] for w in doc['workbooks']}
+        elif 'fp' in doc:
+            rows.append(doc)
+        elif 'rows' in doc:
+            # Single-document state of older versions: start over with a full refresh
+            return None, {}
+        else:
+            key_fields_by_collection[doc['_id']] = doc['key_fields']
+            previous[doc['_id']] = {}
+
+    for row in rows:
+        name = row['_id']['c']
+        if name not in previous:
+            continue
+        key_fields = key_fields_by_collection[name]
+        key_filter = dict(zip(key_fields, row['key']))
+        previous[name][row['_id']['k']] = (row['fp'], key_filter)
+    return workbook_hashes, previous
+
+
+def _state_ops(name, fingerprinted, key_fields, old):
+    """ refresh_state writes storing the row fingerprints of one collection (old: its previous rows or None). """
+    from pymongo import DeleteMany, DeleteOne, ReplaceOne
+
+    key_fields = list(key_fields)
+    ops = [ReplaceOne({'_id': name}, {'_id': name, 'key_fields': key_fields}, upsert=True)]
+    if old is None:
+        ops.append(DeleteMany({'_id.c': name}))
+        old = {}
+    for key, (fp, group) in fingerprinted.items():
+        if old.get(key, (None, None))[0] != fp:
+            row_id = {'c': name, 'k': key}
+            ops.append(ReplaceOne({'_id': row_id}, {'_id': row_id, 'key': [group[0].get(f) for f in key_fields],
+                                                     'fp': fp}, upsert=True))
+    ops.extend(DeleteOne({'_id': {'c': name, 'k': key}}) for key in old.keys() - fingerprinted.keys())
+    return ops
+
+
+def load_collection_state(db, name):
+    """
+    The stored rows of one collection alone (e.g. the inventory ledger's, which is not part of the workbook state).
+    Returns: { key: (fingerprint, key_filter) }, or None if it has no state yet
+    """
+    header = db[STATE_COLLECTION].find_one({'_id': name})
+    if header is None:
+        return None
+    return {row['_id']['k']: (row['fp'], dict(zip(header['key_fields'], row['key'])))
+            for row in db[STATE_COLLECTION].find({'_id.c': name})}
+
+
+def save_collection_state(db, name, fingerprinted, key_fields, previous=None, batch_size=None):
+    """ Stores the row fingerprints of one collection; previous: its load_collection_state() rows. """
+    from mongo_utils import bulk_write_chunked
+
+    bulk_write_chunked(db[STATE_COLLECTION], _state_ops(name, fingerprinted, key_fields, previous), batch_size)
+
+
+def save_state(db, workbook_hashes, fingerprints_by_collection, key_fields_by_collection, previous=None,
+               batch_size=None):
+    """
+    Stores workbook hashes, and the key + fingerprint of every row per collection.
+    previous: the load_state() rows the fingerprints were diffed against -- only rows that changed are
+    written; without it every row of the collections is rewritten.
+    """
+    from mongo_utils import bulk_write_chunked
+
+    state = db[STATE_COLLECTION]
+    # Incomplete until the workbook hashes are back (a crash in between means a full refresh next time)
+    state.delete_one({'_id': WORKBOOKS_STATE_ID})
+
+    ops = []
+    for name, fingerprinted in fingerprints_by_collection.items():
+        old = previous.get(name) if previous is not None else None
+        ops += _state_ops(name, fingerprinted, key_fields_by_collection[name], old)
+    bulk_write_chunked(state, ops, batch_size)
+
+    # Stored as lists (not dicts) because paths and keys may contain '.' or '$'
+    workbooks = [{'path': path, 'sha256': sha} for path, sha in workbook_hashes.items()]
+    state.replace_one({'_id': WORKBOOKS_STATE_ID}, {'_id': WORKBOOKS_STATE_ID, 'workbooks': workbooks}, upsert=True)
@@ -0,0 +1,247 @@
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# ==========================================
+# RUN METRICS (shared by db_refresh / export_mongo / update_shipping)
+# ==========================================
+# One JSON record per script run, appended to METRICS_FILE:
+#   { script, started_at, status, wall_s, cpu_s, peak_rss_mb,
+#     stages: [ { name, wall_s, cpu_s, rows, round_trips, peak_rss_mb, tracemalloc_peak_mb } ] }
+#
+#   with start_run('db_refresh'):
+#       with stage('load'):
+#           ...
+#           count(rows=len(records))
+#
+# stage() / count() are no-ops when no run is active, so library code can call them freely.
+# MongoDB round trips are counted by command_listener(); HTTP ones by update_shipping's session hook.
+# Stages belong to the thread that opened them: rows / round trips of any other thread (e.g. the read
+# API served from the worker's client) never land in them. A pool worker joins its caller's stage by
+# running propagate_stage(fn) instead of fn.
+# cpu_s is process CPU time, so stages running concurrently (the exports) overlap.
+
+METRICS_FILE = os.environ.get("METRICS_FILE", os.path.join("data", ".metrics", "runs.jsonl"))
+# METRICS=0 turns the JSON record off
+METRICS_ENABLED = os.environ.get("METRICS", "1") != "0"
+# Per-stage Python heap peaks (slows the run down a little)
+TRACE_MEMORY = os.environ.get("METRICS_TRACEMALLOC", "0") == "1"
+# Directory for a cProfile dump of the whole run (<script>.<timestamp>.prof)
+PROFILE_DIR = os.environ.get("METRICS_PROFILE", "")
+
+
+def peak_rss_mb():
+    """ Process peak resident set size so far (None where the resource module is missing). """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.round_trips = 0
+        self.record = None
+
+
+class RunMetrics:
+    def __init__(self, script):
+        self.script = script
+        self.stages = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current_stage(self):
+        """ Innermost stage of this thread (None outside of any). """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def count(self, rows=0, round_trips=0):
+        current = self.current_stage()
+        if current is None:
+            return
+        with self.lock:
+            current.rows += rows
+            current.round_trips += round_trips
+
+
+class _StageContext:
+    def __init__(self, run, name):
+        self.run = run
+        self.stage = Stage(name)
+
+    def __enter__(self):
+        if self.run is None:
+            return self.stage
+        if TRACE_MEMORY:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        self.run._stack().append(self.stage)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self.stage
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.run is None:
+            return False
+        stage = self.stage
+        stage.record = {
+            'name': stage.name,
+            'wall_s': round(time.perf_counter() - self.wall, 4),
+            'cpu_s': round(time.process_time() - self.cpu, 4),
+            'rows': stage.rows,
+            'round_trips': stage.round_trips,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if TRACE_MEMORY:
+            import tracemalloc
+            stage.record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        if exc_type is not None:
+            stage.record['error'] = exc_type.__name__
+
+        self.run._stack().pop()
+        with self.run.lock:
+            self.run.stages.append(stage.record)
+        return False
+
+
+_current_run = None
+
+
+def stage(name):
+    """ Times the enclosed block as a stage of the active run (no-op without one). """
+    return _StageContext(_current_run, name)
+
+
+def count(rows=0, round_trips=0):
+    """ Adds rows / round trips to the current stage of the active run. """
+    run = _current_run
+    if run is not None:
+        run.count(rows, round_trips)
+
+
+def propagate_stage(fn):
+    """ Wraps fn so that, run on another thread (e.g. a ThreadPoolExecutor's), it counts into the current stage. """
+    run = _current_run
+    current = run.current_stage() if run is not None else None
+    if current is None:
+        return fn
+
+    def in_stage(*args, **kwargs):
+        stack = run._stack()
+        stack.append(current)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stack.pop()
+
+    return in_stage
+
+
+class start_run:
+    """ Context manager around a whole script run; writes the metrics record on exit. """
+
+    def __init__(self, script):
+        self.script = script
+        self.run = None
+
+    def __enter__(self):
+        global _current_run
+        if _current_run is not None:
+            # Nested (e.g. init_db called from a script that is already measured): join the outer run
+            return _current_run
+
+        self.run = _current_run = RunMetrics(self.script)
+        self.started_at = datetime.now(timezone.utc)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+        if TRACE_MEMORY:
+            import tracemalloc
+            tracemalloc.start()
+        self.profiler = None
+        if PROFILE_DIR:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self.run
+
+    def __exit__(self, exc_type, exc, tb):
+        global _current_run
+        if self.run is None:
+            return False
+        _current_run = None
+
+        record = {
+            'script': self.script,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'status': 'ok' if exc_type is None else f"error: {exc_type.__name__}",
+            'argv': sys.argv[1:],
+            'wall_s': round(time.perf_counter() - self.wall, 4),
+            'cpu_s': round(time.process_time() - self.cpu, 4),
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': self.run.stages,
+        }
+
+        if self.profiler:
+            self.profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIR, f"{self.script}.{self.started_at.strftime('%Y%m%dT%H%M%S')}.prof")
+            self.profiler.dump_stats(profile_path)
+            record['profile'] = profile_path
+        if TRACE_MEMORY:
+            import tracemalloc
+            record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+            tracemalloc.stop()
+
+        print_summary(record)
+        if METRICS_ENABLED:
+            write_record(record)
+        return False
+
+
+def write_record(record):
+    try:
+        os.makedirs(os.path.dirname(METRICS_FILE) or ".", exist_ok=True)
+        with open(METRICS_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"⚠️ Could not write metrics to {METRICS_FILE}: {e}")
+
+
+def print_summary(record):
+    rss = f", peak RSS {record['peak_rss_mb']} MB" if record['peak_rss_mb'] is not None else ""
+    print(f"\n⏱️ {record['script']}: {record['wall_s']:.2f}s wall, {record['cpu_s']:.2f}s CPU{rss}")
+    for s in record['stages']:
+        extra = ", ".join(f"{n} {s[k]}" for k, n in (('rows', 'rows'), ('round_trips', 'round trips')) if s[k])
+        print(f"   - {s['name']}: {s['wall_s']:.2f}s" + (f" ({extra})" if extra else ""))
+
+
+def command_listener():
+    """ pymongo CommandListener counting every command as one round trip of the current stage. """
+    from pymongo import monitoring
+
+    class RoundTripCounter(monitoring.CommandListener):
+        def started(self, event):
+            count(round_trips=1)
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    return RoundTripCounter()
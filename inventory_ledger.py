@@ -0,0 +1,337 @@
+from datetime import datetime, timezone
+
+from aggregation import Reducer, STOCK_NAME_ALIASES
+from incremental import fingerprint_rows, load_collection_state, row_key, save_collection_state
+from mongo_utils import BULK_BATCH_SIZE, bulk_write_chunked, ensure_indexes, touch_collections
+
+# ==========================================
+# INVENTORY LEDGER (MongoDB)
+# ==========================================
+# Every purchase-order line, return and shipment line is an immutable event with a stable id:
+#   inventory_events    { _id, kind, ref, product, qty, inc: { counter: delta }, recorded_at }
+#   inventory_counters  { _id: product, total_stock, us_signed, us_unsigned, shipped_cn }
+# Counters only ever move by $inc of the events added / removed, so recording one new order
+# costs a handful of writes instead of a recompute over every order and shipment.
+#
+# Ids are derived from the row (order id / tracking number, occurrence, line, product, qty, bucket),
+# so an edited line in the workbook retracts its old event and records a new one.
+#
+# db_refresh.py updates the ledger on every write. An incremental one goes through record_events /
+# retract_events for the purchase orders and shipments whose events changed since the last refresh
+# (one fingerprint per order / tracking number in refresh_state), plus any order recorded live
+# ('pending' until the workbooks have it); a full refresh or --rebuild-ledger syncs every event.
+# Either way the counters are checked against the full recompute; a mismatch rebuilds them from
+# the events (rebuild_counters).
+
+EVENTS_COLLECTION = "inventory_events"
+COUNTERS_COLLECTION = "inventory_counters"
+COUNTER_FIELDS = ('total_stock', 'us_signed', 'us_unsigned', 'shipped_cn')
+# Rows of the ledger's refresh_state: one per purchase order / tracking number
+LEDGER_KEYS = ('group', 'ref')
+
+
+def _event(event_id, kind, ref, product, qty, inc):
+    return {'_id': event_id, 'kind': kind, 'ref': ref, 'product': product, 'qty': qty, 'inc': inc}
+
+
+def purchase_order_events(order, occurrence=0):
+    """ One event per purchase-order line (same rules as aggregation.tally_stock_counts). """
+    note = str(order.get('note', ''))
+    is_signed = "已发货" in note and "已签收" in note
+    events = []
+    for line, item in enumerate(order.get('items') or []):
+        name = item['product'].replace(" (Gift Box)", "")
+        name = STOCK_NAME_ALIASES.get(name, name)
+        qty = item['qty']
+        # Returns (qty < 0) always reduce 'Signed' (On Hand) stock
+        bucket = 'us_signed' if qty < 0 or is_signed else 'us_unsigned'
+        events.append(_event(f"po:{order.get('order_id')}#{occurrence}:{line}:{name}:{qty}:{bucket}",
+                             'return' if qty < 0 else 'purchase', order.get('order_id'), name, qty,
+                             {'total_stock': qty, bucket: qty}))
+    return events
+
+
+def shipment_events(ship, parsed_items, occurrence=0):
+    """ One event per product line of a shipment's details. """
+    return [
+        _event(f"ship:{ship['tracking_number']}#{occurrence}:{line}:{name}:{qty}", 'shipment',
+               ship['tracking_number'], name, qty, {'shipped_cn': qty})
+        for line, (name, qty, _is_packaged) in enumerate(parsed_items)
+    ]
+
+
+class LedgerEvents(Reducer):
+    """ Ledger events of every purchase order and shipment row (duplicate rows get their own ids). """
+    name = 'ledger_events'
+
+    def __init__(self):
+        self.events = []
+        self._occurrences = {}
+
+    def _occurrence(self, key):
+        self._occurrences[key] = self._occurrences.get(key, -1) + 1
+        return self._occurrences[key]
+
+    def on_purchase_order(self, order):
+        self.events += purchase_order_events(order, self._occurrence(('po', order.get('order_id'))))
+
+    def on_shipment(self, ship, parsed_items):
+        self.events += shipment_events(ship, parsed_items, self._occurrence(('ship', ship['tracking_number'])))
+
+    def result(self):
+        return self.events
+
+
+def ref_key(event):
+    """ The refresh_state key of the purchase order / shipment an event belongs to. """
+    return row_key(_ref_doc(event), LEDGER_KEYS)
+
+
+def _ref_doc(event):
+    return {'group': 'ship' if event['kind'] == 'shipment' else 'po', 'ref': event['ref']}
+
+
+def ledger_fingerprints(events):
+    """ { ref key: (fingerprint, [ref doc]) } -- the event ids of each purchase order / shipment, hashed. """
+    ids = {}
+    for event in events:
+        ids.setdefault(ref_key(event), (_ref_doc(event), []))[1].append(event['_id'])
+    return fingerprint_rows([dict(doc, ids=sorted(event_ids)) for doc, event_ids in ids.values()], LEDGER_KEYS)
+
+
+def _deltas(events, sign=1):
+    """ { product: { counter: delta } } """
+    deltas = {}
+    for event in events:
+        counters = deltas.setdefault(event['product'], {})
+        for field, qty in event['inc'].items():
+            counters[field] = counters.get(field, 0) + sign * qty
+    return deltas
+
+
+def _merge_deltas(*all_deltas):
+    merged = {}
+    for deltas in all_deltas:
+        for product, counters in deltas.items():
+            target = merged.setdefault(product, {})
+            for field, qty in counters.items():
+                target[field] = target.get(field, 0) + qty
+    return {p: {f: q for f, q in c.items() if q} for p, c in merged.items() if any(c.values())}
+
+
+def _apply_deltas(collection, deltas, key, batch_size, upsert):
+    from pymongo import UpdateOne
+
+    ops = [UpdateOne({key: product}, {'$inc': counters}, upsert=upsert) for product, counters in deltas.items()]
+    return bulk_write_chunked(collection, ops, batch_size, ordered=False)
+
+
+def record_events(db, events, update_products=True, batch_size=BULK_BATCH_SIZE, pending=True):
+    """
+    Appends new events and $inc's their counters (and the products' fields, unless update_products=False).
+    Events already in the ledger are ignored, so recording the same order twice counts it once.
+    pending: the workbooks do not have these events yet -- the next refresh keeps or retracts them.
+    Returns: number of events recorded
+    """
+    from pymongo import InsertOne
+    from pymongo.errors import BulkWriteError
+
+    if not events:
+        return 0
+    now = datetime.now(timezone.utc)
+    docs = [dict(event, recorded_at=now, **({'pending': True} if pending else {})) for event in events]
+    try:
+        db[EVENTS_COLLECTION].bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+        recorded = docs
+    except BulkWriteError as e:
+        duplicates = {err['index'] for err in e.details.get('writeErrors', []) if err.get('code') == 11000}
+        if len(duplicates) != len(e.details.get('writeErrors', [])):
+            raise
+        recorded = [doc for i, doc in enumerate(docs) if i not in duplicates]
+
+    deltas = _merge_deltas(_deltas(recorded))
+    _apply_deltas(db[COUNTERS_COLLECTION], deltas, '_id', batch_size, upsert=True)
+    touched = [EVENTS_COLLECTION, COUNTERS_COLLECTION]
+    if update_products and deltas:
+        _apply_deltas(db.products, deltas, 'name', batch_size, upsert=False)
+        touched.append('products')
+    touch_collections(db, touched)
+    return len(recorded)
+
+
+def retract_events(db, docs, batch_size=BULK_BATCH_SIZE):
+    """ Removes stored events (as read from the ledger) and $inc's their counters back. Returns: number removed """
+    from pymongo import DeleteMany
+
+    if not docs:
+        return 0
+    ids = [doc['_id'] for doc in docs]
+    bulk_write_chunked(db[EVENTS_COLLECTION],
+                       [DeleteMany({'_id': {'$in': ids[i:i + batch_size]}}) for i in range(0, len(ids), batch_size)],
+                       batch_size)
+    _apply_deltas(db[COUNTERS_COLLECTION], _merge_deltas(_deltas(docs, sign=-1)), '_id', batch_size, upsert=True)
+    touch_collections(db, [EVENTS_COLLECTION, COUNTERS_COLLECTION])
+    return len(docs)
+
+
+def sync_events(db, events, batch_size=BULK_BATCH_SIZE):
+    """
+    Makes the ledger hold exactly 'events' (all events derived from the workbooks):
+    new ones are inserted, vanished ones (edited / deleted rows) removed, counters $inc'd by the difference.
+    Reads every stored event id -- refresh_ledger only does this on full refreshes.
+    Returns: (added, removed)
+    """
+    wanted = {event['_id']: event for event in events}
+    stored = {doc['_id'] for doc in db[EVENTS_COLLECTION].find({}, {'_id': 1})}
+    added = [event for event_id, event in wanted.items() if event_id not in stored]
+    gone_ids = [event_id for event_id in stored if event_id not in wanted]
+    removed = list(db[EVENTS_COLLECTION].find({'_id': {'$in': gone_ids}})) if gone_ids else []
+
+    record_events(db, added, update_products=False, batch_size=batch_size, pending=False)
+    retract_events(db, removed, batch_size)
+    # Whatever is left is in the workbooks now
+    db[EVENTS_COLLECTION].update_many({'pending': True}, {'$unset': {'pending': ''}})
+    return len(added), len(removed)
+
+
+def update_events(db, events, fingerprinted, previous, batch_size=BULK_BATCH_SIZE):
+    """
+    Incremental sync: only the purchase orders / shipments whose events changed since 'previous'
+    (their ledger_fingerprints() at the last refresh), plus those of pending events, are touched --
+    their new events go through record_events, the vanished ones through retract_events.
+    Returns: (added, removed)
+    """
+    changed = {key for key, (fp, _group) in fingerprinted.items() if previous.get(key, (None, None))[0] != fp}
+    changed |= previous.keys() - fingerprinted.keys()
+    pending = list(db[EVENTS_COLLECTION].find({'pending': True}))
+    changed |= {ref_key(doc) for doc in pending}
+    if not changed:
+        return 0, 0
+
+    refs = [fingerprinted[key][1][0]['ref'] for key in changed if key in fingerprinted]
+    refs += [previous[key][1]['ref'] for key in changed if key in previous]
+    refs += [doc['ref'] for doc in pending]
+    stored = {doc['_id']: doc for doc in db[EVENTS_COLLECTION].find({'ref': {'$in': list(set(refs))}})
+              if ref_key(doc) in changed}
+    wanted = {event['_id']: event for event in events if ref_key(event) in changed}
+
+    added = [event for event_id, event in wanted.items() if event_id not in stored]
+    removed = [doc for event_id, doc in stored.items() if event_id not in wanted]
+    kept = [event_id for event_id, doc in stored.items() if event_id in wanted and doc.get('pending')]
+    record_events(db, added, update_products=False, batch_size=batch_size, pending=False)
+    retract_events(db, removed, batch_size)
+    if kept:
+        db[EVENTS_COLLECTION].update_many({'_id': {'$in': kept}}, {'$unset': {'pending': ''}})
+    return len(added), len(removed)
+
+
+def load_counters(db):
+    """ Returns: { product: { counter: value } } """
+    return {doc['_id']: {f: doc.get(f, 0) for f in COUNTER_FIELDS} for doc in db[COUNTERS_COLLECTION].find()}
+
+
+def rebuild_counters(db):
+    """ Recomputes every counter from the events (one $group), replacing the stored ones. """
+    group = {'_id': '$product'}
+    group.update({f: {'$sum': f'$inc.{f}'} for f in COUNTER_FIELDS})
+    counters = list(db[EVENTS_COLLECTION].aggregate([{'$group': group}]))
+
+    db[COUNTERS_COLLECTION].delete_many({})
+    if counters:
+        db[COUNTERS_COLLECTION].insert_many(counters)
+    touch_collections(db, [COUNTERS_COLLECTION])
+    return len(counters)
+
+
+def expected_counters(stock_counts, shipped_counts):
+    """ The counters a full recompute gives ({ product: { counter: value } }). """
+    expected = {}
+    for name, counts in stock_counts.items():
+        expected.setdefault(name, {})
+        expected[name].update(total_stock=counts['total'], us_signed=counts['signed'], us_unsigned=counts['unsigned'])
+    for name, qty in shipped_counts.items():
+        expected.setdefault(name, {})['shipped_cn'] = qty
+    return expected
+
+
+def verify_counters(db, stock_counts, shipped_counts):
+    """
+    Compares the counters with a full recompute (aggregation.StockCounts / ShippedCounts).
+    Returns: { product: (counters, expected) } for every product that differs
+    """
+    counters = load_counters(db)
+    expected = expected_counters(stock_counts, shipped_counts)
+    mismatches = {}
+    for name in set(counters) | set(expected):
+        have = {f: counters.get(name, {}).get(f, 0) for f in COUNTER_FIELDS}
+        want = {f: expected.get(name, {}).get(f, 0) for f in COUNTER_FIELDS}
+        if have != want:
+            mismatches[name] = (have, want)
+    return mismatches
+
+
+def reconcile_products(db, expected, batch_size=BULK_BATCH_SIZE):
+    """
+    Resets product fields that record_events moved ahead of the workbooks (e.g. an order recorded
+    but never added to purchase_orders_data.xlsx, whose event the sync just retracted).
+    Returns: number of products corrected
+    """
+    from pymongo import UpdateOne
+
+    ops = []
+    for doc in db.products.find({'name': {'$in': list(expected)}}, dict.fromkeys(('name',) + COUNTER_FIELDS, 1)):
+        changes = {f: v for f, v in expected[doc['name']].items() if doc.get(f) != v}
+        if changes:
+            ops.append(UpdateOne({'_id': doc['_id']}, {'$set': changes}))
+    bulk_write_chunked(db.products, ops, batch_size, ordered=False)
+    if ops:
+        touch_collections(db, ['products'])
+    return len(ops)
+
+
+def refresh_ledger(db, results, rebuild=False, batch_size=BULK_BATCH_SIZE, incremental=False):
+    """
+    db_refresh.py write stage: bring the ledger in line with the workbook events (only the changed
+    orders / shipments when incremental, every event otherwise), then verify the counters against
+    the full recompute in 'results' (aggregate_all output).
+    """
+    events = results['ledger_events']
+    ensure_indexes(db, [EVENTS_COLLECTION])
+    fingerprinted = ledger_fingerprints(events)
+    previous = None
+    if rebuild:
+        print("🧾 Rebuilding the inventory ledger...")
+        db[EVENTS_COLLECTION].drop()
+        db[COUNTERS_COLLECTION].drop()
+    elif incremental:
+        previous = load_collection_state(db, EVENTS_COLLECTION)
+        if previous is None:
+            print("🧾 No ledger state yet, syncing every event")
+
+    if previous is not None:
+        added, removed = update_events(db, events, fingerprinted, previous, batch_size)
+        print(f"🧾 Inventory ledger: {added} events added, {removed} retracted (changed orders / shipments only)")
+    else:
+        added, removed = sync_events(db, events, batch_size)
+        print(f"🧾 Inventory ledger: {added} events added, {removed} retracted ({len(events)} in total)")
+    save_collection_state(db, EVENTS_COLLECTION, fingerprinted, LEDGER_KEYS, previous, batch_size)
+
+    corrected = reconcile_products(db, expected_counters(results['stock_counts'], results['shipped_counts']),
+                                   batch_size)
+    if corrected:
+        print(f"🧾 Reset the stock counts of {corrected} products to the workbooks'")
+
+    mismatches = verify_counters(db, results['stock_counts'], results['shipped_counts'])
+    if not mismatches:
+        print("✅ Ledger counters match the full recompute")
+        return True
+
+    # The events are the source of truth: counters drift only if a sync was interrupted
+    print(f"⚠️ Ledger counters differ from the full recompute for {len(mismatches)} products, rebuilding them...")
+    rebuild_counters(db)
+    mismatches = verify_counters(db, results['stock_counts'], results['shipped_counts'])
+    if not mismatches:
+        print("✅ Counters rebuilt from the events, they match the full recompute")
+    for name, (have, want) in mismatches.items():
+        print(f"   ❌ {name}: ledger {have} != recompute {want}")
+    return not mismatches
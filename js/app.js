@@ -51,14 +51,65 @@ let allOrders = [];
 let allShipping = [];
 let purchaseOrders = [];
 let financeData = [];
+let summary = null; // pre-aggregated figures (data/summary.json), null until loaded / if missing
+
+// ========== FIRST PAINT ==========
+// summary.json is small: paint the metric cards and the cost chart from it before the raw files arrive
+fetch('data/summary.json').then(r => r.ok ? r.json() : null).then(data => {
+    if (!data) return;
+    summary = data;
+    renderMetricCards();
+    renderShippingCostChart();
+}).catch(err => console.warn("Summary load error:", err));
+
+// ========== COMPACT EXPORTS ==========
+// export_mongo.py --compact writes data/<name>.min.json: {"schema": {name, version, derived}, "data": [...]}
+// with derived fields (tracking URLs) left out when they can be rebuilt here (see compact_export.py).
+const COMPACT_SCHEMA_VERSION = 1;
+
+function getTrackingUrl(trackingNum) {
+    if (!trackingNum || trackingNum === '——') return '';
+    trackingNum = trackingNum.trim();
+    if (trackingNum.toUpperCase().startsWith('1Z')) return `https://www.ups.com/track?track=yes&trackNums=${trackingNum}`;
+    return `https://www.fedex.com/fedextrack/?trknbr=${trackingNum}`;
+}
+
+const compactExpanders = {
+    shipping: s => {
+        if (!('tracking_url' in s)) s.tracking_url = `https://www.junanex.com/tracking?code=${s.tracking_number}&mobile=${s.phone}`;
+    },
+    orders: o => {
+        if (!('tracking_url' in o)) o.tracking_url = getTrackingUrl(o.tracking);
+    },
+    purchase_orders: o => (o.shipments || []).forEach(s => {
+        if (!('tracking_url' in s)) s.tracking_url = getTrackingUrl(s.tracking_number);
+    })
+};
+
+function expandCompact(name, file) {
+    const expand = compactExpanders[name];
+    if (expand) file.data.forEach(expand);
+    return file.data;
+}
+
+// Compact file first, the full one if it is missing or of a schema version this page does not know
+function loadExport(name) {
+    return fetch(`data/${name}.min.json`)
+        .then(r => r.ok ? r.json() : null)
+        .catch(() => null)
+        .then(file => {
+            if (file && file.schema && file.schema.version === COMPACT_SCHEMA_VERSION) return expandCompact(name, file);
+            return fetch(`data/${name}.json`).then(r => r.ok ? r.json() : []);
+        });
+}
 
 // ========== FETCH ALL DATA ==========
 Promise.all([
-    fetch('data/products.json').then(r => r.ok ? r.json() : []),
-    fetch('data/stats.json').then(r => r.ok ? r.json() : []),
-    fetch('data/orders.json').then(r => r.ok ? r.json() : []),
-    fetch('data/shipping.json').then(r => r.ok ? r.json() : []),
-    fetch('data/purchase_orders.json').then(r => r.ok ? r.json() : []),
+    loadExport('products'),
+    loadExport('stats'),
+    loadExport('orders'),
+    loadExport('shipping'),
+    loadExport('purchase_orders'),
     fetch('data/finance.json').then(r => r.ok ? r.json() : [])
 ]).then(([products, stats, orders, shipping, purchases, finance]) => {
     allProducts = products;
@@ -194,21 +245,28 @@ function renderFilteredProducts() {
 
 // ========== DASHBOARD ==========
 function renderDashboard() {
+    renderMetricCards();
+    renderOrdersTable();
+    renderShippingCostChart();
+}
+
+function renderMetricCards() {
     let totalSigned = 0, totalUnsigned = 0, totalShippedCn = 0, totalStock = 0;
-    allProducts.forEach(product => {
-        totalSigned += (product.us_signed || 0);
-        totalUnsigned += (product.us_unsigned || 0);
-        totalShippedCn += (product.shipped_cn || 0);
-        totalStock += (product.total_stock || 0);
-    });
+    if (summary) {
+        ({ us_signed: totalSigned, us_unsigned: totalUnsigned, shipped_cn: totalShippedCn, total_stock: totalStock } = summary.metrics);
+    } else {
+        allProducts.forEach(product => {
+            totalSigned += (product.us_signed || 0);
+            totalUnsigned += (product.us_unsigned || 0);
+            totalShippedCn += (product.shipped_cn || 0);
+            totalStock += (product.total_stock || 0);
+        });
+    }
 
     document.getElementById('metric-us-signed').textContent = totalSigned.toLocaleString();
     document.getElementById('metric-us-unsigned').textContent = totalUnsigned.toLocaleString();
     document.getElementById('metric-shipped-cn').textContent = totalShippedCn.toLocaleString();
     document.getElementById('metric-total-stock').textContent = totalStock.toLocaleString();
-
-    renderOrdersTable();
-    renderShippingCostChart();
 }
 
 function renderStatsTable(tbodyId, stats) {
@@ -282,28 +340,37 @@ function renderShippingCostChart() {
     const summaryEl = document.getElementById('shipping-cost-summary');
     if (!container) return;
 
-    // Build deposit/refund lookup from finance.json
     const deposits = {};
     const refunds = {};
-    financeData.forEach(f => {
-        if (f.month) {
-            deposits[f.month] = (deposits[f.month] || 0) + (parseFloat(f.deposit) || 0);
-            refunds[f.month] = (refunds[f.month] || 0) + (parseFloat(f.refund) || 0);
-        }
-    });
-
-    // Aggregate cost & weight from allShipping by month
     const monthlyAgg = {};
-    allShipping.forEach(s => {
-        if (!s.date || !s.fee) return;
-        // Support date formats: "YYYY-MM-DD", "MM/DD/YYYY", "YYYY/MM/DD", etc.
-        const d = new Date(s.date);
-        if (isNaN(d.getTime())) return;
-        const key = d.getFullYear() + '-' + String(d.getMonth() + 1).padStart(2, '0');
-        if (!monthlyAgg[key]) monthlyAgg[key] = { cost: 0, weight: 0 };
-        monthlyAgg[key].cost += parseFloat(s.fee) || 0;
-        monthlyAgg[key].weight += parseFloat(s.weight) || 0;
-    });
+    if (summary) {
+        // Already aggregated per month by export_mongo.py
+        summary.monthly.forEach(m => {
+            deposits[m.month] = m.deposit;
+            refunds[m.month] = m.refund;
+            monthlyAgg[m.month] = { cost: m.cost, weight: m.weight };
+        });
+    } else {
+        // Build deposit/refund lookup from finance.json
+        financeData.forEach(f => {
+            if (f.month) {
+                deposits[f.month] = (deposits[f.month] || 0) + (parseFloat(f.deposit) || 0);
+                refunds[f.month] = (refunds[f.month] || 0) + (parseFloat(f.refund) || 0);
+            }
+        });
+
+        // Aggregate cost & weight from allShipping by month
+        allShipping.forEach(s => {
+            if (!s.date || !s.fee) return;
+            // Support date formats: "YYYY-MM-DD", "MM/DD/YYYY", "YYYY/MM/DD", etc.
+            const d = new Date(s.date);
+            if (isNaN(d.getTime())) return;
+            const key = d.getFullYear() + '-' + String(d.getMonth() + 1).padStart(2, '0');
+            if (!monthlyAgg[key]) monthlyAgg[key] = { cost: 0, weight: 0 };
+            monthlyAgg[key].cost += parseFloat(s.fee) || 0;
+            monthlyAgg[key].weight += parseFloat(s.weight) || 0;
+        });
+    }
 
     // Build last 6 months ending at current month
     const now = new Date();
@@ -819,12 +886,16 @@ function exportShipments() {
 // ========== ANALYTICS PAGE ==========
 function renderAnalyticsPage() {
     let totalShipped = 0, totalStockAll = 0;
-    allStats.forEach(s => {
-        totalShipped += (s['已发总数'] || 0);
-        totalStockAll += (s['总库存'] || 0);
-    });
+    if (summary) {
+        ({ total_shipped: totalShipped, total_stock: totalStockAll } = summary.analytics);
+    } else {
+        allStats.forEach(s => {
+            totalShipped += (s['已发总数'] || 0);
+            totalStockAll += (s['总库存'] || 0);
+        });
+    }
 
-    const totalOrders = allOrders.length + purchaseOrders.length;
+    const totalOrders = summary ? summary.analytics.total_orders : allOrders.length + purchaseOrders.length;
     const avgPerOrder = totalOrders > 0 ? (totalShipped / totalOrders).toFixed(1) : '0';
     const turnover = totalStockAll > 0 ? (totalShipped / totalStockAll).toFixed(1) + 'x' : '0x';
 
@@ -922,16 +993,20 @@ function renderPieChart(data) {
 
 function renderSourcePerformance() {
     const sourceMap = {};
-    allOrders.forEach(o => {
-        if (!sourceMap[o.source]) sourceMap[o.source] = { orders: 0, items: 0 };
-        sourceMap[o.source].orders++;
-    });
+    if (summary) {
+        summary.sources.forEach(s => { sourceMap[s.source] = { orders: s.orders, items: s.items }; });
+    } else {
+        allOrders.forEach(o => {
+            if (!sourceMap[o.source]) sourceMap[o.source] = { orders: 0, items: 0 };
+            sourceMap[o.source].orders++;
+        });
 
-    purchaseOrders.forEach(o => {
-        if (!sourceMap[o.source]) sourceMap[o.source] = { orders: 0, items: 0 };
-        sourceMap[o.source].orders++;
-        if (o.items) o.items.forEach(i => { sourceMap[o.source].items += Math.abs(i.qty || 0); });
-    });
+        purchaseOrders.forEach(o => {
+            if (!sourceMap[o.source]) sourceMap[o.source] = { orders: 0, items: 0 };
+            sourceMap[o.source].orders++;
+            if (o.items) o.items.forEach(i => { sourceMap[o.source].items += Math.abs(i.qty || 0); });
+        });
+    }
 
     const container = document.getElementById('source-performance');
     let html = '';
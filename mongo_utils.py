@@ -0,0 +1,115 @@
+import os
+from datetime import datetime, timezone
+
+# ==========================================
+# SHARED MONGODB HELPERS
+# ==========================================
+
+# Max operations per bulk_write round trip (override with the BULK_BATCH_SIZE env var or --batch-size)
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", "1000"))
+
+
+def bulk_write_chunked(collection, ops, batch_size=None, ordered=True):
+    """
+    Sends 'ops' with one bulk_write per chunk of 'batch_size' operations.
+    Returns: number of round trips made.
+    """
+    batch_size = batch_size or BULK_BATCH_SIZE
+    round_trips = 0
+    for start in range(0, len(ops), batch_size):
+        collection.bulk_write(ops[start:start + batch_size], ordered=ordered)
+        round_trips += 1
+    return round_trips
+
+
+# ==========================================
+# COLLECTION WATERMARKS
+# ==========================================
+# Every writer bumps { _id: collection, updated_at } here after changing a collection,
+# so readers (export_mongo.py) can skip collections that did not change without reading them.
+
+WATERMARK_COLLECTION = "collection_watermarks"
+
+
+def touch_collections(db, names):
+    """ Marks the given collections as modified now. """
+    from pymongo import UpdateOne
+
+    now = datetime.now(timezone.utc)
+    ops = [UpdateOne({'_id': name}, {'$set': {'updated_at': now}}, upsert=True) for name in names]
+    if ops:
+        db[WATERMARK_COLLECTION].bulk_write(ops, ordered=False)
+
+
+def load_watermarks(db):
+    """ Returns: { collection_name: updated_at (ISO string) } """
+    return {doc['_id']: doc['updated_at'].isoformat() for doc in db[WATERMARK_COLLECTION].find()}
+
+
+# ==========================================
+# INDEXES
+# ==========================================
+# Keys every writer upserts against, and the fields the exports filter / sort on.
+# { collection: [ (keys, options) ] }
+
+INDEXES = {
+    'customers': [([('phone', 1), ('name', 1)], {'unique': True})],
+    # (field, _id) pairs: the read API's sorts and keyset pages (read_api.RESOURCES)
+    'outgoing_shipments': [([('tracking_number', 1)], {'unique': True}), ([('date', 1), ('_id', 1)], {})],
+    'purchase_orders': [([('order_id', 1)], {}), ([('date', 1), ('_id', 1)], {})],
+    'incoming_orders': [([('order_id', 1), ('tracking', 1)], {})],
+    'inventory_events': [([('ref', 1)], {}), ([('pending', 1)], {'sparse': True})],
+    'products': [([('name', 1), ('_id', 1)], {}), ([('total_stock', 1), ('_id', 1)], {}),
+                 ([('us_signed', 1), ('_id', 1)], {})],
+    'product_stats': [([('产品名称', 1)], {}), ([('order', 1)], {})],
+    'tracking_status_history': [([('tracking_number', 1), ('recorded_at', -1)], {})],
+}
+
+
+def ensure_indexes(db, names=None, suffix=''):
+    """
+    Creates the INDEXES of the given collections (default: all). Idempotent, one round trip
+    per collection. A failing index (e.g. duplicates under a unique key) is reported, not raised.
+    suffix: create them on '<name><suffix>' instead (staging collections).
+    Returns: number of collections whose indexes are in place.
+    """
+    from pymongo import IndexModel
+    from pymongo.errors import OperationFailure
+
+    ok = 0
+    for name in (names if names is not None else INDEXES):
+        models = [IndexModel(keys, **options) for keys, options in INDEXES.get(name, [])]
+        if not models:
+            continue
+        try:
+            db[name + suffix].create_indexes(models)
+            ok += 1
+        except OperationFailure as e:
+            print(f"⚠️ Could not create indexes on {name + suffix}: {e}")
+    return ok
+
+
+# ==========================================
+# STAGING COLLECTIONS
+# ==========================================
+# Full rewrites go to '<collection><STAGING_SUFFIX>' and are renamed over the live collection,
+# so readers see the old or the new collection, never an empty or half-written one.
+
+STAGING_SUFFIX = "__staging"
+
+
+def create_staging(db, names):
+    """ Fresh, indexed '<name>__staging' collections (leftovers of an unfinished rewrite are dropped). """
+    existing = set(db.list_collection_names())
+    for name in names:
+        staging = name + STAGING_SUFFIX
+        if staging in existing:
+            db[staging].drop()
+        db.create_collection(staging)
+    ensure_indexes(db, names, suffix=STAGING_SUFFIX)
+
+
+def swap_in(db, names):
+    """ Renames each staging collection over its live one (each rename is atomic). """
+    for name in names:
+        db[name + STAGING_SUFFIX].rename(name, dropTarget=True)
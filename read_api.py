@@ -0,0 +1,425 @@
+import argparse
+import base64
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from export_mongo import CUSTOMER_LOOKUP, SHIPMENT_INTERNAL_FIELDS, join_customer, json_serial
+from instrumentation import command_listener
+from mongo_utils import load_watermarks
+from tracking_schedule import DELIVERED_MARKERS
+
+# ==========================================
+# READ API (python read_api.py)
+# ==========================================
+# Paginated, server-side filtered views of the collections export_mongo.py dumps whole:
+#   GET /api/shipments        ?q=  &status=delivered|transit  &product=  &sort=date|-date
+#   GET /api/purchase_orders  ?q=  &source=                   &sort=-date|date
+#   GET /api/products         ?q=  &status=low|out            &sort=name|total-desc|total-asc|signed-desc
+#   common:                   &limit= (default API_PAGE_SIZE)  &cursor= (next_cursor of the previous page)
+# -> { "items": [ same documents as data/<name>.json ], "next_cursor": "..." | null }
+#
+# Filters, sorts and searches mirror js/app.js (filterShipments, filterPurchaseOrders, getFilteredProducts);
+# q is a case-insensitive substring of the text columns (numbers and dates are not searched).
+# Sorts are on stored fields only (missing ones sort as null), each backed by a compound
+# (field, _id) index in mongo_utils.INDEXES; the status sort of the dashboard is computed and stays client-side.
+# Pagination is keyset-based (last sort key + _id, as plain range matches on the same index),
+# so a page costs the same however deep it is and rows written between two pages are neither skipped nor repeated.
+#
+# Pages are kept in an LRU / TTL cache keyed by the query and the watermarks of its collections
+# (mongo_utils.touch_collections), so a refresh, export or scrape invalidates them on the next poll.
+
+# Load .env file if present (for local development)
+_env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if os.path.exists(_env_path):
+    with open(_env_path) as _f:
+        for _line in _f:
+            _line = _line.strip()
+            if _line and not _line.startswith('#') and '=' in _line:
+                _k, _v = _line.split('=', 1)
+                os.environ.setdefault(_k.strip(), _v.strip())
+
+MONGO_URI = os.environ.get("MONGO_URI", "")
+DB_NAME = os.environ.get("MONGO_DB_NAME", "tracking_db")
+
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("API_PORT", "8010"))
+API_PAGE_SIZE = int(os.environ.get("API_PAGE_SIZE", "50"))
+API_MAX_PAGE_SIZE = int(os.environ.get("API_MAX_PAGE_SIZE", "500"))
+# Cached pages: how many, for how long (seconds)
+API_CACHE_SIZE = int(os.environ.get("API_CACHE_SIZE", "256"))
+API_CACHE_TTL = float(os.environ.get("API_CACHE_TTL", "300"))
+# Watermarks are re-read at most this often (seconds): the longest a page outlives a refresh
+API_WATERMARK_POLL = float(os.environ.get("API_WATERMARK_POLL", "2"))
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class TTLCache:
+    """ LRU cache of at most max_entries values, each dropped ttl seconds after it was stored. """
+
+    def __init__(self, max_entries=API_CACHE_SIZE, ttl=API_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """ Returns: the cached value, or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'ttl_s': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+# ==========================================
+# RESOURCES
+# ==========================================
+
+def _search(fields, q):
+    pattern = {'$regex': re.escape(q), '$options': 'i'}
+    return {'$or': [{field: pattern} for field in fields]}
+
+
+_DELIVERED = re.compile('|'.join(re.escape(marker) for marker in DELIVERED_MARKERS))
+
+
+def shipment_filter(params):
+    match = {}
+    status = params.get('status')
+    if status == 'delivered':
+        match['status'] = _DELIVERED
+    elif status == 'transit':
+        # Like isDelivered(''), a shipment without a status is still in transit
+        match['status'] = {'$not': _DELIVERED}
+    elif status:
+        raise BadRequest(f"unknown status: {status} (delivered, transit)")
+    if params.get('product'):
+        # Structured items stored at ingest (db_refresh.py), exact product name
+        match['items.product'] = params['product']
+    return match
+
+
+def purchase_order_filter(params):
+    return {'source': params['source']} if params.get('source') else {}
+
+
+def product_filter(params):
+    status = params.get('status')
+    if status == 'low':
+        return {'total_stock': {'$gt': 0, '$lt': 5}}
+    if status == 'out':
+        return {'$or': [{'total_stock': 0}, {'total_stock': None}]}
+    if status:
+        raise BadRequest(f"unknown status: {status} (low, out)")
+    return {}
+
+
+def _drop_id(doc):
+    doc.pop('_id', None)
+    return doc
+
+
+# name: { collection, sources (watermarked collections), filter(params), search fields,
+#         sorts: { name: [ (field, direction) ] } (ties broken by _id), default sort, shape(doc) }
+RESOURCES = {
+    'shipments': {
+        'collection': 'outgoing_shipments',
+        'sources': ['outgoing_shipments', 'customers'],
+        'filter': shipment_filter,
+        # The customer's fields too: iter_shipments fills missing ones from them
+        'search': ['tracking_number', 'recipient', 'details', 'items.product', 'status', 'phone', 'address',
+                   '_customer.name', '_customer.phone', '_customer.address'],
+        'sorts': {'default': [], 'date': [('date', 1)], '-date': [('date', -1)]},
+        'default_sort': 'default',
+        'shape': join_customer,
+    },
+    'purchase_orders': {
+        'collection': 'purchase_orders',
+        'sources': ['purchase_orders'],
+        'filter': purchase_order_filter,
+        'search': ['source', 'order_id', 'note', 'items.product', 'shipments.carrier', 'shipments.tracking_number'],
+        'sorts': {'-date': [('date', -1)], 'date': [('date', 1)]},
+        # Newest first, like the export
+        'default_sort': '-date',
+        'shape': _drop_id,
+    },
+    'products': {
+        'collection': 'products',
+        'sources': ['products'],
+        'filter': product_filter,
+        'search': ['name'],
+        'sorts': {
+            'name': [('name', 1)],
+            'total-desc': [('total_stock', -1)],
+            'total-asc': [('total_stock', 1)],
+            'signed-desc': [('us_signed', -1)],
+        },
+        'default_sort': 'name',
+        'shape': _drop_id,
+    },
+}
+
+
+# ==========================================
+# QUERIES
+# ==========================================
+
+def encode_cursor(values):
+    from bson import json_util
+
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, size):
+    from bson import json_util
+
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'),
+                                 json_options=json_util.JSONOptions(tz_aware=False))
+    except ValueError:
+        raise BadRequest("invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise BadRequest("invalid cursor (from another sort?)")
+    return values
+
+
+# BSON sort order of the types the sort fields hold (dates are strings in some rows, datetimes in others)
+_TYPE_ORDER = (None, 'number', 'string', 'date')
+
+
+def _type_rank(value):
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    return None
+
+
+def _after(value, direction):
+    """
+    Conditions on a field for values after 'value' in $sort order: a plain $gt / $lt within its
+    type (a range scan of the index), plus every type sorting after it ($lt, $gt never cross types).
+    """
+    conditions = [] if value is None else [{'$gt' if direction == 1 else '$lt': value}]
+    rank = _type_rank(value)
+    if rank is not None:
+        later = range(rank + 1, len(_TYPE_ORDER)) if direction == 1 else range(rank)
+        # Missing fields sort (and match) as null
+        conditions += [None if r == 0 else {'$type': _TYPE_ORDER[r]} for r in later]
+    return conditions
+
+
+def keyset_match(keys, values):
+    """ Rows strictly after 'values' in the (key, direction) order: a > v1, or a == v1 and b > v2, ... """
+    clauses = []
+    for i, (key, direction) in enumerate(keys):
+        equal = {k: v for (k, _d), v in zip(keys[:i], values[:i])}
+        clauses += [dict(equal, **{key: condition}) for condition in _after(values[i], direction)]
+    return {'$or': clauses}
+
+
+def build_pipeline(resource, params, limit, cursor=None):
+    """ Returns: (pipeline, sort keys) """
+    q = (params.get('q') or '').strip()
+    sort = params.get('sort') or resource['default_sort']
+    if sort not in resource['sorts']:
+        raise BadRequest(f"unknown sort: {sort} ({', '.join(resource['sorts'])})")
+
+    # _id breaks ties in the direction of the last key, so one (field, _id) index serves both directions
+    keys = list(resource['sorts'][sort])
+    keys.append(('_id', keys[-1][1] if keys else 1))
+
+    pipeline = []
+    # Filter and keyset first, on the stored fields: both are served by the index
+    match = resource['filter'](params)
+    if cursor:
+        keyset = keyset_match(keys, decode_cursor(cursor, len(keys)))
+        match = {'$and': [match, keyset]} if match else keyset
+    if match:
+        pipeline.append({'$match': match})
+    joined = resource['collection'] == 'outgoing_shipments'
+    if q:
+        if joined:
+            pipeline.append(CUSTOMER_LOOKUP)
+        pipeline.append({'$match': _search(resource['search'], q)})
+    pipeline.append({'$sort': dict(keys)})
+    # One extra row tells whether there is a next page
+    pipeline.append({'$limit': limit + 1})
+    if joined:
+        # Filtered on above, but not part of the exported documents
+        pipeline.append(SHIPMENT_INTERNAL_FIELDS)
+        if not q:
+            pipeline.append(CUSTOMER_LOOKUP)
+    return pipeline, keys
+
+
+class ReadAPI:
+    """ Query + cache layer over one database (shared by every request thread). """
+
+    def __init__(self, db, cache=None):
+        self.db = db
+        self.cache = cache if cache is not None else TTLCache()
+        self.lock = threading.Lock()
+        self.watermarks = {}
+        self.watermarks_read = None
+
+    def current_watermarks(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.watermarks_read is None or now - self.watermarks_read >= API_WATERMARK_POLL:
+                watermarks = load_watermarks(self.db)
+                if watermarks != self.watermarks:
+                    # Keys carry the watermarks, so old pages can never be served again: free them
+                    self.cache.clear()
+                self.watermarks, self.watermarks_read = watermarks, now
+            return self.watermarks
+
+    def page(self, name, params):
+        """ Returns: the page as JSON bytes, { "items": [doc], "next_cursor": str or null } """
+        resource = RESOURCES.get(name)
+        if resource is None:
+            raise KeyError(name)
+        try:
+            limit = int(params.get('limit') or API_PAGE_SIZE)
+        except ValueError:
+            raise BadRequest("limit must be a number")
+        limit = max(1, min(limit, API_MAX_PAGE_SIZE))
+
+        watermarks = self.current_watermarks()
+        key = (name, tuple(sorted(params.items())), limit,
+               tuple(watermarks.get(source) for source in resource['sources']))
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        pipeline, keys = build_pipeline(resource, params, limit, params.get('cursor'))
+        docs = list(self.db[resource['collection']].aggregate(pipeline))
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = encode_cursor([docs[-1].get(k) for k, _d in keys])
+        items = [resource['shape'](doc) for doc in docs]
+
+        # Cached as JSON: every hit is served without re-encoding
+        result = json.dumps({'items': items, 'next_cursor': next_cursor}, ensure_ascii=False,
+                            default=json_serial).encode('utf-8')
+        self.cache.put(key, result)
+        return result
+
+
+# ==========================================
+# HTTP
+# ==========================================
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            # The dashboard may be opened from another origin (or file://)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status, obj):
+            self._send(status, json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            path = url.path.rstrip('/')
+            if path == '/api/cache':
+                self._send_json(200, api.cache.stats())
+                return
+            if not path.startswith('/api/') or path[len('/api/'):] not in RESOURCES:
+                self._send_json(404, {'error': f"not found: {url.path}", 'resources': list(RESOURCES)})
+                return
+            try:
+                self._send(200, api.page(path[len('/api/'):], params))
+            except BadRequest as e:
+                self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                print(f"❌ {self.path}: {e}")
+                self._send_json(500, {'error': f"{type(e).__name__}: {e}"})
+
+    return Handler
+
+
+def serve_api(db, host=API_HOST, port=API_PORT, background=True):
+    """ Starts the read API (on a daemon thread unless background=False). Returns: the server """
+    server = ThreadingHTTPServer((host, port), make_handler(ReadAPI(db)))
+    print(f"📡 Read API on http://{host}:{server.server_address[1]}/api/ ({', '.join(RESOURCES)})")
+    if background:
+        threading.Thread(target=server.serve_forever, name='read-api', daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def main(argv=None):
+    # Fix emoji output on Windows consoles with GBK encoding
+    if sys.stdout.encoding and sys.stdout.encoding.lower() in ('gbk', 'gb2312', 'gb18030', 'cp936'):
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+    parser = argparse.ArgumentParser(description="Serve paginated, filtered reads of the MongoDB collections.")
+    parser.add_argument("--host", default=API_HOST, help=f"interface to listen on (default: {API_HOST})")
+    parser.add_argument("--port", type=int, default=API_PORT, help=f"port to listen on (default: {API_PORT})")
+    args = parser.parse_args(argv)
+
+    if not MONGO_URI:
+        print("❌ MONGO_URI is not set")
+        return 1
+    from pymongo import MongoClient
+
+    client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True, event_listeners=[command_listener()])
+    try:
+        serve_api(client[DB_NAME], args.host, args.port, background=False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+import re
+from collections import deque
+from functools import lru_cache
+
+# ==========================================
+# SHIPPING DETAILS PARSER
+# ==========================================
+# Turns free-text shipment details such as "1*蓝包装40oz+3*蓝包装20oz+1*礼盒包装"
+# into (product_name, qty, is_packaged) tuples.
+#
+# The alias table is compiled ONCE into an Aho-Corasick automaton, and parsed
+# results are memoized per normalized details string (most shipments repeat
+# the same few strings).
+
+# How many distinct normalized details strings to keep parsed results for
+PARSE_CACHE_SIZE = 4096
+
+# Stamped on the 'items' stored with each outgoing_shipments document. Bump it whenever NAME_MAP
+# or the parsing rules change: `db_refresh.py --backfill-items` re-parses the older documents.
+PARSER_VERSION = 1
+
+# Product Name Mapping
+# Maps keywords to the canonical Product Name in your database
+NAME_MAP = {
+    # 20oz Blue
+    "20oz蓝": "蓝底 20oz", "蓝20oz": "蓝底 20oz", "蓝底20oz": "蓝底 20oz",
+    # 40oz Blue
+    "40oz蓝": "蓝底 40oz", "蓝40oz": "蓝底 40oz", "蓝底40oz": "蓝底 40oz", "40蓝": "蓝底 40oz",
+    # 30oz Blue
+    "30oz蓝": "蓝底 30oz", "蓝30oz": "蓝底 30oz", "蓝底30oz": "蓝底 30oz",
+    # 20oz White
+    "20oz白": "白底 20oz", "白20oz": "白底 20oz", "白底20oz": "白底 20oz",
+    "30oz白": "白底 30oz", "白30oz": "白底 30oz", "白底30oz": "白底 30oz",
+    # 40oz White
+    "40oz白": "白底 40oz", "白40oz": "白底 40oz", "白底40oz": "白底 40oz", "40白": "白底 40oz",
+    # 20oz pink
+    "20oz粉": "粉底 20oz", "粉20oz": "粉底 20oz", "粉底20oz": "粉底 20oz",
+    "40oz粉": "粉底 40oz", "粉40oz": "粉底 40oz", "粉底40oz": "粉底 40oz", "40粉": "粉底 40oz",
+    # Slim Bottle
+    "SlimBottle": "Slim Bottle", "Slim": "Slim Bottle",  # Spaceless due to earlier replace
+    "礼盒": "礼盒",
+    "HolidayReserveAllDayWineSet": "Holiday Reserve All Day Wine Set",
+    "TheReserveWineTumblerSet|11oz": "The Reserve Wine Tumbler Set | 11 oz",
+    "Everyday Camp Mug Set": "Everyday Camp Mug Set", "EverydayCampMugSet": "Everyday Camp Mug Set",
+    "Holiday The Quencher Details ProTour Tumbler Set": "Holiday The Quencher Details ProTour Tumbler Set",
+    "HolidayTheQuencherDetailsProTourTumblerSet": "Holiday The Quencher Details ProTour Tumbler Set",
+    "Coquette Bow Chantilly 20oz": "Coquette Bow Chantilly 20oz", "CoquetteBowChantilly20oz": "Coquette Bow Chantilly 20oz",
+    "情人节款20oz": "情人节款20oz", "情人节款30oz": "情人节款30oz", "情人节款40oz": "情人节款40oz",
+    "情人节款红色20oz": "情人节款红色20oz", "情人节款红色30oz": "情人节款红色30oz", "情人节款红色40oz": "情人节款红色40oz",
+}
+
+_FLATTENED_RE = re.compile(r'(\d+)\*?压扁包装')
+_GROUP_RE = re.compile(r'\((.*?)\)')
+
+
+class AliasMatcher:
+    """
+    Aho-Corasick automaton over the alias keys.
+    find() returns the canonical name of the LONGEST key contained in the text
+    (ties go to the key listed first), or None if no key matches.
+    """
+
+    def __init__(self, name_map):
+        # Rank 0 = best match. Same order as sorting keys by length desc (stable).
+        ranked_keys = sorted(name_map.keys(), key=len, reverse=True)
+        self.values = [name_map[k] for k in ranked_keys]
+
+        # goto[state] = {char: next_state}, best[state] = best rank ending here (or None)
+        self.goto = [{}]
+        self.best = [None]
+        for rank, key in enumerate(ranked_keys):
+            state = 0
+            for char in key:
+                nxt = self.goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][char] = nxt
+                    self.goto.append({})
+                    self.best.append(None)
+                state = nxt
+            if self.best[state] is None:
+                self.best[state] = rank
+
+        # Breadth-first pass: failure links, and inherit the best rank of the
+        # longest proper suffix so a single scan sees every key ending at a position.
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and char not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(char, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                inherited = self.best[self.fail[nxt]]
+                if inherited is not None and (self.best[nxt] is None or inherited < self.best[nxt]):
+                    self.best[nxt] = inherited
+                queue.append(nxt)
+
+    def find(self, text):
+        goto, fail, best = self.goto, self.fail, self.best
+        state = 0
+        found = None
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            rank = best[state]
+            if rank is not None and (found is None or rank < found):
+                found = rank
+                if found == 0:
+                    break
+        return None if found is None else self.values[found]
+
+
+_MATCHER = AliasMatcher(NAME_MAP)
+
+
+def normalize_details(details_str):
+    # Replace x/X with *, standardize brackets, remove spaces
+    return details_str.replace("x", "*").replace("X", "*").replace("（", "(").replace("）", ")").replace(" ", "")
+
+
+def _split_multiplier(part):
+    """ "3*蓝20oz" -> (3, "蓝20oz"). Falls back to (1, part) if there is no valid multiplier. """
+    if '*' in part:
+        try:
+            m_str, content = part.split('*', 1)
+            return int(m_str), content
+        except ValueError:
+            pass
+    return 1, part
+
+
+def _parse_single_item(item_str, multiplier, items):
+    # A. Check for Packaging Keyword
+    is_pkg = "包装" in item_str
+
+    # B. Clean the string for matching (Remove "包装" so "蓝包装20oz" becomes "蓝20oz")
+    clean_str = item_str.replace("包装", "")
+
+    # C. Match against the compiled alias table (longest key wins)
+    product = _MATCHER.find(clean_str)
+    if product is not None:
+        items.append((product, multiplier, is_pkg))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_normalized(s):
+    items = []
+
+    # 1. Handle Parentheses Groups
+    # We replace '+' inside parentheses with '&' to split safely later
+    chars = []
+    depth = 0
+    for char in s:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        chars.append('&' if char == '+' and depth > 0 else char)
+    parts = ''.join(chars).split('+')
+
+    # 2. Handle Special "Packaging Only" item
+    if "压扁包装" in s:
+        match = _FLATTENED_RE.search(s)
+        qty = int(match.group(1)) if match else 1
+        items.append(("压扁包装", qty, True))
+
+    # 3. Process each part
+    for part in parts:
+        part = part.strip()
+        if not part: continue
+
+        mult, content = _split_multiplier(part)
+        content = content.replace('&', '+')
+
+        # Check for groups (...)
+        if '(' in content:
+            match = _GROUP_RE.search(content)
+            if match:
+                for sub in match.group(1).split('+'):
+                    # Handle inner multiplier if exists (e.g. inside group)
+                    sub_mult, sub_content = _split_multiplier(sub)
+                    _parse_single_item(sub_content, mult * sub_mult, items)
+        else:
+            # Single Item
+            _parse_single_item(content, mult, items)
+
+    return tuple(items)
+
+
+def parse_shipping_details(details_str):
+    """
+    Parses a shipping details string and extracts product items, quantities, and packaging status.
+    Returns: A list of tuples: (product_name, qty, is_packaged_bool)
+    """
+    return list(_parse_normalized(normalize_details(details_str)))
+
+
+def items_from_details(details_str):
+    """ parse_shipping_details as stored documents: [ { product, qty, packaged } ] """
+    return [{'product': p_name, 'qty': qty, 'packaged': is_packaged}
+            for p_name, qty, is_packaged in parse_shipping_details(details_str)]
+
+
+def shipment_items(ship):
+    """
+    (product_name, qty, is_packaged) tuples of a shipment: its stored 'items' when this
+    PARSER_VERSION wrote them, otherwise parsed from 'details'.
+    """
+    if ship.get('parser_version') == PARSER_VERSION and ship.get('items') is not None:
+        return [(item['product'], item['qty'], item['packaged']) for item in ship['items']]
+    return parse_shipping_details(ship['details'])
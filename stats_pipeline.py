@@ -0,0 +1,157 @@
+from aggregation import Reducer, stats_image_and_type
+from mongo_utils import BULK_BATCH_SIZE, STAGING_SUFFIX, bulk_write_chunked, create_staging, swap_in, touch_collections
+
+# ==========================================
+# PRODUCT STATS ON THE SERVER (db_refresh.py --stats-pipeline)
+# ==========================================
+# Same product_stats documents as aggregation.ProductStats, computed by MongoDB from the 'items'
+# db_refresh.py stores on outgoing_shipments, with their sheet position ('row') and the
+# 'duplicate_rows' of repeated tracking numbers (which ProductStats counts too):
+#   product_stats_meta   { _id: product, image, type, rank (stats template position or None), stock }
+# PRODUCT_STATS_PIPELINE unwinds the items, groups them per product / recipient and
+# $merges them into a staging collection that is then renamed over product_stats. Each row keeps
+# its sort key in 'order' (export_mongo.iter_stats sorts on it: $merge does not keep the order).
+# The client only uploads one meta document per product.
+# Needs MongoDB 4.2+ ($merge); mongomock does not implement $merge / $reduce.
+
+META_COLLECTION = "product_stats_meta"
+# Uploaded by older versions, before the items were stored on the shipments
+LEGACY_LINES_COLLECTION = "shipment_lines"
+
+
+class ProductStatsMeta(Reducer):
+    """
+    Metadata of every product in the stats template or named by a shipment.
+    stock_counts is read at result() time, like ProductStats.
+    Result: [ meta doc ]
+    """
+    name = 'product_stats_meta'
+
+    def __init__(self, current_inventory_stats, product_images, fallback_images, stock_counts):
+        self.product_images = product_images
+        self.fallback_images = fallback_images
+        self.stock_counts = stock_counts
+
+        # 1. Template products keep their position (ties in the sort keep this order)
+        self.meta = {}
+        for rank, stat in enumerate(current_inventory_stats):
+            self.meta[stat['产品名称']] = {'image': stat.get('image', 'img/default.png'),
+                                          'type': stat.get('类型', 'product'), 'rank': rank}
+
+    def on_shipment(self, ship, parsed_items):
+        for p_name, _qty, _is_packaged in parsed_items:
+            if p_name not in self.meta:
+                image, p_type = stats_image_and_type(p_name, self.product_images, self.fallback_images)
+                self.meta[p_name] = {'image': image, 'type': p_type, 'rank': None}
+
+    def result(self):
+        meta = []
+        for p_name, entry in self.meta.items():
+            stock = self.stock_counts[p_name]['total'] if p_name in self.stock_counts else 0
+            if entry['type'] == 'packaging': stock = 'N/A'
+            meta.append(dict(entry, _id=p_name, stock=stock))
+        return meta
+
+
+def _format_details(details):
+    """ aggregation.format_details as an expression: "name(qty), ..." or "——". """
+    return {'$cond': [
+        {'$eq': [{'$size': details}, 0]},
+        "——",
+        {'$reduce': {
+            'input': details,
+            'initialValue': "",
+            'in': {'$concat': ['$$value', {'$cond': [{'$eq': ['$$value', ""]}, "", ", "]},
+                               '$$this.name', "(", {'$toString': '$$this.qty'}, ")"]},
+        }},
+    ]}
+
+
+def _bucket(packed):
+    return {'$filter': {'input': '$details', 'cond': {'$eq': ['$$this.packed', packed]}}}
+
+
+PRODUCT_STATS_PIPELINE = [
+    # 1. One row per line item of every sheet row (copy 0: the shipment's own, then its duplicates),
+    #    with its position in the sheet
+    {'$addFields': {'copies': {'$concatArrays': [[None], {'$ifNull': ['$duplicate_rows', []]}]}}},
+    {'$unwind': {'path': '$copies', 'includeArrayIndex': 'copy'}},
+    {'$project': {
+        'row': {'$cond': [{'$eq': ['$copy', 0]}, '$row', '$copies.row']},
+        'recipient': {'$cond': [{'$eq': ['$copy', 0]}, '$recipient', '$copies.recipient']},
+        'items': {'$cond': [{'$eq': ['$copy', 0]}, '$items', '$copies.items']},
+    }},
+    {'$unwind': {'path': '$items', 'includeArrayIndex': 'line'}},
+    {'$project': {
+        'product': '$items.product',
+        'qty': '$items.qty',
+        'recipient': 1,
+        # Special Case: "Packaging Only" is implicitly "Packaged"
+        'packed': {'$or': ['$items.packaged', {'$eq': ['$items.product', "压扁包装"]}]},
+        'row': 1,
+        'line': 1,
+    }},
+    {'$sort': {'row': 1, 'line': 1}},
+
+    # 2. Per product, packaging bucket and recipient; recipients in first-seen (row, line) order
+    {'$group': {'_id': {'product': '$product', 'packed': '$packed', 'recipient': '$recipient'},
+                'qty': {'$sum': '$qty'}, 'row': {'$first': '$row'}, 'line': {'$first': '$line'}}},
+    {'$sort': {'row': 1, 'line': 1}},
+    {'$group': {'_id': '$_id.product',
+                'total': {'$sum': '$qty'},
+                'packed': {'$sum': {'$cond': ['$_id.packed', '$qty', 0]}},
+                'details': {'$push': {'name': '$_id.recipient', 'qty': '$qty', 'packed': '$_id.packed'}},
+                'row': {'$first': '$row'}, 'line': {'$first': '$line'}}},
+    {'$match': {'total': {'$gt': 0}}},
+
+    # 3. Packaging last, most shipped first; then template products (in template order),
+    #    then the others in first-seen order
+    {'$lookup': {'from': META_COLLECTION, 'localField': '_id', 'foreignField': '_id', 'as': 'meta'}},
+    {'$unwind': '$meta'},
+    {'$addFields': {'order': {
+        'packaging': {'$eq': ['$meta.type', 'packaging']},
+        'shipped': {'$multiply': ['$total', -1]},
+        'untemplated': {'$eq': ['$meta.rank', None]},
+        'rank': {'$ifNull': ['$meta.rank', 0]},
+        'row': '$row',
+        'line': '$line',
+    }}},
+
+    # 4. Same fields, in the same order, as ProductStats.result()
+    {'$project': {
+        '_id': 0,
+        '产品名称': '$_id',
+        'image': '$meta.image',
+        '已发总数': '$total',
+        '带包装': '$packed',
+        '带包装详情': _format_details(_bucket(True)),
+        '不带包装': {'$subtract': ['$total', '$packed']},
+        '不带包装详情': _format_details(_bucket(False)),
+        '总库存': '$meta.stock',
+        '类型': '$meta.type',
+        'order': 1,
+    }},
+    {'$merge': {'into': 'product_stats' + STAGING_SUFFIX, 'whenMatched': 'fail', 'whenNotMatched': 'insert'}},
+]
+
+
+def write_product_stats(db, meta, batch_size=BULK_BATCH_SIZE):
+    """
+    Uploads the product metadata (through a staging copy), builds product_stats from
+    outgoing_shipments with PRODUCT_STATS_PIPELINE and swaps it in.
+    Returns: number of product_stats documents
+    """
+    from pymongo import InsertOne
+
+    create_staging(db, [META_COLLECTION])
+    bulk_write_chunked(db[META_COLLECTION + STAGING_SUFFIX], [InsertOne(doc) for doc in meta], batch_size)
+    swap_in(db, [META_COLLECTION])
+    db.drop_collection(LEGACY_LINES_COLLECTION)
+
+    create_staging(db, ['product_stats'])
+    # $merge writes server-side: the pipeline returns no documents
+    db.outgoing_shipments.aggregate(PRODUCT_STATS_PIPELINE, allowDiskUse=True)
+    swap_in(db, ['product_stats'])
+
+    touch_collections(db, [META_COLLECTION, 'product_stats'])
+    return db.product_stats.estimated_document_count()
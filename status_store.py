@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+
+from mongo_utils import BULK_BATCH_SIZE, bulk_write_chunked, ensure_indexes, touch_collections
+
+# ==========================================
+# SCRAPED TRACKING STATUS (MongoDB)
+# ==========================================
+# update_shipping.py writes what it scrapes here, so the work survives the next export:
+#   tracking_status          { _id: tracking_number, status, last_checked, changed_at }   latest only
+#   tracking_status_history  { tracking_number, status, previous_status, recorded_at }    append-only,
+#                                                                                           one doc per change
+#   outgoing_shipments.status is updated in place (the export reads it from there).
+# db_refresh.py re-applies tracking_status when it rewrites outgoing_shipments from the workbook.
+
+STATUS_COLLECTION = "tracking_status"
+HISTORY_COLLECTION = "tracking_status_history"
+
+
+def load_statuses(db, tracking_numbers=None):
+    """ Returns: { tracking_number: latest scraped status } """
+    query = {} if tracking_numbers is None else {'_id': {'$in': list(tracking_numbers)}}
+    return {doc['_id']: doc['status'] for doc in db[STATUS_COLLECTION].find(query, {'status': 1})}
+
+
+def save_statuses(db, statuses, checked_at=None, batch_size=BULK_BATCH_SIZE):
+    """
+    statuses: { tracking_number: scraped status } (successful scrapes only).
+    Bumps last_checked on every one; appends history and updates outgoing_shipments for changes.
+    Returns: number of changed statuses
+    """
+    from pymongo import InsertOne, UpdateOne
+
+    if not statuses:
+        return 0
+    checked_at = checked_at or datetime.now(timezone.utc)
+    ensure_indexes(db, [HISTORY_COLLECTION])
+    previous = load_statuses(db, statuses)
+
+    status_ops, history_ops, shipment_ops = [], [], []
+    for code, status in statuses.items():
+        changes = {'status': status, 'last_checked': checked_at}
+        if previous.get(code) != status:
+            changes['changed_at'] = checked_at
+            history_ops.append(InsertOne({'tracking_number': code, 'status': status,
+                                          'previous_status': previous.get(code), 'recorded_at': checked_at}))
+            shipment_ops.append(UpdateOne({'tracking_number': code}, {'$set': {'status': status}}))
+        status_ops.append(UpdateOne({'_id': code}, {'$set': changes}, upsert=True))
+
+    bulk_write_chunked(db[STATUS_COLLECTION], status_ops, batch_size, ordered=False)
+    bulk_write_chunked(db[HISTORY_COLLECTION], history_ops, batch_size)
+    bulk_write_chunked(db.outgoing_shipments, shipment_ops, batch_size, ordered=False)
+
+    touch_collections(db, [STATUS_COLLECTION] + ([HISTORY_COLLECTION, 'outgoing_shipments'] if history_ops else []))
+    return len(history_ops)
+
+
+def apply_statuses(db, shipment_docs):
+    """ Overwrites the (workbook) status of shipment docs with the latest scraped one, in place. """
+    latest = load_statuses(db, [doc['tracking_number'] for doc in shipment_docs])
+    for doc in shipment_docs:
+        if doc['tracking_number'] in latest:
+            doc['status'] = latest[doc['tracking_number']]
+    return len(latest)
@@ -0,0 +1,118 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+# ==========================================
+# TRACKING POLL SCHEDULER
+# ==========================================
+# Decides which JunAn tracking numbers are worth querying on this run:
+#   - delivered (terminal) statuses are never polled again
+#   - fresh shipments are polled every run
+#   - stale ones back off exponentially while their status does not change
+# Next-poll times persist in data/.cache/tracking_schedule.json between runs. It changes on
+# every run, so it is kept out of the committed data/*.json; the workflow carries it between
+# CI runs with actions/cache.
+
+SCHEDULE_FILE = 'data/.cache/tracking_schedule.json'
+
+# Same markers as isDelivered() in js/app.js
+DELIVERED_MARKERS = ('已派送', '已签收', '已放在', '丰巢取出', '派送至')
+
+# Scrape results that say nothing about the parcel -- keep the old status, retry next run
+FAILED_PREFIXES = ('Update Failed', 'Connection Failed')
+
+BASE_INTERVAL_HOURS = float(os.environ.get("POLL_BASE_INTERVAL_HOURS", "2"))
+MAX_INTERVAL_HOURS = float(os.environ.get("POLL_MAX_INTERVAL_HOURS", "48"))
+FRESH_DAYS = int(os.environ.get("POLL_FRESH_DAYS", "7"))
+# A shipment due within this window counts as due now (scheduled CI runs often start late)
+POLL_SLACK = timedelta(minutes=30)
+
+
+def is_delivered(status):
+    return any(marker in (status or '') for marker in DELIVERED_MARKERS)
+
+
+def is_failed(status):
+    return (status or '').startswith(FAILED_PREFIXES)
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _shipment_age_days(item, now):
+    try:
+        shipped = datetime.strptime(str(item.get('date', ''))[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return (now - shipped).days
+
+
+class PollScheduler:
+    """
+    Per-tracking-number schedule:
+    { code: { "status", "terminal", "unchanged_polls", "last_checked", "next_poll" } }
+    """
+
+    def __init__(self, path=SCHEDULE_FILE):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (ValueError, OSError) as e:
+                print(f"⚠️ Ignoring unreadable schedule {path}: {e}")
+
+    def is_due(self, item, now):
+        code = item.get('tracking_number')
+        entry = self.entries.get(code)
+
+        if is_delivered(item.get('status')) or (entry and entry.get('terminal')):
+            return False
+        if not entry or not entry.get('next_poll'):
+            return True
+        return _parse_time(entry['next_poll']) <= now + POLL_SLACK
+
+    def known_status(self, code):
+        """ Last scraped status, if any (used to undo a stale status written by the export). """
+        entry = self.entries.get(code)
+        return entry.get('status') if entry else None
+
+    def record(self, item, status, now):
+        """ Stores a scrape result and schedules the next poll. Returns the status to keep. """
+        code = item.get('tracking_number')
+        entry = self.entries.setdefault(code, {'status': item.get('status'), 'unchanged_polls': 0})
+
+        if is_failed(status):
+            # Nothing learned: keep the previous status and try again next run
+            status = entry.get('status') or item.get('status')
+            entry['next_poll'] = (now + timedelta(hours=BASE_INTERVAL_HOURS)).isoformat()
+            return status
+
+        if status == entry.get('status'):
+            entry['unchanged_polls'] = entry.get('unchanged_polls', 0) + 1
+        else:
+            entry['unchanged_polls'] = 0
+
+        entry['status'] = status
+        entry['last_checked'] = now.isoformat()
+        entry['terminal'] = is_delivered(status)
+
+        if entry['terminal']:
+            entry['next_poll'] = None
+        else:
+            age = _shipment_age_days(item, now)
+            if age is not None and age <= FRESH_DAYS:
+                hours = BASE_INTERVAL_HOURS
+            else:
+                hours = min(MAX_INTERVAL_HOURS, BASE_INTERVAL_HOURS * (2 ** entry['unchanged_polls']))
+            entry['next_poll'] = (now + timedelta(hours=hours)).isoformat()
+        return status
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
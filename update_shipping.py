@@ -1,90 +1,276 @@
 import json
 import requests
+import random
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+
+from compact_export import compact_path, publish_compact
+from instrumentation import command_listener, count, propagate_stage, stage, start_run
+from tracking_schedule import PollScheduler, is_delivered, is_failed
+
+# Load .env file if present (for local development)
+_env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if os.path.exists(_env_path):
+    with open(_env_path) as _f:
+        for _line in _f:
+            _line = _line.strip()
+            if _line and not _line.startswith('#') and '=' in _line:
+                _k, _v = _line.split('=', 1)
+                os.environ.setdefault(_k.strip(), _v.strip())
 
 # Define file path
 JSON_FILE = 'data/shipping.json'
 
-def scrape_junan_status(tracking_number, phone): # Renamed for consistency
-    url = "https://www.junanex.com/tracking"
+# Scraped statuses are written back to MongoDB when MONGO_URI is set
+MONGO_URI = os.environ.get("MONGO_URI", "")
+DB_NAME = os.environ.get("MONGO_DB_NAME", "tracking_db")
+
+# --- SCRAPER CONFIG ---
+JUNAN_URL = os.environ.get("JUNAN_TRACKING_URL", "https://www.junanex.com/tracking")
+# Politeness limit: requests per second (token bucket) and max concurrent requests
+SCRAPER_RATE_LIMIT = float(os.environ.get("SCRAPER_RATE_LIMIT", "2"))
+SCRAPER_MAX_IN_FLIGHT = int(os.environ.get("SCRAPER_MAX_IN_FLIGHT", "4"))
+# Retries on timeouts / connection errors / 5xx / 429, with jittered exponential backoff
+SCRAPER_MAX_RETRIES = int(os.environ.get("SCRAPER_MAX_RETRIES", "3"))
+SCRAPER_BACKOFF_BASE = float(os.environ.get("SCRAPER_BACKOFF_BASE", "1"))
+SCRAPER_BACKOFF_MAX = 30
+SCRAPER_TIMEOUT = 10
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'X-Requested-With': 'XMLHttpRequest'
+}
+
+
+class TokenBucket:
+    """ Thread-safe token bucket: acquire() blocks until a request is allowed. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size=SCRAPER_MAX_IN_FLIGHT):
+    """ Keep-alive session with a connection pool big enough for every worker. """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # Every response is one round trip of the current metrics stage
+    session.hooks['response'].append(lambda response, *args, **kwargs: count(round_trips=1))
+    return session
+
+
+_default_session = None
+
+
+def get_session():
+    global _default_session
+    if _default_session is None:
+        _default_session = make_session()
+    return _default_session
+
+
+def backoff_delay(attempt):
+    """ Full jitter: random delay up to base * 2^attempt (capped). """
+    return random.uniform(0, min(SCRAPER_BACKOFF_MAX, SCRAPER_BACKOFF_BASE * (2 ** attempt)))
+
+
+def scrape_junan_status(tracking_number, phone, session=None, limiter=None, max_retries=SCRAPER_MAX_RETRIES): # Renamed for consistency
+    session = session or get_session()
     payload = {
         't': 'query_code',
         'code': tracking_number,
         'mobile': phone  # Matches the argument above
     }
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'X-Requested-With': 'XMLHttpRequest'
-    }
 
-    try:
-        # Use POST to talk to the API
-        response = requests.post(url, data=payload, headers=headers, timeout=10)
-
-        if response.status_code == 200:
-            data = response.json()
-            # Check if the API returned success
-            if data.get('success'):
-                history_list = data.get('message', [])
-                if history_list:
-                    # Logic from your snippet: take the latest entry
-                    latest_entry = history_list[0]
-                    
-                    # Your logic: Get the last key (latest status)
-                    # Note: Depending on JunAn's structure, we might need the value or the key.
-                    # Assuming your snippet is correct and the status is the key.
-                    if isinstance(latest_entry, dict):
-                        keys = list(latest_entry.keys())
-                        if keys:
-                            return keys[-1] # Returns the status text
-                    
-                    # Fallback if entry is just a string or different format
-                    return str(latest_entry)
-
-            return "Check Website (No Data)"
-        return f"Connection Failed ({response.status_code})"
-    
-    except Exception as e:
-        print(f"Scraper Error for {tracking_number}: {e}")
-        return "Update Failed"
+    for attempt in range(max_retries + 1):
+        if limiter:
+            limiter.acquire()
+
+        try:
+            # Use POST to talk to the API
+            response = session.post(JUNAN_URL, data=payload, headers=HEADERS, timeout=SCRAPER_TIMEOUT)
+
+            # Server busy / rate limited: back off and retry
+            if (response.status_code >= 500 or response.status_code == 429) and attempt < max_retries:
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if response.status_code == 200:
+                data = response.json()
+                # Check if the API returned success
+                if data.get('success'):
+                    history_list = data.get('message', [])
+                    if history_list:
+                        # Logic from your snippet: take the latest entry
+                        latest_entry = history_list[0]
 
-def update_tracking():
+                        # Your logic: Get the last key (latest status)
+                        # Note: Depending on JunAn's structure, we might need the value or the key.
+                        # Assuming your snippet is correct and the status is the key.
+                        if isinstance(latest_entry, dict):
+                            keys = list(latest_entry.keys())
+                            if keys:
+                                return keys[-1] # Returns the status text
+
+                        # Fallback if entry is just a string or different format
+                        return str(latest_entry)
+
+                return "Check Website (No Data)"
+            return f"Connection Failed ({response.status_code})"
+
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if attempt < max_retries:
+                time.sleep(backoff_delay(attempt))
+                continue
+            print(f"Scraper Error for {tracking_number}: {e}")
+            return "Update Failed"
+
+        except Exception as e:
+            print(f"Scraper Error for {tracking_number}: {e}")
+            return "Update Failed"
+
+
+def scrape_many(targets, rate=SCRAPER_RATE_LIMIT, max_in_flight=SCRAPER_MAX_IN_FLIGHT, session=None):
+    """
+    Scrapes [(tracking_number, phone)] on a worker pool sharing one keep-alive session.
+    Throughput is bounded by the token bucket (rate) and max_in_flight, not by serial latency.
+    Yields (tracking_number, status) as they complete.
+    """
+    session = session or make_session(max_in_flight)
+    limiter = TokenBucket(rate)
+
+    # The requests are counted as round trips of the caller's stage
+    scrape = propagate_stage(scrape_junan_status)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        futures = {
+            pool.submit(scrape, tracking_code, phone, session, limiter): tracking_code
+            for tracking_code, phone in targets
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def update_tracking(session=None, db=None):
+    """ session / db: warm HTTP session and database to reuse (worker.py); created per run otherwise. """
     if not os.path.exists(JSON_FILE):
         print(f"Error: {JSON_FILE} not found.")
         return
 
     # 1. Read the current JSON
-    with open(JSON_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with stage('load'):
+        with open(JSON_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        count(rows=len(data))
 
     print(f"Checking {len(data)} items...")
 
-    # 2. Loop through and update
+    # 2. Collect what to check (skip if missing data)
+    items_by_code = {}
     for item in data:
         tracking_code = item.get('tracking_number')
         phone = item.get('phone')
-        
-        # Skip if missing data
         if not tracking_code or not phone:
             continue
+        items_by_code.setdefault(tracking_code, []).append(item)
+
+    # 3. Only poll what is due: delivered shipments are done, stale ones are backed off
+    with stage('schedule'):
+        scheduler = PollScheduler()
+        now = datetime.now(timezone.utc)
+        targets = []
+        delivered = 0
+        for code, items in items_by_code.items():
+            # The export rewrites statuses from MongoDB; keep the newer scraped one
+            known_status = scheduler.known_status(code)
+            if known_status:
+                for item in items:
+                    item['status'] = known_status
+
+            if scheduler.is_due(items[0], now):
+                targets.append((code, items[0].get('phone')))
+            elif is_delivered(items[0].get('status')):
+                delivered += 1
+        count(rows=len(items_by_code))
+
+    print(f"Scraping {len(targets)} of {len(items_by_code)} tracking numbers "
+          f"({delivered} delivered, {len(items_by_code) - len(targets) - delivered} not due yet; "
+          f"{SCRAPER_RATE_LIMIT:g} req/s, {SCRAPER_MAX_IN_FLIGHT} in flight)...")
 
-        print(f"Checking {tracking_code}...")
-        
-        # Call the new API scraper function
-        new_status = scrape_junan_status(tracking_code, phone)
-        
-        # Update the item status
-        item['status'] = new_status
-        print(f"  -> Status: {new_status}")
-        
-        # Sleep to be polite to the server
-        time.sleep(1)
-
-    # 3. Save back to file
-    with open(JSON_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    # 4. Scrape concurrently and update the item status
+    scraped = {}
+    with stage('scrape'):
+        for tracking_code, new_status in scrape_many(targets, session=session):
+            if not is_failed(new_status):
+                scraped[tracking_code] = new_status
+            items = items_by_code[tracking_code]
+            new_status = scheduler.record(items[0], new_status, now)
+            for item in items:
+                item['status'] = new_status
+            print(f"  {tracking_code} -> Status: {new_status}")
+        count(rows=len(targets))
+
+    # 5. Save back to file
+    with stage('save'):
+        scheduler.save()
+        # Written next to it and renamed, so the site never serves a half-written file
+        tmp_path = f"{JSON_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, JSON_FILE)
+        # Keep the compact copy (export_mongo.py --compact) in step
+        if os.path.exists(compact_path(JSON_FILE)):
+            publish_compact(JSON_FILE, data)
+        count(rows=len(data))
     print("Done. shipping.json updated.")
 
+    # 6. ...and to MongoDB, so the next export does not bring back the old status
+    with stage('save_db'):
+        save_statuses_to_db(scraped, now, db)
+
+
+def save_statuses_to_db(scraped, checked_at, db=None):
+    if db is None and not MONGO_URI:
+        print("ℹ️ MONGO_URI not set, statuses were not written to MongoDB.")
+        return
+    if not scraped:
+        return
+
+    from pymongo import MongoClient
+    from status_store import save_statuses
+
+    try:
+        if db is None:
+            client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True, event_listeners=[command_listener()])
+            db = client[DB_NAME]
+        changed = save_statuses(db, scraped, checked_at)
+        count(rows=len(scraped))
+        print(f"✅ Saved {len(scraped)} statuses to MongoDB ({changed} changed)")
+    except Exception as e:
+        # shipping.json and the poll schedule already have them; MongoDB catches up on the next change
+        print(f"❌ Could not save statuses to MongoDB: {e}")
+
+
 if __name__ == "__main__":
-    update_tracking()
\ No newline at end of file
+    with start_run('update_shipping'):
+        update_tracking()
@@ -0,0 +1,297 @@
+import argparse
+import io
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import db_refresh
+import export_mongo
+import update_shipping
+from instrumentation import command_listener, peak_rss_mb, start_run
+
+# ==========================================
+# WORKER (long-running refresh / export / scrape)
+# ==========================================
+# One process instead of a cold start per cron run: one pooled MongoClient and one keep-alive
+# JunAn session stay warm, and the jobs run on an internal schedule:
+#   refresh  db_refresh.py --incremental   (workbooks -> MongoDB)
+#   export   export_mongo.py               (MongoDB -> data/*.json)
+#   scrape   update_shipping.py            (JunAn -> shipping.json + MongoDB)
+# Jobs run one at a time, in that order when several are due, so a scrape always reads the
+# shipping.json the last export wrote. Each run is followed by interval * (1 ± jitter) of rest.
+#
+#   GET /health   200 {"status": "ok"} / 503 when the loop is stuck or a job keeps failing
+#   GET /metrics  per-job runs, failures, last duration / error, next run; uptime, peak RSS
+# --api-port also serves read_api.py from the same warm client (its cache follows the jobs' writes).
+#
+# The scripts themselves stay one-shot for cron and the GitHub workflow;
+# `python worker.py --once` runs every job once with the same warm connections.
+
+# Load .env file if present (for local development)
+_env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if os.path.exists(_env_path):
+    with open(_env_path) as _f:
+        for _line in _f:
+            _line = _line.strip()
+            if _line and not _line.startswith('#') and '=' in _line:
+                _k, _v = _line.split('=', 1)
+                os.environ.setdefault(_k.strip(), _v.strip())
+
+MONGO_URI = os.environ.get("MONGO_URI", "")
+DB_NAME = os.environ.get("MONGO_DB_NAME", "tracking_db")
+
+# Seconds between the end of one run of a job and the start of the next
+JOB_INTERVALS = {
+    'refresh': float(os.environ.get("WORKER_REFRESH_INTERVAL", "1800")),
+    'export': float(os.environ.get("WORKER_EXPORT_INTERVAL", "600")),
+    'scrape': float(os.environ.get("WORKER_SCRAPE_INTERVAL", "900")),
+}
+# Each interval is stretched / shrunk by up to this fraction, so runs do not line up
+WORKER_JITTER = float(os.environ.get("WORKER_JITTER", "0.1"))
+# Health / metrics endpoint (WORKER_PORT=0 turns it off)
+WORKER_HOST = os.environ.get("WORKER_HOST", "127.0.0.1")
+WORKER_PORT = int(os.environ.get("WORKER_PORT", "8008"))
+# /health reports 503 once a job failed this many times in a row
+WORKER_MAX_FAILURES = int(os.environ.get("WORKER_MAX_FAILURES", "3"))
+# ...or when the scheduler loop has not moved on for this long (a hung job)
+WORKER_STALE_AFTER = float(os.environ.get("WORKER_STALE_AFTER", "3600"))
+# Also serve read_api.py from the worker's client on this port (0: off)
+WORKER_API_PORT = int(os.environ.get("WORKER_API_PORT", "0"))
+
+JOBS = ('refresh', 'export', 'scrape')
+
+
+def next_delay(interval, jitter=WORKER_JITTER):
+    """ interval * (1 ± jitter), never negative. """
+    return max(0.0, interval * (1 + random.uniform(-jitter, jitter)))
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+class Job:
+    """ A scheduled job and its run statistics. """
+
+    def __init__(self, name, fn, script, interval):
+        self.name = name
+        self.fn = fn
+        self.script = script
+        self.interval = interval
+        self.next_run = time.monotonic()
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_status = None
+        self.last_error = None
+        self.last_started_at = None
+        self.last_duration_s = None
+
+    def run(self):
+        self.last_started_at = _now_iso()
+        started = time.perf_counter()
+        try:
+            # Same metrics record as the one-shot script
+            with start_run(self.script):
+                self.fn()
+            self.last_status, self.last_error = 'ok', None
+            self.consecutive_failures = 0
+        except Exception as e:
+            traceback.print_exc()
+            print(f"❌ Job {self.name} failed: {e}")
+            self.last_status, self.last_error = 'error', f"{type(e).__name__}: {e}"
+            self.failures += 1
+            self.consecutive_failures += 1
+        finally:
+            self.runs += 1
+            self.last_duration_s = round(time.perf_counter() - started, 3)
+            self.next_run = time.monotonic() + next_delay(self.interval)
+
+    def stats(self):
+        return {
+            'interval_s': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'last_status': self.last_status,
+            'last_error': self.last_error,
+            'last_started_at': self.last_started_at,
+            'last_duration_s': self.last_duration_s,
+            'next_run_in_s': round(max(0.0, self.next_run - time.monotonic()), 1),
+        }
+
+
+class Worker:
+    """ Warm MongoDB client + HTTP session, and the jobs that share them. """
+
+    def __init__(self, jobs=JOBS, compact=export_mongo.EXPORT_COMPACT, stats_pipeline=db_refresh.STATS_PIPELINE):
+        from pymongo import MongoClient
+
+        # Big enough for the concurrent exports; connections are kept between runs
+        self.client = MongoClient(MONGO_URI, tlsAllowInvalidCertificates=True,
+                                  maxPoolSize=max(len(export_mongo.EXPORTS) + 1, 10),
+                                  event_listeners=[command_listener()])
+        self.db = self.client[DB_NAME]
+        self.session = update_shipping.make_session()
+
+        job_fns = {
+            'refresh': lambda: db_refresh.RefreshPipeline(stats_pipeline=stats_pipeline).write(db=self.db,
+                                                                                               incremental=True),
+            'export': lambda: export_mongo.export_data(compact=compact, db=self.db),
+            'scrape': lambda: update_shipping.update_tracking(session=self.session, db=self.db),
+        }
+        scripts = {'refresh': 'db_refresh', 'export': 'export_mongo', 'scrape': 'update_shipping'}
+        self.jobs = [Job(name, job_fns[name], scripts[name], JOB_INTERVALS[name]) for name in JOBS if name in jobs]
+
+        self.started = time.monotonic()
+        self.heartbeat = time.monotonic()
+        self.stopping = threading.Event()
+
+    def run_once(self):
+        """ Every job once, in order. Returns: True if all of them succeeded """
+        for job in self.jobs:
+            print(f"\n▶️ {job.name}")
+            job.run()
+        return all(job.last_status == 'ok' for job in self.jobs)
+
+    def run_forever(self):
+        print(f"🔁 Worker running: " + ", ".join(f"{job.name} every {job.interval:g}s" for job in self.jobs)
+              + f" (±{WORKER_JITTER:.0%})")
+        while not self.stopping.is_set():
+            self.heartbeat = time.monotonic()
+            due = [job for job in self.jobs if job.next_run <= self.heartbeat]
+            for job in due:
+                if self.stopping.is_set():
+                    break
+                print(f"\n▶️ {job.name} ({_now_iso()})")
+                job.run()
+                self.heartbeat = time.monotonic()
+            if not due:
+                wait = min(job.next_run for job in self.jobs) - time.monotonic()
+                # Wakes up early on stop(); capped so the heartbeat keeps moving
+                self.stopping.wait(min(max(wait, 0.0), 60.0))
+        print("👋 Worker stopped")
+
+    def stop(self, *_args):
+        self.stopping.set()
+
+    def close(self):
+        self.session.close()
+        self.client.close()
+
+    def health(self):
+        """ Returns: (healthy, reasons) """
+        reasons = []
+        idle = time.monotonic() - self.heartbeat
+        if idle > WORKER_STALE_AFTER:
+            reasons.append(f"scheduler loop idle for {idle:.0f}s")
+        for job in self.jobs:
+            if job.consecutive_failures >= WORKER_MAX_FAILURES:
+                reasons.append(f"{job.name} failed {job.consecutive_failures} times in a row: {job.last_error}")
+        return not reasons, reasons
+
+    def metrics(self):
+        return {
+            'uptime_s': round(time.monotonic() - self.started, 1),
+            'peak_rss_mb': peak_rss_mb(),
+            'jobs': {job.name: job.stats() for job in self.jobs},
+        }
+
+
+# ==========================================
+# HEALTH / METRICS ENDPOINT
+# ==========================================
+
+def make_handler(worker):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, obj):
+            body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/health':
+                healthy, reasons = worker.health()
+                self._send_json(200 if healthy else 503, {'status': 'ok' if healthy else 'unhealthy',
+                                                          'reasons': reasons})
+            elif path == '/metrics':
+                self._send_json(200, worker.metrics())
+            else:
+                self._send_json(404, {'error': f"not found: {path}"})
+
+        def log_message(self, format, *args):
+            # Health checks every few seconds would drown the job output
+            pass
+
+    return Handler
+
+
+def serve_status(worker, host=WORKER_HOST, port=WORKER_PORT):
+    """ Starts the /health + /metrics server on a daemon thread. Returns: the server """
+    server = ThreadingHTTPServer((host, port), make_handler(worker))
+    threading.Thread(target=server.serve_forever, name='worker-status', daemon=True).start()
+    print(f"🩺 Health / metrics on http://{host}:{server.server_address[1]}/health")
+    return server
+
+
+def main(argv=None):
+    # Fix emoji output on Windows consoles with GBK encoding
+    if sys.stdout.encoding and sys.stdout.encoding.lower() in ('gbk', 'gb2312', 'gb18030', 'cp936'):
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+    parser = argparse.ArgumentParser(description="Run the refresh, export and scrape jobs in one long-lived process.")
+    parser.add_argument("--jobs", default=",".join(JOBS),
+                        help=f"comma-separated jobs to run (default: {','.join(JOBS)})")
+    parser.add_argument("--once", action="store_true", help="run every job once, then exit (for cron)")
+    parser.add_argument("--port", type=int, default=WORKER_PORT,
+                        help=f"health / metrics port, 0 to disable (default: {WORKER_PORT})")
+    parser.add_argument("--api-port", type=int, default=WORKER_API_PORT,
+                        help="also serve the read API (read_api.py) on this port (default: off)")
+    parser.add_argument("--compact", action="store_true", default=export_mongo.EXPORT_COMPACT,
+                        help="export jobs also write the minified data/<name>.min.json files")
+    parser.add_argument("--stats-pipeline", action="store_true", default=db_refresh.STATS_PIPELINE,
+                        help="refresh jobs build product_stats with a MongoDB aggregation pipeline")
+    args = parser.parse_args(argv)
+
+    jobs = [j.strip() for j in args.jobs.split(",") if j.strip()]
+    unknown = [j for j in jobs if j not in JOBS]
+    if unknown:
+        parser.error(f"unknown job(s): {', '.join(unknown)} (choose from {', '.join(JOBS)})")
+    if not MONGO_URI:
+        print("❌ MONGO_URI is not set")
+        return 1
+
+    worker = Worker(jobs, compact=args.compact, stats_pipeline=args.stats_pipeline)
+    try:
+        if args.once:
+            return 0 if worker.run_once() else 1
+
+        server = serve_status(worker, port=args.port) if args.port else None
+        if args.api_port:
+            from read_api import serve_api
+            serve_api(worker.db, WORKER_HOST, args.api_port)
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+        worker.run_forever()
+        if server:
+            server.shutdown()
+        return 0
+    finally:
+        worker.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())